@@ -0,0 +1,115 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+# All Rights Reserved
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Measure concurrent quota reservation throughput of one project
+
+Usage: quota_reserve_benchmark.py CONFIG_FILE [WORKERS] [ROUNDS]
+
+Each worker thread reserves and commits quota of the same project ROUNDS
+times, reservations per second and deadlock retries of every DB API call
+are printed at the end. Tables should already exist in the database
+configured in CONFIG_FILE, run against MySQL or PostgreSQL, since sqlite
+serializes all the writers anyway.
+"""
+
+import datetime
+import sys
+import threading
+import time
+
+from oslo_config import cfg
+
+from tricircle.common import context
+from tricircle.common import exceptions
+from tricircle.common import quota
+from tricircle.db import api
+from tricircle.db import core
+
+PROJECT_ID = 'quota_reserve_benchmark'
+RESOURCES = ('volumes', 'gigabytes', 'snapshots', 'backups')
+
+
+_LOCK = threading.Lock()
+
+
+def _run_worker(index, rounds, stats):
+    ctx = context.get_admin_context()
+    # workers touch overlapping but different resource sets
+    names = RESOURCES[index % 2:]
+    resources = dict((name, quota.ReservableResource(name, None))
+                     for name in names)
+    quotas = dict((name, -1) for name in names)
+    deltas = dict((name, 1) for name in names)
+    for _ in xrange(rounds):
+        expire = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        try:
+            reservations = api.quota_reserve(ctx, resources, quotas, deltas,
+                                             expire, 0, 0, PROJECT_ID)
+            api.reservation_commit(ctx, reservations, PROJECT_ID)
+        except exceptions.OverQuota:
+            with _LOCK:
+                stats['over_quota'] += 1
+            continue
+        except Exception:
+            # sqlite raises "database is locked" instead of deadlocks
+            with _LOCK:
+                stats['failed'] += 1
+            continue
+        with _LOCK:
+            stats['reserved'] += len(reservations)
+
+
+def main(argv=None, config_files=None):
+    core.initialize()
+    cfg.CONF(args=[], project='tricircle', default_config_files=config_files)
+    workers = int(argv[2]) if len(argv) > 2 else 10
+    rounds = int(argv[3]) if len(argv) > 3 else 100
+
+    ctx = context.get_admin_context()
+    api.quota_destroy_all_by_project(ctx, PROJECT_ID)
+    # create usages up front so only reservation is measured
+    resources = dict((name, quota.ReservableResource(name, None))
+                     for name in RESOURCES)
+    expire = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    api.reservation_rollback(
+        ctx, api.quota_reserve(ctx, resources,
+                               dict((name, -1) for name in RESOURCES),
+                               dict((name, 0) for name in RESOURCES),
+                               expire, 0, 0, PROJECT_ID),
+        PROJECT_ID)
+
+    stats = {'reserved': 0, 'over_quota': 0, 'failed': 0}
+    threads = [threading.Thread(target=_run_worker, args=(i, rounds, stats))
+               for i in xrange(workers)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    print('workers: %d, rounds: %d, elapsed: %.2fs' % (workers, rounds,
+                                                       elapsed))
+    print('reservations: %d, reservations/sec: %.1f, over quota: %d, '
+          'failed: %d' % (stats['reserved'], stats['reserved'] / elapsed,
+                          stats['over_quota'], stats['failed']))
+    print('deadlock retries: %s' % api.get_deadlock_retries())
+
+    api.quota_destroy_all_by_project(ctx, PROJECT_ID)
+
+
+if __name__ == '__main__':
+    config_file = sys.argv[1]
+    main(argv=sys.argv, config_files=[config_file])
@@ -62,14 +62,14 @@ def setup_app(*args, **kwargs):
     }
     pecan_config = pecan.configuration.conf_from_dict(config)
 
-    # app_hooks = [], hook collection will be put here later
+    app_hooks = [restapp.TransactionHook()]
 
     app = pecan.make_app(
         pecan_config.app.root,
         debug=False,
         wrap_app=restapp.auth_app,
         force_canonical=False,
-        hooks=[],
+        hooks=app_hooks,
         guess_content_type_from_ext=True
     )
 
@@ -18,15 +18,21 @@ from pecan import expose
 from pecan import Response
 from pecan import rest
 
+from oslo_config import cfg
 import oslo_db.exception as db_exc
 from oslo_log import log as logging
+from oslo_serialization import jsonutils
 from oslo_utils import uuidutils
+import six
+from six.moves import urllib
 
 from tricircle.common import az_ag
 import tricircle.common.context as t_context
 import tricircle.common.exceptions as t_exc
 from tricircle.common.i18n import _
 from tricircle.common.i18n import _LE
+from tricircle.common.i18n import _LW
+from tricircle.common import restapp
 from tricircle.common import utils
 
 from tricircle.db import api as db_api
@@ -36,6 +42,127 @@ from tricircle.db import models
 LOG = logging.getLogger(__name__)
 
 
+def _get_max_limit():
+    """Get the max number of items returned in one list response
+
+    :return: the number, or None if pagination_max_limit is not positive
+    """
+    max_limit = cfg.CONF.pagination_max_limit
+    if max_limit.lower() == 'infinite':
+        return None
+    try:
+        max_limit = int(max_limit)
+    except ValueError:
+        LOG.warning(_LW('Invalid value for pagination_max_limit: %s'),
+                    max_limit)
+        return None
+    return max_limit if max_limit > 0 else None
+
+
+def _get_list_params(kw, sort_keys):
+    """Parse limit, marker, sort_key and sort_dir of a list request
+
+    :param kw: query parameters of the request
+    :param sort_keys: indexed attributes the resources can be sorted by,
+                      the first one is the primary key
+    :return: (limit, marker, sorts), limit is bounded by
+             pagination_max_limit
+    :raises ValidationError: if some parameter is invalid
+    """
+    max_limit = _get_max_limit()
+    limit = kw.get('limit')
+    if limit is None:
+        limit = max_limit
+    else:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            raise t_exc.ValidationError(
+                msg=_('Limit must be a positive integer'))
+        if max_limit:
+            limit = min(limit, max_limit)
+
+    sort_key = kw.get('sort_key', sort_keys[0])
+    if sort_key not in sort_keys:
+        raise t_exc.ValidationError(
+            msg=_('Sort key must be one of %s') % ', '.join(sort_keys))
+    sort_dir = kw.get('sort_dir', 'asc')
+    if sort_dir not in ('asc', 'desc'):
+        raise t_exc.ValidationError(msg=_('Sort dir must be asc or desc'))
+    return limit, kw.get('marker'), [(sort_key, sort_dir == 'asc')]
+
+
+def _list_resources(context, collection, model, sort_keys, kw):
+    """List resources page by page in a streamed response
+
+    The page is read from the database in batches and serialized one
+    resource at a time. If more resources follow the page, a next link
+    with the primary key of the last resource as marker is appended.
+    """
+    try:
+        limit, marker, sorts = _get_list_params(kw, sort_keys)
+        if marker is not None:
+            with context.session.begin(subtransactions=True):
+                core.get_resource(context, model, marker)
+    except t_exc.ValidationError as e:
+        pecan.abort(400, six.text_type(e))
+        return
+    except t_exc.ResourceNotFound:
+        pecan.abort(400, _('Invalid marker'))
+        return
+
+    # NOTE: resources are streamed after the request transaction
+    # is finished, so they are read with a separate session. the first
+    # batch is read here, so failing to read it still returns an error
+    # status. one more resource is read to tell if there is a next page
+    stream_ctx = t_context.get_stream_context(context)
+    try:
+        resources = restapp.prefetch(core.query_resource_iter(
+            stream_ctx, model, [], sorts,
+            limit=limit + 1 if limit else None, marker=marker))
+    except Exception as e:
+        stream_ctx.session.close()
+        LOG.error(_LE('Fail to list %(collection)s: %(exception)s'),
+                  {'collection': collection, 'exception': e})
+        pecan.abort(500, _('Fail to list %s') % collection)
+        return
+    pk_key = sort_keys[0]
+    params = dict((key, value) for key, value in six.iteritems(kw)
+                  if key in ('limit', 'sort_key', 'sort_dir'))
+    url = pecan.request.path_url
+
+    def _stream():
+        yield '{"%s": [' % collection
+        last = None
+        try:
+            for i, resource in enumerate(resources):
+                if limit and i == limit:
+                    params['marker'] = last[pk_key]
+                    links = [{'rel': 'next',
+                              'href': '%s?%s' % (
+                                  url, urllib.parse.urlencode(
+                                      sorted(params.items())))}]
+                    yield '], "%s_links": %s}' % (collection,
+                                                  jsonutils.dumps(links))
+                    return
+                body = jsonutils.dumps(resource)
+                yield ', ' + body if i else body
+                last = resource
+        except Exception as e:
+            # NOTE: response status has been sent when streaming,
+            # the client gets a broken json body
+            LOG.error(_LE('Fail to list %(collection)s: %(exception)s'),
+                      {'collection': collection, 'exception': e})
+            raise
+        finally:
+            stream_ctx.session.close()
+        yield ']}'
+
+    return Response(app_iter=_stream(), content_type='application/json')
+
+
 class PodsController(rest.RestController):
 
     def __init__(self):
@@ -86,7 +213,7 @@ class PodsController(rest.RestController):
             pod_az_name = ''
 
         try:
-            with context.session.begin():
+            with context.session.begin(subtransactions=True):
                 # if not top region,
                 # then add corresponding ag and az for the pod
                 if az_name != '':
@@ -130,20 +257,21 @@ class PodsController(rest.RestController):
             return
 
     @expose(generic=True, template='json')
-    def get_all(self):
+    def get_all(self, **kw):
+        """List pods.
+
+        Pods are sorted by "sort_key", one of pod_id and pod_name, in
+        "sort_dir" order. At most "limit" pods after the pod whose id is
+        "marker" are returned.
+        """
         context = t_context.extract_context_from_environ()
 
         if not t_context.is_admin_context(context):
             pecan.abort(400, _('Admin role required to list pods'))
             return
 
-        try:
-            return {'pods': db_api.list_pods(context)}
-        except Exception as e:
-            LOG.error(_LE('Fail to list pod: %(exception)s'),
-                      {'exception': e})
-            pecan.abort(500, _('Fail to list pod'))
-            return
+        return _list_resources(context, 'pods', models.Pod,
+                               ('pod_id', 'pod_name'), kw)
 
     @expose(generic=True, template='json')
     def delete(self, _id):
@@ -154,7 +282,7 @@ class PodsController(rest.RestController):
             return
 
         try:
-            with context.session.begin():
+            with context.session.begin(subtransactions=True):
                 pod = core.get_resource(context, models.Pod, _id)
                 if pod is not None:
                     ag_name = utils.get_ag_name(pod['pod_name'])
@@ -173,12 +301,14 @@ class PodsController(rest.RestController):
     def _get_top_region(self, ctx):
         top_region_name = ''
         try:
-            with ctx.session.begin():
-                pods = core.query_resource(ctx,
-                                           models.Pod, [], [])
-                for pod in pods:
-                    if pod['az_name'] == '' and pod['pod_name'] != '':
-                        return pod['pod_name']
+            with ctx.session.begin(subtransactions=True):
+                pods = core.query_resource(
+                    ctx, models.Pod,
+                    [{'key': 'az_name', 'comparator': 'eq', 'value': ''},
+                     {'key': 'pod_name', 'comparator': 'ne', 'value': ''}],
+                    [], limit=1)
+                if pods:
+                    return pods[0]['pod_name']
         except Exception:
             return top_region_name
 
@@ -198,6 +328,9 @@ class BindingsController(rest.RestController):
             pecan.abort(400, _('Admin role required to create bindings'))
             return
 
+        if 'pod_bindings' in kw:
+            return self._post_bulk(context, kw['pod_bindings'])
+
         if 'pod_binding' not in kw:
             pecan.abort(400, _('Request body not found'))
             return
@@ -214,7 +347,7 @@ class BindingsController(rest.RestController):
 
         # the az_pod_map_id should be exist for in the pod map table
         try:
-            with context.session.begin():
+            with context.session.begin(subtransactions=True):
                 pod = core.get_resource(context, models.Pod,
                                         pod_id)
                 if pod.get('az_name') == '':
@@ -228,7 +361,7 @@ class BindingsController(rest.RestController):
             return
 
         try:
-            with context.session.begin():
+            with context.session.begin(subtransactions=True):
                 pod_binding = core.create_resource(context, models.PodBinding,
                                                    {'id': _uuid,
                                                     'tenant_id': tenant_id,
@@ -247,6 +380,67 @@ class BindingsController(rest.RestController):
 
         return {'pod_binding': pod_binding}
 
+    def _post_bulk(self, context, pod_bs):
+        """Create many tenant pod bindings in one request.
+
+        Each binding in the response is either {"pod_binding": binding} or
+        the requested tenant_id and pod_id with an "error" giving the code
+        and message of the failure, failed bindings don't stop the others.
+        """
+        if not isinstance(pod_bs, list):
+            pecan.abort(400, _('pod_bindings should be a list'))
+            return
+
+        results = [None] * len(pod_bs)
+        bindings = []
+        indexes = []
+        for i, pod_b in enumerate(pod_bs):
+            if not isinstance(pod_b, dict):
+                pod_b = {}
+            tenant_id = pod_b.get('tenant_id') or ''
+            pod_id = pod_b.get('pod_id') or ''
+            if not isinstance(tenant_id, six.string_types) or (
+                    not isinstance(pod_id, six.string_types)):
+                results[i] = {'tenant_id': tenant_id, 'pod_id': pod_id,
+                              'error': {'code': 422,
+                                        'message': _('Tenant_id and pod_id '
+                                                     'should be strings')}}
+                continue
+            tenant_id = tenant_id.strip()
+            pod_id = pod_id.strip()
+            if tenant_id == '' or pod_id == '':
+                results[i] = {'tenant_id': tenant_id, 'pod_id': pod_id,
+                              'error': {'code': 422,
+                                        'message': _('Tenant_id and pod_id '
+                                                     'can not be empty')}}
+                continue
+            bindings.append({'tenant_id': tenant_id, 'pod_id': pod_id})
+            indexes.append(i)
+
+        try:
+            created = db_api.create_pod_bindings(context, bindings)
+        except db_exc.DBDuplicateEntry:
+            # NOTE: the same binding is created concurrently, the
+            # whole batch is rolled back and can be retried
+            return Response(_('Pod binding already exists'), 409)
+        except Exception as e:
+            LOG.error(_LE('Fail to create pod bindings: %(exception)s'),
+                      {'exception': e})
+            pecan.abort(500, _('Fail to create pod bindings'))
+            return
+
+        for i, binding, result in zip(indexes, bindings, created):
+            if isinstance(result, t_exc.PodBindingExists):
+                code = 409
+            elif isinstance(result, Exception):
+                code = 422
+            else:
+                results[i] = {'pod_binding': result}
+                continue
+            error = {'code': code, 'message': six.text_type(result)}
+            results[i] = dict(binding, error=error)
+        return {'pod_bindings': results}
+
     @expose(generic=True, template='json')
     def get_one(self, _id):
         context = t_context.extract_context_from_environ()
@@ -256,7 +450,7 @@ class BindingsController(rest.RestController):
             return
 
         try:
-            with context.session.begin():
+            with context.session.begin(subtransactions=True):
                 pod_binding = core.get_resource(context,
                                                 models.PodBinding,
                                                 _id)
@@ -266,23 +460,21 @@ class BindingsController(rest.RestController):
             return
 
     @expose(generic=True, template='json')
-    def get_all(self):
+    def get_all(self, **kw):
+        """List tenant pod bindings.
+
+        Bindings are sorted by "sort_key", one of id and tenant_id, in
+        "sort_dir" order. At most "limit" bindings after the binding whose
+        id is "marker" are returned.
+        """
         context = t_context.extract_context_from_environ()
 
         if not t_context.is_admin_context(context):
             pecan.abort(400, _('Admin role required to list bindings'))
             return
 
-        try:
-            with context.session.begin():
-                pod_bindings = core.query_resource(context,
-                                                   models.PodBinding,
-                                                   [], [])
-        except Exception:
-            pecan.abort(500, _('Fail to list tenant pod bindings'))
-            return
-
-        return {'pod_bindings': pod_bindings}
+        return _list_resources(context, 'pod_bindings', models.PodBinding,
+                               ('id', 'tenant_id'), kw)
 
     @expose(generic=True, template='json')
     def delete(self, _id):
@@ -293,7 +485,7 @@ class BindingsController(rest.RestController):
             return
 
         try:
-            with context.session.begin():
+            with context.session.begin(subtransactions=True):
                 core.delete_resource(context, models.PodBinding, _id)
                 pecan.response.status = 200
         except t_exc.ResourceNotFound:
@@ -0,0 +1,99 @@
+# Copyright (c) 2015 Huawei Tech. Co., Ltd.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import pecan
+from pecan import expose
+from pecan import Response
+from pecan import rest
+import six
+
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+from oslo_utils import strutils
+
+import tricircle.common.context as t_context
+from tricircle.common.i18n import _
+from tricircle.common.i18n import _LE
+from tricircle.common import quota
+from tricircle.common import restapp
+
+LOG = logging.getLogger(__name__)
+
+
+def _stream_quotas(ctx, project_quotas):
+    """Serialize quotas of projects one project at a time."""
+    yield '{"quotas": ['
+    try:
+        for i, (project_id, quota_set) in enumerate(project_quotas):
+            body = jsonutils.dumps({'project_id': project_id,
+                                    'quota_set': quota_set})
+            yield ', ' + body if i else body
+    except Exception as e:
+        # NOTE: response status has been sent when streaming, the
+        # client gets a broken json body
+        LOG.error(_LE('Fail to list quotas: %(exception)s'),
+                  {'exception': e})
+        raise
+    finally:
+        ctx.session.close()
+    yield ']}'
+
+
+class QuotasController(rest.RestController):
+
+    def __init__(self):
+        pass
+
+    @expose(generic=True, template='json')
+    def get_all(self, **kw):
+        """List limits and usages of many projects.
+
+        Quotas of the projects given by "project_id" query parameters, or
+        of all the projects having limits or usages, are streamed in the
+        response body sorted by project id.
+        """
+        context = t_context.extract_context_from_environ()
+
+        if not t_context.is_admin_context(context):
+            pecan.abort(400, _('Admin role required to list quotas'))
+            return
+
+        project_id = kw.get('project_id')
+        if isinstance(project_id, six.string_types):
+            project_id = [project_id]
+        try:
+            usage = strutils.bool_from_string(kw.get('usage', 'true'),
+                                              strict=True)
+        except ValueError:
+            pecan.abort(400, _('Invalid value for usage'))
+            return
+
+        # NOTE: quotas are streamed after the request transaction
+        # is finished, so they are read with a separate session. quotas of
+        # the first project are read here, so failing to read them still
+        # returns an error status
+        stream_ctx = t_context.get_stream_context(context)
+        try:
+            project_quotas = restapp.prefetch(
+                quota.QUOTAS.get_all_project_quotas(
+                    stream_ctx, project_ids=project_id, usages=usage))
+        except Exception as e:
+            stream_ctx.session.close()
+            LOG.error(_LE('Fail to list quotas: %(exception)s'),
+                      {'exception': e})
+            pecan.abort(500, _('Fail to list quotas'))
+            return
+        return Response(app_iter=_stream_quotas(stream_ctx, project_quotas),
+                        content_type='application/json')
@@ -13,6 +13,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import functools
+
 import pecan
 from pecan import expose
 from pecan import request
@@ -29,6 +31,9 @@ import tricircle.common.context as t_context
 from tricircle.common import httpclient as hclient
 from tricircle.common.i18n import _
 from tricircle.common.i18n import _LE
+from tricircle.common import id_index
+from tricircle.common import id_rewriter
+from tricircle.common import list_cache
 
 import tricircle.db.api as db_api
 from tricircle.db import core
@@ -131,6 +136,9 @@ class VolumeController(rest.RestController):
                              'pod_id': pod['pod_id'],
                              'project_id': self.tenant_id,
                              'resource_type': cons.RT_VOLUME})
+                    id_index.add(cons.RT_VOLUME, b_vol_ret['id'],
+                                 b_vol_ret['id'])
+                    list_cache.invalidate(self.tenant_id)
                 except Exception as e:
                     LOG.error(_LE('Fail to create volume: %(exception)s'),
                               {'exception': e})
@@ -197,6 +205,9 @@ class VolumeController(rest.RestController):
                         'comparator': 'eq',
                         'value': cons.RT_VOLUME}]
             with context.session.begin():
+                for _pod, bottom_id in db_api.get_bottom_mappings_by_top_id(
+                        context, _id, cons.RT_VOLUME):
+                    id_index.discard(cons.RT_VOLUME, bottom_id)
                 core.delete_resources(context,
                                       models.ResourceRouting,
                                       filters)
@@ -211,6 +222,34 @@ class VolumeController(rest.RestController):
         context = t_context.extract_context_from_environ()
         return {'volumes': self._get_all(context)}
 
+    def _list_pod_volumes(self, context, pod):
+        s_ctx = hclient.get_pod_service_ctx(
+            context,
+            request.url,
+            pod['pod_name'],
+            s_type=cons.ST_CINDER)
+        if s_ctx['b_url'] == '':
+            LOG.error(_LE("bottom pod endpoint incorrect %s")
+                      % pod['pod_name'])
+            return None
+
+        # TODO(joehuang): convert header and body content
+        resp = hclient.forward_req(context, 'GET',
+                                   request.headers,
+                                   s_ctx['b_url'],
+                                   request.body)
+
+        if resp.status_code != 200:
+            return None
+
+        b_ret_body = jsonutils.loads(resp.content)
+        # volumes not created via tricircle are not returned
+        volumes = id_rewriter.VOLUME_REWRITER.rewrite(
+            context, b_ret_body.get('volumes') or [])
+        for vol in volumes:
+            vol['availability_zone'] = pod['az_name']
+        return volumes
+
     def _get_all(self, context):
 
         # TODO(joehuang): query optimization for pagination, sort, etc
@@ -220,40 +259,13 @@ class VolumeController(rest.RestController):
             if pod['pod_name'] == '':
                 continue
 
-            s_ctx = hclient.get_pod_service_ctx(
-                context,
-                request.url,
-                pod['pod_name'],
-                s_type=cons.ST_CINDER)
-            if s_ctx['b_url'] == '':
-                LOG.error(_LE("bottom pod endpoint incorrect %s")
-                          % pod['pod_name'])
-                continue
-
-            # TODO(joehuang): convert header and body content
-            resp = hclient.forward_req(context, 'GET',
-                                       request.headers,
-                                       s_ctx['b_url'],
-                                       request.body)
-
-            if resp.status_code == 200:
-
-                routings = db_api.get_bottom_mappings_by_tenant_pod(
-                    context, self.tenant_id,
-                    pod['pod_id'], cons.RT_VOLUME
-                )
-
-                b_ret_body = jsonutils.loads(resp.content)
-                if b_ret_body.get('volumes'):
-                    for vol in b_ret_body['volumes']:
-
-                        if not routings.get(vol['id']):
-                            b_ret_body['volumes'].remove(vol)
-                            continue
-
-                        vol['availability_zone'] = pod['az_name']
-
-                    ret.extend(b_ret_body['volumes'])
+            # summary and detail lists are cached separately
+            volumes = list_cache.get(
+                context, self.tenant_id, pod['pod_id'], cons.RT_VOLUME,
+                functools.partial(self._list_pod_volumes, context, pod),
+                query=request.path_qs)
+            if volumes:
+                ret.extend(volumes)
         return ret
 
     @expose(generic=True, template='json')
@@ -281,6 +293,8 @@ class VolumeController(rest.RestController):
                                    request.body)
 
         response.status = resp.status_code
+        if 200 <= resp.status_code < 300:
+            list_cache.invalidate(self.tenant_id)
 
         # don't remove the resource routing for delete is async. operation
         # remove the routing when query is executed but not find
@@ -129,7 +129,7 @@ def get_pod_by_az_tenant(context, az_name, tenant_id):
     for pod in pods:
         if pod['pod_name'] != '':
             try:
-                with context.session.begin():
+                with context.session.begin(subtransactions=True):
                     core.create_resource(
                         context, models.PodBinding,
                         {'id': uuidutils.generate_uuid(),
@@ -14,6 +14,7 @@
 #    under the License.
 
 import collections
+import copy
 import functools
 import inspect
 import six
@@ -25,10 +26,12 @@ from keystoneclient import session
 from keystoneclient.v3 import client as keystone_client
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_serialization import jsonutils
 
 import tricircle.common.context as tricircle_context
 from tricircle.common import exceptions
 from tricircle.common import resource_handle
+from tricircle.common import singleflight
 from tricircle.db import api
 from tricircle.db import models
 
@@ -62,7 +65,12 @@ client_opts = [
     cfg.StrOpt('admin_tenant_domain_name',
                default='Default',
                help='tenant domain name of admin account, needed when'
-                    ' auto_refresh_endpoint set to True')
+                    ' auto_refresh_endpoint set to True'),
+    cfg.BoolOpt('share_concurrent_reads',
+                default=True,
+                help='if set to True, identical get and list requests that'
+                     ' API gateways send to the same pod at the same time'
+                     ' with the same project and user share one request')
 ]
 client_opt_group = cfg.OptGroup('client')
 cfg.CONF.register_group(client_opt_group)
@@ -70,6 +78,10 @@ cfg.CONF.register_opts(client_opts, group=client_opt_group)
 
 LOG = logging.getLogger(__name__)
 
+# NOTE: every caller gets its own copy of the shared result since
+# callers like id rewriters modify the returned resources in place
+_read_flights = singleflight.Group(copy_func=copy.deepcopy)
+
 
 def _safe_operation(operation_name):
     def handle_func(func):
@@ -280,6 +292,16 @@ class Client(object):
         """
         self._update_endpoint_from_keystone(cxt, False)
 
+    def _share_read(self, cxt, shared, operation, resource, target, func,
+                    *args):
+        if not shared or not cfg.CONF.client.share_concurrent_reads:
+            return func(*args)
+        # requests of different projects or users may see different
+        # resources, so they are not shared
+        key = (self.pod_name, operation, resource, target,
+               cxt.tenant, cxt.user, cxt.is_admin)
+        return _read_flights.do(key, func, *args)
+
     @_safe_operation('client')
     def get_native_client(self, resource, cxt):
         """Get native python client instance
@@ -299,7 +321,7 @@ class Client(object):
         return handle._get_client(cxt)
 
     @_safe_operation('list')
-    def list_resources(self, resource, cxt, filters=None):
+    def list_resources(self, resource, cxt, filters=None, shared=False):
         """Query resource in pod of top layer
 
         Directly invoke this method to query resources, or use
@@ -313,6 +335,9 @@ class Client(object):
         :param filters: list of dict with key 'key', 'comparator', 'value'
         like {'key': 'name', 'comparator': 'eq', 'value': 'private'}, 'key'
         is the field name of resources
+        :param shared: whether to share the request with identical ones
+        sent at the same time, only for reads not following a write of
+        the caller
         :return: list of dict containing resources information
         :raises: EndpointNotAvailable
         """
@@ -323,7 +348,10 @@ class Client(object):
         service = self.resource_service_map[resource]
         handle = self.service_handle_map[service]
         filters = filters or []
-        return handle.handle_list(cxt, resource, filters)
+        return self._share_read(
+            cxt, shared, 'list', resource,
+            jsonutils.dumps(filters, sort_keys=True),
+            handle.handle_list, cxt, resource, filters)
 
     @_safe_operation('create')
     def create_resources(self, resource, cxt, *args, **kwargs):
@@ -409,7 +437,7 @@ class Client(object):
         handle.handle_delete(cxt, resource, resource_id)
 
     @_safe_operation('get')
-    def get_resources(self, resource, cxt, resource_id):
+    def get_resources(self, resource, cxt, resource_id, shared=False):
         """Get resource in pod of top layer
 
         Directly invoke this method to get resources, or use
@@ -419,6 +447,9 @@ class Client(object):
         :param resource: resource type
         :param cxt: context object
         :param resource_id: id of resource
+        :param shared: whether to share the request with identical ones
+        sent at the same time, only for reads not following a write of
+        the caller
         :return: a dict containing resource information
         :raises: EndpointNotAvailable
         """
@@ -428,7 +459,8 @@ class Client(object):
 
         service = self.resource_service_map[resource]
         handle = self.service_handle_map[service]
-        return handle.handle_get(cxt, resource, resource_id)
+        return self._share_read(cxt, shared, 'get', resource, resource_id,
+                                handle.handle_get, cxt, resource, resource_id)
 
     @_safe_operation('action')
     def action_resources(self, resource, cxt, action, *args, **kwargs):
@@ -0,0 +1,83 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import eventlet
+
+from oslo_log import log as logging
+
+from tricircle.common.i18n import _LE
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Coalescer(object):
+    """Merge requests for the same key arriving within a time window
+
+    The first request for a key schedules the handler to run after "window"
+    seconds, requests for the same key arriving before that are merged into
+    the pending one and only the arguments of the latest request are passed
+    to the handler. If the handler for a key is still running when the next
+    window expires, the pending request waits for another window, so one key
+    is never handled concurrently. A non-positive window disables merging
+    and the handler is called directly, exceptions are then raised to the
+    caller instead of being logged.
+    """
+
+    def __init__(self, handler, window):
+        self.handler = handler
+        self.window = window
+        self.pending = {}
+        self.running = set()
+        self.submitted_count = 0
+        self.merged_count = 0
+        self.handled_count = 0
+
+    def submit(self, key, *args, **kwargs):
+        self.submitted_count += 1
+        if self.window <= 0:
+            self.handled_count += 1
+            return self.handler(*args, **kwargs)
+        if key in self.pending:
+            self.merged_count += 1
+            self.pending[key] = (args, kwargs)
+            return
+        self.pending[key] = (args, kwargs)
+        eventlet.spawn_after(self.window, self._run, key)
+
+    def _run(self, key):
+        if key in self.running:
+            eventlet.spawn_after(self.window, self._run, key)
+            return
+        args, kwargs = self.pending.pop(key)
+        self.running.add(key)
+        try:
+            self._handle(key, args, kwargs)
+        finally:
+            self.running.discard(key)
+
+    def _handle(self, key, args, kwargs):
+        try:
+            self.handler(*args, **kwargs)
+        except Exception:
+            LOG.exception(_LE('Failed to handle coalesced request %s'), key)
+        self.handled_count += 1
+
+    def get_stats(self):
+        return {'queue_depth': len(self.pending),
+                'running': len(self.running),
+                'submitted': self.submitted_count,
+                'merged': self.merged_count,
+                'handled': self.handled_count}
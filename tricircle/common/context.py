@@ -21,6 +21,9 @@ import oslo_context.context as oslo_ctx
 
 from tricircle.db import core
 
+# environ key of the DB session shared by the contexts of one request
+DB_SESSION_ENV = 'tricircle.db_session'
+
 
 def get_db_context():
     return Context()
@@ -54,7 +57,23 @@ def extract_context_from_environ():
     role = environ.get('HTTP_X_ROLE')
 
     context_paras['is_admin'] = role == 'admin'
-    return Context(**context_paras)
+    ctx = Context(**context_paras)
+    # join the transaction opened for this request, if any
+    ctx._session = environ.get(DB_SESSION_ENV)
+    return ctx
+
+
+def get_stream_context(ctx):
+    """Get a copy of the context with its own DB session
+
+    Bodies of streamed responses are generated after TransactionHook has
+    finished the transaction of the request and closed its session, so
+    generators read resources with this context, outside the request
+    transaction.
+    """
+    stream_ctx = copy.copy(ctx)
+    stream_ctx._session = None
+    return stream_ctx
 
 
 def get_context_from_neutron_context(context):
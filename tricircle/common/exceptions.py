@@ -65,6 +65,10 @@ class Conflict(TricircleException):
     pass
 
 
+class PodBindingExists(Conflict):
+    message = _("Tenant %(tenant_id)s is already bound to pod %(pod_id)s")
+
+
 class NotAuthorized(TricircleException):
     message = _("Not authorized.")
 
@@ -180,6 +184,20 @@ class PodNotFound(NotFound):
         super(PodNotFound, self).__init__(pod_name=pod_name)
 
 
+class RoutingCreateFail(TricircleException):
+    message = _("Fail to create %(resource_type)s routing entry")
+
+    def __init__(self, resource_type):
+        super(RoutingCreateFail, self).__init__(resource_type=resource_type)
+
+
+class RoutingBindFail(TricircleException):
+    message = _("Fail to bind top and bottom %(resource_type)s")
+
+    def __init__(self, resource_type):
+        super(RoutingBindFail, self).__init__(resource_type=resource_type)
+
+
 class ChildQuotaNotZero(TricircleException):
     message = _("Child projects having non-zero quota")
 
@@ -0,0 +1,48 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import hashlib
+
+import six
+
+
+class HashRing(object):
+    """Consistent hash ring mapping keys to nodes
+
+    Each node is placed on the ring "replicas" times so keys are evenly
+    distributed, and adding or removing one node only moves the keys owned
+    by that node.
+    """
+
+    def __init__(self, nodes, replicas=64):
+        self.nodes = sorted(set(nodes))
+        self.ring = {}
+        for node in self.nodes:
+            for i in xrange(replicas):
+                self.ring[self._hash('%s-%d' % (node, i))] = node
+        self.sorted_hashes = sorted(self.ring.keys())
+
+    @staticmethod
+    def _hash(key):
+        if isinstance(key, six.text_type):
+            key = key.encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def get_node(self, key):
+        if not self.sorted_hashes:
+            return None
+        index = bisect.bisect(self.sorted_hashes, self._hash(key))
+        return self.ring[self.sorted_hashes[index % len(self.sorted_hashes)]]
@@ -0,0 +1,129 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+
+from oslo_config import cfg
+
+from tricircle.common.i18n import _
+from tricircle.db import models
+
+
+id_index_opts = [
+    cfg.IntOpt('bottom_top_index_size',
+               default=10000,
+               help=_('Max number of bottom id to top id mappings cached in'
+                      ' each process to rewrite ids in responses from'
+                      ' bottom pods, least recently used mappings are'
+                      ' evicted first. Set to 0 to disable the cache')),
+]
+CONF = cfg.CONF
+CONF.register_opts(id_index_opts)
+
+# NOTE: key is (resource_type, bottom_id), value is top_id. a
+# routing entry never changes its bottom id once bound, so cached mappings
+# only need to be removed when the entry is deleted
+_index = collections.OrderedDict()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+_QUERY_BATCH_SIZE = 500
+
+
+def add(resource_type, bottom_id, top_id):
+    """Record the mapping of a bound routing entry"""
+    size = CONF.bottom_top_index_size
+    if size <= 0 or not bottom_id:
+        return
+    key = (resource_type, bottom_id)
+    _index.pop(key, None)
+    _index[key] = top_id
+    while len(_index) > size:
+        _index.popitem(last=False)
+        _stats['evictions'] += 1
+
+
+def add_routing(routing):
+    add(routing['resource_type'], routing['bottom_id'], routing['top_id'])
+
+
+def discard(resource_type, bottom_id):
+    _index.pop((resource_type, bottom_id), None)
+
+
+def clear():
+    _index.clear()
+    for key in _stats:
+        _stats[key] = 0
+
+
+def get_stats():
+    return dict(_stats, size=len(_index))
+
+
+def lookup(t_ctx, keys):
+    """Map bottom ids of any resource types to top ids
+
+    Mappings not cached are read from the routing table with one query per
+    batch of ids, whatever types they are, and cached.
+
+    :param t_ctx: tricircle context
+    :param keys: iterable of (resource_type, bottom_id)
+    :return: a dict mapping (resource_type, bottom_id) to top id, keys not
+             bound to any top resource are not included
+    """
+    result = {}
+    missing = {}
+    for key in set(keys):
+        if not key[1]:
+            continue
+        top_id = _index.pop(key, None)
+        if top_id is None:
+            missing.setdefault(key[1], set()).add(key[0])
+            continue
+        # move to the most recently used end
+        _index[key] = top_id
+        result[key] = top_id
+    _stats['hits'] += len(result)
+    _stats['misses'] += sum(len(types) for types in missing.itervalues())
+
+    routing = models.ResourceRouting
+    bottom_ids = sorted(missing)
+    for start in xrange(0, len(bottom_ids), _QUERY_BATCH_SIZE):
+        with t_ctx.session.begin(subtransactions=True):
+            rows = t_ctx.session.query(routing.resource_type,
+                                       routing.bottom_id, routing.top_id).\
+                filter(routing.bottom_id.in_(
+                    bottom_ids[start:start + _QUERY_BATCH_SIZE])).all()
+        for resource_type, bottom_id, top_id in rows:
+            if resource_type not in missing[bottom_id]:
+                continue
+            result[(resource_type, bottom_id)] = top_id
+            add(resource_type, bottom_id, top_id)
+    return result
+
+
+def get_top_ids(t_ctx, resource_type, bottom_ids):
+    """Map bottom ids of one resource type to top ids
+
+    :param t_ctx: tricircle context
+    :param resource_type: type of the resources
+    :param bottom_ids: iterable of bottom ids
+    :return: a dict mapping bottom id to top id, bottom ids not bound to
+             any top resource are not included
+    """
+    mapping = lookup(t_ctx, [(resource_type, bottom_id)
+                             for bottom_id in bottom_ids])
+    return dict((bottom_id, top_id)
+                for (_type, bottom_id), top_id in mapping.iteritems())
@@ -0,0 +1,129 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import six
+
+from tricircle.common import constants
+from tricircle.common import id_index
+
+
+class _Field(object):
+    __slots__ = ('resource_type', 'is_list', 'children')
+
+    def __init__(self, is_list):
+        self.resource_type = None
+        self.is_list = is_list
+        self.children = {}
+
+
+def _compile(rules):
+    tree = {}
+    for path, resource_type in rules.iteritems():
+        node = tree
+        steps = path.split('.')
+        for i, step in enumerate(steps):
+            is_list = step.endswith('[]')
+            key = step[:-2] if is_list else step
+            field = node.get(key)
+            if not field:
+                field = node[key] = _Field(is_list)
+            if i == len(steps) - 1:
+                field.resource_type = resource_type
+            node = field.children
+    return tree
+
+
+def _collect(tree, obj, refs):
+    for key, field in tree.iteritems():
+        value = obj.get(key)
+        if value is None:
+            continue
+        if field.is_list:
+            if not isinstance(value, list):
+                continue
+            for i, item in enumerate(value):
+                if field.resource_type:
+                    if isinstance(item, six.string_types):
+                        refs.append((value, i, field.resource_type, item))
+                elif isinstance(item, dict):
+                    _collect(field.children, item, refs)
+        elif field.resource_type:
+            if isinstance(value, six.string_types):
+                refs.append((obj, key, field.resource_type, value))
+        elif isinstance(value, dict):
+            _collect(field.children, value, refs)
+
+
+class Rewriter(object):
+    """Rewrite bottom ids in resources returned by bottom pods to top ids
+
+    Rules map a path in the resource to the resource type of the id found
+    there. Steps of the path are separated by ".", a step ending with "[]"
+    is a list whose items are walked, like "fixed_ips[].subnet_id". Rules
+    are compiled into a tree when the rewriter is created, so a resource is
+    walked once to collect all the ids, then the ids of all the resources
+    are mapped with one batched lookup in id_index and replaced in place.
+    Ids not bound to any top resource are kept.
+    """
+
+    def __init__(self, rules, required=()):
+        """Create a rewriter
+
+        :param rules: dict mapping path to resource type
+        :param required: top level keys whose ids must be mapped, resources
+                         with unmapped ids in these keys are dropped
+        """
+        self.rules = dict(rules)
+        self.required = tuple(required)
+        self._tree = _compile(self.rules)
+
+    def rewrite(self, t_ctx, resources, drop_unmapped=True):
+        """Rewrite ids of resources in place
+
+        :param t_ctx: tricircle context
+        :param resources: list of resource dicts
+        :param drop_unmapped: whether to drop resources with unmapped ids
+                              in required keys
+        :return: list of rewritten resources
+        """
+        refs = []
+        for resource in resources:
+            _collect(self._tree, resource, refs)
+        mapping = id_index.lookup(t_ctx, [ref[2:] for ref in refs])
+
+        if drop_unmapped and self.required:
+            required = [(key, self.rules[key]) for key in self.required]
+            resources = [
+                resource for resource in resources
+                if all((resource_type, resource.get(key)) in mapping
+                       for key, resource_type in required)]
+        for container, key, resource_type, bottom_id in refs:
+            top_id = mapping.get((resource_type, bottom_id))
+            if top_id is not None:
+                container[key] = top_id
+        return resources
+
+
+PORT_REWRITER = Rewriter({'id': constants.RT_PORT,
+                          'network_id': constants.RT_NETWORK,
+                          'fixed_ips[].subnet_id': constants.RT_SUBNET,
+                          'device_id': constants.RT_ROUTER},
+                         required=('id',))
+SERVER_REWRITER = Rewriter(
+    {'id': constants.RT_SERVER,
+     'os-extended-volumes:volumes_attached[].id': constants.RT_VOLUME})
+VOLUME_REWRITER = Rewriter({'id': constants.RT_VOLUME,
+                            'attachments[].server_id': constants.RT_SERVER},
+                           required=('id',))
@@ -0,0 +1,122 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+from oslo_config import cfg
+
+from tricircle.common.i18n import _
+from tricircle.common import singleflight
+
+
+list_cache_opts = [
+    cfg.IntOpt('list_cache_ttl',
+               default=0,
+               help=_('Seconds to cache resources listed from a bottom pod '
+                      'for a tenant, so resource lists polled frequently do '
+                      'not hit every bottom pod each time. The cache is '
+                      'kept in each API process and only invalidated by '
+                      'changes made through the same process, so with '
+                      'several API workers or hosts a list may miss '
+                      'changes made elsewhere until the cache expires. '
+                      'Set to 0 to disable the cache')),
+]
+CONF = cfg.CONF
+CONF.register_opts(list_cache_opts)
+
+# key is (tenant_id, pod_id, resource_type, query, caller scope), value
+# is (expire time, resources). cached resources are shared by all the
+# requests, callers should not modify them
+_cache = {}
+# concurrent requests for the same key wait for the green thread listing
+# the resources instead of listing them again
+_flights = singleflight.Group()
+# tenant id -> number of invalidations, results listed before an
+# invalidation are not cached
+_generations = {}
+_stats = {'hits': 0, 'misses': 0}
+
+
+def _purge_expired(now):
+    for key in [key for key, (expire, _res) in _cache.iteritems()
+                if expire < now]:
+        del _cache[key]
+
+
+def get(context, tenant_id, pod_id, resource_type, list_func, query=None):
+    """Get resources listed from a bottom pod, from cache if not expired
+
+    Resources are cached per caller, the project, user and admin flag of
+    the context are part of the cache key, so a caller only gets resources
+    listed with its own credentials.
+
+    :param context: context of the caller
+    :param tenant_id: id of the tenant listing the resources
+    :param pod_id: id of the bottom pod
+    :param resource_type: type of the resources
+    :param list_func: function called without arguments to list the
+                      resources when they are not cached, returns an
+                      iterable of resources, or None if the resources
+                      fail to be listed
+    :param query: path and query string of the list request
+    :return: iterable of resources, a list if the cache is enabled
+    """
+    ttl = CONF.list_cache_ttl
+    if ttl <= 0:
+        return list_func()
+
+    key = (tenant_id, pod_id, resource_type, query,
+           context.tenant, context.user, context.is_admin)
+    cached = _cache.get(key)
+    if cached and cached[0] >= time.time():
+        _stats['hits'] += 1
+        return cached[1]
+    generation = _generations.get(tenant_id, 0)
+
+    def _list():
+        _stats['misses'] += 1
+        resources = list_func()
+        if resources is None:
+            return None
+        resources = list(resources)
+        if generation == _generations.get(tenant_id, 0):
+            now = time.time()
+            _purge_expired(now)
+            _cache[key] = (now + ttl, resources)
+        return resources
+
+    return _flights.do(key, _list)
+
+
+def invalidate(tenant_id):
+    """Drop cached resources of a tenant after resources are changed"""
+    _generations[tenant_id] = _generations.get(tenant_id, 0) + 1
+    for key in [key for key in _cache if key[0] == tenant_id]:
+        del _cache[key]
+
+
+def clear():
+    _cache.clear()
+    _generations.clear()
+    for key in _stats:
+        _stats[key] = 0
+    _flights.reset_stats()
+
+
+def get_stats():
+    flight_stats = _flights.get_stats()
+    return dict(_stats, size=len(_cache),
+                inflight=flight_stats['inflight'],
+                coalesced=flight_stats['shared'])
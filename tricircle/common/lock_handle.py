@@ -15,17 +15,72 @@
 
 import datetime
 import eventlet
+from eventlet import event
+import random
 
+from oslo_config import cfg
 import oslo_db.exception as db_exc
 
+from tricircle.common import exceptions
+from tricircle.common.i18n import _
+from tricircle.common import id_index
 from tricircle.db import core
 from tricircle.db import models
 
 
+lock_opts = [
+    cfg.IntOpt('route_expire_threshold',
+               default=30,
+               help=_('Seconds after which a routing entry whose bottom '
+                      'resource is still not created is considered expired '
+                      'and can be removed by other workers')),
+    cfg.IntOpt('route_max_tries',
+               default=10,
+               help=_('Max number of tries to get or create a routing entry '
+                      'when other worker is creating the same entry')),
+    cfg.FloatOpt('route_retry_interval',
+                 default=0.1,
+                 help=_('Seconds to wait before the first retry, the '
+                        'interval is doubled for each following retry and '
+                        'randomized to avoid retrying at the same time')),
+    cfg.FloatOpt('route_retry_interval_max',
+                 default=2.0,
+                 help=_('Max seconds to wait between two retries')),
+]
+CONF = cfg.CONF
+CONF.register_opts(lock_opts)
+
+# NOTE: key is (top_id, pod_id), event is sent when the worker in
+# this process creating the bottom resource finishes, so other green threads
+# waiting for the same routing entry are waked up without polling database
+_route_events = {}
+
+
+def _get_retry_interval(try_num):
+    interval = min(CONF.route_retry_interval * (2 ** try_num),
+                   CONF.route_retry_interval_max)
+    return interval / 2 + random.uniform(0, interval / 2)
+
+
+def _wait_for_route(key, try_num):
+    interval = _get_retry_interval(try_num)
+    route_event = _route_events.get(key)
+    if route_event:
+        with eventlet.Timeout(interval, False):
+            route_event.wait()
+    else:
+        eventlet.sleep(interval)
+
+
+def _notify_route_done(key):
+    route_event = _route_events.pop(key, None)
+    if route_event:
+        route_event.send()
+
+
 def get_or_create_route(t_ctx, q_ctx,
                         project_id, pod, _id, _type, list_ele_method):
-    # use configuration option later
-    route_expire_threshold = 30
+    route_expire_threshold = CONF.route_expire_threshold
 
     with t_ctx.session.begin():
         routes = core.query_resource(
@@ -41,7 +96,7 @@ def get_or_create_route(t_ctx, q_ctx,
                 route_time = route['updated_at'] or route['created_at']
                 current_time = datetime.datetime.utcnow()
                 delta = current_time - route_time
-                if delta.seconds > route_expire_threshold:
+                if delta.total_seconds() > route_expire_threshold:
                     # NOTE(zhiyuan) cannot directly remove the route, we have
                     # a race here that other worker is updating this route, we
                     # need to check if the corresponding element has been
@@ -52,6 +107,7 @@ def get_or_create_route(t_ctx, q_ctx,
                         core.update_resource(t_ctx,
                                              models.ResourceRouting,
                                              route['id'], route)
+                        id_index.add_routing(route)
                         return route, False
                     try:
                         core.delete_resource(t_ctx,
@@ -78,47 +134,195 @@ def get_or_create_route(t_ctx, q_ctx,
         t_ctx.session.close()
 
 
+def get_or_create_routes(t_ctx, q_ctx, project_id, eles, list_ele_method):
+    """Batch version of get_or_create_route
+
+    Existing routing entries are read in one query and the missing ones are
+    inserted in one multi-row insert.
+
+    :param eles: list of (top_id, pod, resource_type) tuple
+    :return: list of (route, is_new) tuple in the same order as eles, same
+             as the return value of get_or_create_route
+    """
+    route_expire_threshold = CONF.route_expire_threshold
+    results = {}
+    missing_eles = []
+    missing_keys = set()
+
+    with t_ctx.session.begin():
+        top_ids = set([_id for _id, _, _ in eles])
+        routes = t_ctx.session.query(models.ResourceRouting).filter(
+            models.ResourceRouting.top_id.in_(top_ids)).all()
+        route_map = dict([((route.top_id, route.pod_id), route.to_dict())
+                          for route in routes])
+        for _id, pod, _type in eles:
+            key = (_id, pod['pod_id'])
+            if key in results or key in missing_keys:
+                continue
+            route = route_map.get(key)
+            if not route:
+                missing_eles.append((_id, pod, _type))
+                missing_keys.add(key)
+                continue
+            if route['bottom_id']:
+                results[key] = (route, False)
+                continue
+            route_time = route['updated_at'] or route['created_at']
+            delta = datetime.datetime.utcnow() - route_time
+            if delta.total_seconds() <= route_expire_threshold:
+                results[key] = (route, False)
+                continue
+            # NOTE: same as get_or_create_route, check if the
+            # element has been created by other worker before removing the
+            # expired route
+            eles_ = list_ele_method(t_ctx, q_ctx, pod, _id, _type)
+            if eles_:
+                route['bottom_id'] = eles_[0]['id']
+                core.update_resource(t_ctx, models.ResourceRouting,
+                                     route['id'], route)
+                id_index.add_routing(route)
+                results[key] = (route, False)
+                continue
+            try:
+                core.delete_resource(t_ctx, models.ResourceRouting,
+                                     route['id'])
+            except db_exc.ResourceNotFound:
+                pass
+            missing_eles.append((_id, pod, _type))
+            missing_keys.add(key)
+
+    fallback_eles = []
+    if missing_eles:
+        rows = [{'top_id': _id,
+                 'pod_id': pod['pod_id'],
+                 'project_id': project_id,
+                 'resource_type': _type} for _id, pod, _type in missing_eles]
+        try:
+            # NOTE(zhiyuan) try/except block inside a with block will cause
+            # problem, so move them out of the block and manually handle the
+            # session context
+            t_ctx.session.begin()
+            t_ctx.session.execute(
+                models.ResourceRouting.__table__.insert().values(rows))
+            routes = t_ctx.session.query(models.ResourceRouting).filter(
+                models.ResourceRouting.top_id.in_(
+                    [row['top_id'] for row in rows])).all()
+            t_ctx.session.commit()
+            for route in routes:
+                key = (route.top_id, route.pod_id)
+                if key in missing_keys:
+                    results[key] = (route.to_dict(), True)
+        except db_exc.DBDuplicateEntry:
+            # NOTE: some routes are created by other worker at the
+            # same time, fall back to handle the missing routes one by one
+            t_ctx.session.rollback()
+            fallback_eles = missing_eles
+        finally:
+            t_ctx.session.close()
+    for _id, pod, _type in fallback_eles:
+        results[(_id, pod['pod_id'])] = get_or_create_route(
+            t_ctx, q_ctx, project_id, pod, _id, _type, list_ele_method)
+
+    return [results[(_id, pod['pod_id'])] for _id, pod, _ in eles]
+
+
+def delete_unbound_routes(t_ctx, routes):
+    """Remove routing entries whose bottom resources are not created
+
+    Used to clean up routing entries created by get_or_create_routes when
+    creating some of the elements fails.
+    """
+    route_ids = [route['id'] for route in routes if route]
+    if not route_ids:
+        return
+    with t_ctx.session.begin():
+        t_ctx.session.query(models.ResourceRouting).filter(
+            models.ResourceRouting.id.in_(route_ids)).filter_by(
+                bottom_id=None).delete(synchronize_session=False)
+    for route in routes:
+        if route:
+            _notify_route_done((route['top_id'], route['pod_id']))
+
+
+def _refresh_route(t_ctx, route):
+    """Refresh the update time of an unbound routing entry
+
+    :return: False if the entry has been removed or bound by other worker
+    """
+    with t_ctx.session.begin():
+        num = t_ctx.session.query(models.ResourceRouting).filter_by(
+            id=route['id'], bottom_id=None).update(
+                {'updated_at': datetime.datetime.utcnow()},
+                synchronize_session=False)
+    return num > 0
+
+
 def get_or_create_element(t_ctx, q_ctx,
                           project_id, pod, ele, _type, body,
-                          list_ele_method, create_ele_method):
-    # use configuration option later
-    max_tries = 5
-    for _ in xrange(max_tries):
-        route, is_new = get_or_create_route(
-            t_ctx, q_ctx, project_id, pod, ele['id'], _type, list_ele_method)
+                          list_ele_method, create_ele_method,
+                          prepared_route=None):
+    """Get or create the element and its routing entry
+
+    :param prepared_route: (route, is_new) tuple returned by
+                           get_or_create_routes for this element, used in the
+                           first try instead of querying the routing entry
+    :return: (is_new, bottom_id) tuple
+    """
+    key = (ele['id'], pod['pod_id'])
+    for try_num in xrange(CONF.route_max_tries):
+        if try_num == 0 and prepared_route:
+            route, is_new = prepared_route
+            # NOTE: creating elements prepared before this one may
+            # take longer than route_expire_threshold and other worker may
+            # remove this route as expired, so check and refresh it first
+            if is_new and not _refresh_route(t_ctx, route):
+                route, is_new = get_or_create_route(
+                    t_ctx, q_ctx, project_id, pod, ele['id'], _type,
+                    list_ele_method)
+        else:
+            route, is_new = get_or_create_route(
+                t_ctx, q_ctx, project_id, pod, ele['id'], _type,
+                list_ele_method)
         if not route:
-            eventlet.sleep(0)
+            _wait_for_route(key, try_num)
             continue
         if not is_new and not route['bottom_id']:
-            eventlet.sleep(0)
+            _wait_for_route(key, try_num)
             continue
         if not is_new and route['bottom_id']:
             break
         if is_new:
+            _route_events[key] = event.Event()
             try:
-                ele = create_ele_method(t_ctx, q_ctx, pod, body, _type)
-            except Exception:
+                try:
+                    ele = create_ele_method(t_ctx, q_ctx, pod, body, _type)
+                except Exception:
+                    with t_ctx.session.begin():
+                        try:
+                            core.delete_resource(t_ctx,
+                                                 models.ResourceRouting,
+                                                 route['id'])
+                        except db_exc.ResourceNotFound:
+                            # NOTE(zhiyuan) this is a rare case that other
+                            # worker considers the route expires and delete
+                            # it though it was just created, maybe caused by
+                            # out-of-sync time
+                            pass
+                    raise
                 with t_ctx.session.begin():
-                    try:
-                        core.delete_resource(t_ctx,
-                                             models.ResourceRouting,
-                                             route['id'])
-                    except db_exc.ResourceNotFound:
-                        # NOTE(zhiyuan) this is a rare case that other worker
-                        # considers the route expires and delete it though it
-                        # was just created, maybe caused by out-of-sync time
-                        pass
-                raise
-            with t_ctx.session.begin():
-                # NOTE(zhiyuan) it's safe to update route, the bottom network
-                # has been successfully created, so other worker will not
-                # delete this route
-                route['bottom_id'] = ele['id']
-                core.update_resource(t_ctx, models.ResourceRouting,
-                                     route['id'], route)
-                break
+                    # NOTE(zhiyuan) it's safe to update route, the bottom
+                    # network has been successfully created, so other worker
+                    # will not delete this route
+                    route['bottom_id'] = ele['id']
+                    core.update_resource(t_ctx, models.ResourceRouting,
+                                         route['id'], route)
+                id_index.add_routing(route)
+            finally:
+                # waiters are waked up whether the route is bound or not
+                _notify_route_done(key)
+            break
     if not route:
-        raise Exception('Fail to create %s routing entry' % _type)
+        raise exceptions.RoutingCreateFail(_type)
     if not route['bottom_id']:
-        raise Exception('Fail to bind top and bottom %s' % _type)
+        raise exceptions.RoutingBindFail(_type)
     return is_new, route['bottom_id']
@@ -14,13 +14,19 @@
 #    under the License.
 
 import tricircle.common.client
-
-# Todo: adding rpc cap negotiation configuration after first release
-# import tricircle.common.xrpcapi
+import tricircle.common.id_index
+import tricircle.common.list_cache
+import tricircle.common.lock_handle
+import tricircle.common.xrpcapi
 
 
 def list_opts():
     return [
         ('client', tricircle.common.client.client_opts),
+        ('DEFAULT', tricircle.common.lock_handle.lock_opts),
+        ('DEFAULT', tricircle.common.id_index.id_index_opts),
+        ('DEFAULT', tricircle.common.list_cache.list_cache_opts),
+        ('DEFAULT', tricircle.common.xrpcapi.xjobapi_opts),
+        # Todo: adding rpc cap negotiation configuration after first release
         # ('upgrade_levels', tricircle.common.xrpcapi.rpcapi_cap_opt),
     ]
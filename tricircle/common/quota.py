@@ -19,6 +19,7 @@ Routines for configuring tricircle, copy and modify from Cinder
 
 import datetime
 import six
+import time
 
 from oslo_config import cfg
 import oslo_log.log as logging
@@ -129,7 +130,21 @@ quota_opts = [
     cfg.BoolOpt('use_default_quota_class',
                 default=True,
                 help='Enables or disables use of default quota class '
-                     'with default quota.'), ]
+                     'with default quota.'),
+    cfg.IntOpt('project_hierarchy_cache_ttl',
+               default=60,
+               help='Seconds to cache the parent and the subtree of projects '
+                    'got from keystone, changes of the project hierarchy may '
+                    'take this long to take effect on quota operations. Set '
+                    'to 0 to disable the cache'),
+    cfg.IntOpt('limit_snapshot_ttl',
+               default=10,
+               help='Seconds to use the snapshot of the limits of a project '
+                    'when checking absolute limits like metadata_items. '
+                    'Limit changes made in this process refresh snapshots '
+                    'immediately, changes made in other processes may take '
+                    'this long to take effect. Set to 0 to disable the '
+                    'snapshot'), ]
 
 LOG = logging.getLogger(__name__)
 
@@ -140,10 +155,64 @@ CONF.register_opts(quota_opts, quota_group)
 
 NON_QUOTA_KEYS = ['tenant_id', 'id']
 
+# project id -> (expire time, GenericProjectInfo)
+_project_cache = {}
+
+
+def _get_cached_project(project_id):
+    cached = _project_cache.get(project_id)
+    if not cached or cached[0] < time.time():
+        return None
+    return cached[1]
+
+
+def _cache_project(project):
+    """Cache the project and all the projects in its subtree.
+
+    Subtree got with "subtree_as_ids" contains the subtree of every
+    descendant, so descendants are cached without asking keystone again.
+    """
+    if CONF.quota.project_hierarchy_cache_ttl <= 0:
+        return
+    now = time.time()
+    for project_id in [project_id for project_id, (expire, _project)
+                       in six.iteritems(_project_cache) if expire < now]:
+        del _project_cache[project_id]
+    expire = now + CONF.quota.project_hierarchy_cache_ttl
+    _project_cache[project.id] = (expire, project)
+    if project.keystone_api_version != 'v3':
+        return
+    stack = [project]
+    while stack:
+        parent = stack.pop()
+        for child_id, child_subtree in (parent.subtree or {}).items():
+            child = QuotaSetOperation.GenericProjectInfo(
+                child_id, parent.keystone_api_version, parent.id,
+                child_subtree)
+            _project_cache[child_id] = (expire, child)
+            stack.append(child)
+
+
+def invalidate_project_cache(project_id=None):
+    if project_id:
+        _project_cache.pop(project_id, None)
+    else:
+        _project_cache.clear()
+
+
+# (project id, quota class) -> (limits version, expire time, limits)
+_limit_snapshots = {}
+
+
+def invalidate_limit_snapshots():
+    _limit_snapshots.clear()
+
 
 class BaseResource(object):
     """Describe a single resource for quota checking."""
 
+    __slots__ = ('name', 'flag', 'parent_project_id')
+
     def __init__(self, name, flag=None, parent_project_id=None):
         """Initializes a Resource.
 
@@ -218,6 +287,10 @@ class BaseResource(object):
 class ReservableResource(BaseResource):
     """Describe a reservable resource."""
 
+    # NOTE: sync is only set if a sync function is given, callers
+    # use hasattr(resource, 'sync') to tell reservable resources apart
+    __slots__ = ('sync',)
+
     def __init__(self, name, sync, flag=None):
         """Initializes a ReservableResource.
 
@@ -254,12 +327,14 @@ class ReservableResource(BaseResource):
 class AbsoluteResource(BaseResource):
     """Describe a non-reservable resource."""
 
-    pass
+    __slots__ = ()
 
 
 class CountableResource(AbsoluteResource):
     """Describe a resource where counts aren't based only on the project ID."""
 
+    __slots__ = ('count',)
+
     def __init__(self, name, count, flag=None):
         """Initializes a CountableResource.
 
@@ -298,6 +373,8 @@ class CountableResource(AbsoluteResource):
 class VolumeTypeResource(ReservableResource):
     """ReservableResource for a specific volume type."""
 
+    __slots__ = ('volume_type_name', 'volume_type_id')
+
     def __init__(self, part_name, volume_type):
         """Initializes a VolumeTypeResource.
 
@@ -352,11 +429,17 @@ class DbQuotaDriver(object):
                                   if any.
         """
 
-        quotas = {}
         default_quotas = {}
         if CONF.quota.use_default_quota_class and not parent_project_id:
             default_quotas = db_api.quota_class_get_default(context)
+        return self._get_defaults(resources, default_quotas,
+                                  parent_project_id)
 
+    def _get_defaults(self, resources, default_quotas,
+                      parent_project_id=None):
+        """Build default quotas from the loaded default quota class."""
+
+        quotas = {}
         for resource in resources.values():
             if default_quotas:
                 if resource.name not in default_quotas:
@@ -426,29 +509,72 @@ class DbQuotaDriver(object):
                                   if any.
         """
 
-        quotas = {}
-        project_quotas = db_api.quota_get_all_by_project(context, project_id)
-        if usages:
-            project_usages = db_api.quota_usage_get_all_by_project(context,
-                                                                   project_id)
-            allocated_quotas = db_api.quota_allocated_get_all_by_project(
-                context, project_id)
-            allocated_quotas.pop('project_id')
-
         # Get the quotas for the appropriate class.  If the project ID
         # matches the one in the context, we use the quota_class from
         # the context, otherwise, we use the provided quota_class (if
         # any)
         if project_id == context.project_id:
             quota_class = context.quota_class
-        if quota_class:
-            class_quotas = db_api.quota_class_get_all_by_name(context,
-                                                              quota_class)
-        else:
-            class_quotas = {}
+        use_default_class = (CONF.quota.use_default_quota_class and
+                             not parent_project_id)
+
+        # Load limits, usages and quota classes at once
+        loaded = db_api.quota_load_all_by_project(
+            context, project_id, quota_class=quota_class,
+            default_class=use_default_class, usages=usages)
+
+        default_quotas = self._get_defaults(
+            resources, loaded['default_quotas'],
+            parent_project_id=parent_project_id)
+
+        return self._format_project_quotas(
+            resources, loaded, loaded['class_quotas'], default_quotas,
+            defaults=defaults, usages=usages,
+            parent_project_id=parent_project_id)
+
+    def get_all_project_quotas(self, context, resources, project_ids=None,
+                               defaults=True, usages=True):
+        """Retrieve quotas for many projects.
+
+        Limits and usages are read in batches of projects, so the quotas
+        are returned as an iterator and can be streamed. Projects are taken
+        as root projects, and only the default quota class applies.
+
+        :param context: The request context, for access checks.
+        :param resources: A dictionary of the registered resources.
+        :param project_ids: The IDs of the projects to return quotas for,
+                            if not specified, all the projects having
+                            limits or usages are returned.
+        :param defaults: If True, the default value will be reported if
+                         there is no specific value for the resource.
+        :param usages: If True, the current in_use, reserved and allocated
+                       counts will also be returned.
+        :returns: an iterator of (project_id, quotas) sorted by project_id,
+                  quotas is in the format of get_project_quotas.
+        """
 
-        default_quotas = self.get_defaults(context, resources,
-                                           parent_project_id=parent_project_id)
+        default_class = {}
+        if CONF.quota.use_default_quota_class:
+            default_class = db_api.quota_class_get_default(context)
+        default_quotas = self._get_defaults(resources, default_class)
+
+        for project_id, loaded in db_api.quota_load_all_projects(
+                context, project_ids, usages=usages):
+            yield project_id, self._format_project_quotas(
+                resources, loaded, {}, default_quotas,
+                defaults=defaults, usages=usages)
+
+    def _format_project_quotas(self, resources, loaded, class_quotas,
+                               default_quotas, defaults=True, usages=True,
+                               parent_project_id=None):
+        """Merge loaded limits and usages of a project with the defaults."""
+
+        quotas = {}
+        project_quotas = loaded['quotas']
+        if usages:
+            project_usages = loaded['usages']
+            allocated_quotas = dict(loaded['allocated'])
+            allocated_quotas.pop('project_id')
 
         for resource in resources.values():
             # Omit default/quota class values
@@ -520,6 +646,42 @@ class DbQuotaDriver(object):
 
         return {k: v['limit'] for k, v in quotas.items()}
 
+    def _get_limit_snapshot(self, context, resources, keys, project_id):
+        """Get limits of the absolute resources of a project.
+
+        Limits of all the absolute resources are loaded at once and kept
+        as a snapshot, which is used until it expires or any project or
+        quota class limit is changed.
+        """
+
+        db_api.authorize_project_context(context, project_id)
+        snapshot_key = (project_id, context.quota_class)
+        version = db_api.get_quota_limits_version()
+        snapshot = _limit_snapshots.get(snapshot_key)
+        if snapshot and snapshot[0] == version and (
+                snapshot[1] >= time.time()) and (
+                set(keys).issubset(snapshot[2])):
+            return snapshot[2]
+
+        names = [k for k, v in resources.items() if not hasattr(v, 'sync')]
+        unknown = set(keys) - set(names)
+        if unknown:
+            raise t_exceptions.QuotaResourceUnknown(unknown=sorted(unknown))
+        # version is read before loading, so limits changed during loading
+        # make the snapshot out of date at once
+        limits = self._get_quotas(context, resources, names,
+                                  has_sync=False, project_id=project_id)
+        if CONF.quota.limit_snapshot_ttl > 0:
+            # snapshots expired or out of date are never used again
+            now = time.time()
+            for key in [key for key, (snapshot_version, expire, _limits)
+                        in six.iteritems(_limit_snapshots)
+                        if snapshot_version != version or expire < now]:
+                del _limit_snapshots[key]
+            _limit_snapshots[snapshot_key] = (
+                version, now + CONF.quota.limit_snapshot_ttl, limits)
+        return limits
+
     def limit_check(self, context, resources, values, project_id=None):
         """Check simple quota limits.
 
@@ -555,8 +717,8 @@ class DbQuotaDriver(object):
             project_id = context.project_id
 
         # Get the applicable quotas
-        quotas = self._get_quotas(context, resources, values.keys(),
-                                  has_sync=False, project_id=project_id)
+        quotas = self._get_limit_snapshot(context, resources, values.keys(),
+                                          project_id)
         # Check the quotas and construct a list of the resources that
         # would be put over limit by the desired values
         overs = [key for key, val in values.items()
@@ -685,9 +847,10 @@ class DbQuotaDriver(object):
         any that have expired.
 
         :param context: The request context, for access checks.
+        :returns: number of reservations expired
         """
 
-        db_api.reservation_expire(context)
+        return db_api.reservation_expire(context)
 
 
 class QuotaEngine(object):
@@ -791,6 +954,27 @@ class QuotaEngine(object):
             usages=usages,
             parent_project_id=parent_project_id)
 
+    def get_all_project_quotas(self, context, project_ids=None,
+                               defaults=True, usages=True):
+        """Retrieve the quotas for many projects.
+
+        :param context: The request context, for access checks.
+        :param project_ids: The IDs of the projects to return quotas for,
+                            all the projects having limits or usages if
+                            not specified.
+        :param defaults: If True, the default value will be reported if
+                         there is no specific value for the resource.
+        :param usages: If True, the current in_use, reserved and
+                       allocated counts will also be returned.
+        :returns: an iterator of (project_id, quotas).
+        """
+
+        return self._driver.get_all_project_quotas(
+            context, self.resources,
+            project_ids=project_ids,
+            defaults=defaults,
+            usages=usages)
+
     def count(self, context, resource, *args, **kwargs):
         """Count a resource.
 
@@ -948,9 +1132,10 @@ class QuotaEngine(object):
         any that have expired.
 
         :param context: The request context, for access checks.
+        :returns: number of reservations expired
         """
 
-        self._driver.expire(context)
+        return self._driver.expire(context)
 
     def add_volume_type_opts(self, context, opts, volume_type_id):
         """Add volume type resource options.
@@ -991,64 +1176,93 @@ class QuotaEngine(object):
 class AllQuotaEngine(QuotaEngine):
     """Represent the set of all quotas."""
 
+    # Global quotas.
+    # Set sync_func to None for no sync function in Tricircle
+    reservable_argses = [
+
+        ('instances', None, 'quota_instances'),
+        ('cores', None, 'quota_cores'),
+        ('ram', None, 'quota_ram'),
+        ('security_groups', None, 'quota_security_groups'),
+        ('floating_ips', None, 'quota_floating_ips'),
+        ('fixed_ips', None, 'quota_fixed_ips'),
+        ('server_groups', None, 'quota_server_groups'),
+
+
+        ('volumes', None, 'quota_volumes'),
+        ('per_volume_gigabytes', None, 'per_volume_size_limit'),
+        ('snapshots', None, 'quota_snapshots'),
+        ('gigabytes', None, 'quota_gigabytes'),
+        ('backups', None, 'quota_backups'),
+        ('backup_gigabytes', None, 'quota_backup_gigabytes'),
+        ('consistencygroups', None, 'quota_consistencygroups')
+    ]
+
+    absolute_argses = [
+        ('metadata_items', 'quota_metadata_items'),
+        ('injected_files', 'quota_injected_files'),
+        ('injected_file_content_bytes',
+         'quota_injected_file_content_bytes'),
+        ('injected_file_path_length',
+         'quota_injected_file_path_length'),
+    ]
+
+    # TODO(joehuang), for countable, the count should be the
+    # value in the db but not 0 here
+    countable_argses = [
+        ('security_group_rules', None, 'quota_security_group_rules'),
+        ('key_pairs', None, 'quota_key_pairs'),
+        ('server_group_members', None, 'quota_server_group_members'),
+    ]
+
+    volume_type_parts = ('volumes', 'gigabytes', 'snapshots')
+
+    def __init__(self, quota_driver_class=None):
+        super(AllQuotaEngine, self).__init__(quota_driver_class)
+        self._all_resources = None
+
     @property
     def resources(self):
-        """Fetches all possible quota resources."""
+        """Fetches all possible quota resources.
+
+        Resources are built on first access and shared afterwards, call
+        refresh_resources to rebuild them.
+        """
+
+        if self._all_resources is None:
+            self.refresh_resources()
+        return self._all_resources
+
+    def refresh_resources(self, volume_types=None):
+        """Rebuild all the quota resources.
+
+        :param volume_types: list of volume type dicts with 'id' and 'name'
+                             keys, volume type specific resources are
+                             created for each of them
+        """
 
         result = {}
 
-        # Global quotas.
-        # Set sync_func to None for no sync function in Tricircle
-        reservable_argses = [
-
-            ('instances', None, 'quota_instances'),
-            ('cores', None, 'quota_cores'),
-            ('ram', None, 'quota_ram'),
-            ('security_groups', None, 'quota_security_groups'),
-            ('floating_ips', None, 'quota_floating_ips'),
-            ('fixed_ips', None, 'quota_fixed_ips'),
-            ('server_groups', None, 'quota_server_groups'),
-
-
-            ('volumes', None, 'quota_volumes'),
-            ('per_volume_gigabytes', None, 'per_volume_size_limit'),
-            ('snapshots', None, 'quota_snapshots'),
-            ('gigabytes', None, 'quota_gigabytes'),
-            ('backups', None, 'quota_backups'),
-            ('backup_gigabytes', None, 'quota_backup_gigabytes'),
-            ('consistencygroups', None, 'quota_consistencygroups')
-        ]
-
-        absolute_argses = [
-            ('metadata_items', 'quota_metadata_items'),
-            ('injected_files', 'quota_injected_files'),
-            ('injected_file_content_bytes',
-             'quota_injected_file_content_bytes'),
-            ('injected_file_path_length',
-             'quota_injected_file_path_length'),
-        ]
-
-        # TODO(joehuang), for countable, the count should be the
-        # value in the db but not 0 here
-        countable_argses = [
-            ('security_group_rules', None, 'quota_security_group_rules'),
-            ('key_pairs', None, 'quota_key_pairs'),
-            ('server_group_members', None, 'quota_server_group_members'),
-        ]
-
-        for args in reservable_argses:
+        for args in self.reservable_argses:
             resource = ReservableResource(*args)
             result[resource.name] = resource
 
-        for args in absolute_argses:
+        for args in self.absolute_argses:
             resource = AbsoluteResource(*args)
             result[resource.name] = resource
 
-        for args in countable_argses:
+        for args in self.countable_argses:
             resource = CountableResource(*args)
             result[resource.name] = resource
 
-        return result
+        for volume_type in volume_types or []:
+            for part_name in self.volume_type_parts:
+                resource = VolumeTypeResource(part_name, volume_type)
+                result[resource.name] = resource
+
+        # NOTE: replace the whole dict at once so readers never see
+        # a partially built registry
+        self._all_resources = result
 
     def register_resource(self, resource):
         raise NotImplementedError(_("Cannot register resource"))
@@ -1083,6 +1297,30 @@ class QuotaSetOperation(object):
             self.parent_id = project_parent_id
             self.subtree = project_subtree
 
+        @property
+        def subtree(self):
+            return self._subtree
+
+        @subtree.setter
+        def subtree(self, subtree):
+            self._subtree = subtree
+            self._descendants = None
+
+        @property
+        def descendants(self):
+            """Ids of all the projects in the subtree, flattened once."""
+            if self._descendants is None:
+                descendants = set()
+                stack = [self._subtree]
+                while stack:
+                    subtree = stack.pop()
+                    if not subtree:
+                        continue
+                    descendants.update(subtree.keys())
+                    stack.extend(subtree.values())
+                self._descendants = frozenset(descendants)
+            return self._descendants
+
     def _format_quota_set(self, tenant_id, quota_set):
         """Convert the quota object to a result dict."""
 
@@ -1207,8 +1445,7 @@ class QuotaSetOperation(object):
             raise t_exceptions.HTTPForbiddenError(msg=msg)
 
         if context_project.id != target_project_id:
-            if not self._is_descendant(target_project_id,
-                                       context_project.subtree):
+            if not self._is_descendant(target_project_id, context_project):
                 msg = _("Update and delete quota operations can only be made "
                         "to projects in the same hierarchy of the project in "
                         "which users are scoped to."
@@ -1247,7 +1484,7 @@ class QuotaSetOperation(object):
         if target_project.parent_id:
             if target_project.id != context_project.id:
                 if not self._is_descendant(target_project.id,
-                                           context_project.subtree):
+                                           context_project):
                     msg = _("Show operations can only be made to projects in "
                             "the same hierarchy of the project in which users "
                             "are scoped to."
@@ -1271,14 +1508,8 @@ class QuotaSetOperation(object):
             LOG.error(msg=msg)
             raise t_exceptions.HTTPForbiddenError(msg=msg)
 
-    def _is_descendant(self, target_project_id, subtree):
-        if subtree is not None:
-            for key, value in subtree.items():
-                if key == target_project_id:
-                    return True
-                if self._is_descendant(target_project_id, value):
-                    return True
-        return False
+    def _is_descendant(self, target_project_id, project):
+        return target_project_id in project.descendants
 
     def _get_project(self, context, id, subtree_as_ids=False):
         """A Helper method to get the project hierarchy.
@@ -1286,21 +1517,27 @@ class QuotaSetOperation(object):
         Along with Hierachical Multitenancy in keystone API v3, projects can be
         hierarchically organized. Therefore, we need to know the project
         hierarchy, if any, in order to do quota operations properly.
+
+        The subtree is always requested so that one cached project serves
+        both parent and subtree lookups, subtree_as_ids is kept for
+        compatibility.
         """
+        generic_project = _get_cached_project(id)
+        if generic_project:
+            return generic_project
         try:
             keystone = self._keystone_client(context)
             generic_project = self.GenericProjectInfo(id, keystone.version)
             if keystone.version == 'v3':
-                project = keystone.projects.get(id,
-                                                subtree_as_ids=subtree_as_ids)
+                project = keystone.projects.get(id, subtree_as_ids=True)
                 generic_project.parent_id = project.parent_id
-                generic_project.subtree = (
-                    project.subtree if subtree_as_ids else None)
+                generic_project.subtree = project.subtree
         except k_exceptions.NotFound:
             msg = _("Tenant ID: %s does not exist.") % id
             LOG.error(msg=msg)
             raise t_exceptions.NotFound()
 
+        _cache_project(generic_project)
         return generic_project
 
     def update(self, context, **kw):
@@ -200,7 +200,7 @@ class NeutronResourceHandle(ResourceHandle):
 
 class NovaResourceHandle(ResourceHandle):
     service_type = cons.ST_NOVA
-    support_resource = {'flavor': LIST,
+    support_resource = {'flavor': LIST | GET,
                         'server': LIST | CREATE | GET,
                         'aggregate': LIST | CREATE | DELETE | ACTION}
 
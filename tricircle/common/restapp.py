@@ -12,13 +12,24 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import itertools
+
 from keystonemiddleware import auth_token
 from oslo_config import cfg
+from oslo_log import log as logging
 from oslo_middleware import request_id
+from oslo_service import loopingcall
 from oslo_service import service
+from pecan import hooks
 
+import context as t_context
 import exceptions as t_exc
 from i18n import _
+from i18n import _LI
+from i18n import _LW
+from tricircle.db import core
+
+LOG = logging.getLogger(__name__)
 
 
 def auth_app(app):
@@ -37,6 +48,101 @@ def auth_app(app):
     return app
 
 
+class TransactionHook(hooks.PecanHook):
+    """Run DB operations of one request in one transaction
+
+    Contexts extracted from the request share the session of the
+    transaction, and DB API functions beginning transactions with
+    "subtransactions=True" join it, so the request is committed once. The
+    transaction is rolled back if the request fails. Bodies of streamed
+    responses are generated after the transaction is finished, they are
+    read with contexts returned by get_stream_context outside of it.
+    """
+
+    def before(self, state):
+        session = core.get_session()
+        session.begin()
+        state.request.environ[t_context.DB_SESSION_ENV] = session
+
+    def after(self, state):
+        session = state.request.environ.pop(t_context.DB_SESSION_ENV, None)
+        if not session:
+            # already rolled back in on_error
+            return
+        if state.response.status_int < 400 and session.is_active:
+            session.commit()
+        else:
+            session.rollback()
+        session.close()
+
+    def on_error(self, state, e):
+        session = state.request.environ.pop(t_context.DB_SESSION_ENV, None)
+        if session:
+            session.rollback()
+            session.close()
+
+
+def prefetch(iterable):
+    """Read the first item of an iterable used as a response body
+
+    Errors raised when reading the first item, like failing to query the
+    first batch, are raised here and turned into an error status, while
+    errors raised when the body is streamed only break the body.
+
+    :return: an iterator yielding all the items of the iterable
+    """
+    iterator = iter(iterable)
+    try:
+        first = next(iterator)
+    except StopIteration:
+        return iter([])
+    return itertools.chain([first], iterator)
+
+
+def _log_pool_stats():
+    try:
+        LOG.info(_LI('DB connection pool stats: %s'), core.get_pool_stats())
+    except Exception as e:
+        # NOTE: the looping call stops if the function raises
+        LOG.warning(_LW('Fail to get DB connection pool stats: '
+                        '%(exception)s'), {'exception': e})
+
+
+class WorkerService(service.ServiceBase):
+    """Prepare the DB engine of each worker before serving requests"""
+
+    def __init__(self, api_service):
+        self.api_service = api_service
+        self._pool_stats_timer = None
+
+    def start(self):
+        # NOTE: start is called in the worker process after fork
+        try:
+            core.warmup_engine()
+        except Exception as e:
+            # the engine connects on the first request instead
+            LOG.warning(_LW('Fail to warm up DB engine, connecting on '
+                            'demand: %(exception)s'), {'exception': e})
+        interval = cfg.CONF.tricircle_db_pool_stats_interval
+        if interval > 0:
+            self._pool_stats_timer = loopingcall.FixedIntervalLoopingCall(
+                _log_pool_stats)
+            self._pool_stats_timer.start(interval, initial_delay=interval)
+        self.api_service.start()
+
+    def stop(self):
+        if self._pool_stats_timer:
+            self._pool_stats_timer.stop()
+            self._pool_stats_timer = None
+        self.api_service.stop()
+
+    def wait(self):
+        self.api_service.wait()
+
+    def reset(self):
+        self.api_service.reset()
+
+
 _launcher = None
 
 
@@ -45,7 +151,8 @@ def serve(api_service, conf, workers=1):
     if _launcher:
         raise RuntimeError(_('serve() can only be called once'))
 
-    _launcher = service.launch(conf, api_service, workers=workers)
+    _launcher = service.launch(conf, WorkerService(api_service),
+                               workers=workers)
 
 
 def wait():
@@ -0,0 +1,69 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from eventlet import event
+
+
+class Group(object):
+    """Share one call among concurrent callers with the same key
+
+    The first caller for a key runs the function, callers for the same key
+    arriving before it returns wait for it and get the same result, or the
+    same exception, instead of running the function again. Nothing is kept
+    after the call returns, so a caller arriving later runs the function
+    again. If "copy_func" is given, waiting callers get the result passed
+    through it, so callers modifying the result do not affect each other.
+    """
+
+    def __init__(self, copy_func=None):
+        self.copy_func = copy_func
+        self.inflight = {}
+        self.called_count = 0
+        self.shared_count = 0
+
+    def do(self, key, func, *args, **kwargs):
+        call = self.inflight.get(key)
+        if call:
+            self.shared_count += 1
+            call['waiters'] += 1
+            result = call['done'].wait()
+            return self.copy_func(result) if self.copy_func else result
+
+        call = self.inflight[key] = {'done': event.Event(), 'waiters': 0}
+        self.called_count += 1
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            # NOTE: also covers eventlet.Timeout and GreenletExit raised when
+            # the green thread is killed, otherwise the waiters block forever
+            del self.inflight[key]
+            call['done'].send_exception(e)
+            raise
+        del self.inflight[key]
+        call['done'].send(result)
+        if call['waiters'] and self.copy_func:
+            # NOTE: waiters copy the result when they are waked up,
+            # so the caller should not modify the original one
+            return self.copy_func(result)
+        return result
+
+    def reset_stats(self):
+        self.called_count = 0
+        self.shared_count = 0
+
+    def get_stats(self):
+        return {'inflight': len(self.inflight),
+                'called': self.called_count,
+                'shared': self.shared_count}
@@ -81,3 +81,30 @@ def bool_from_string(subject, strict=False, default=False):
         raise ValueError(msg)
     else:
         return default
+
+
+def list_all_servers(client, cxt, filters=None):
+    """List servers in a pod page by page
+
+    Nova returns at most osapi_max_limit servers for one list request, so
+    servers are requested again with the id of the last server received as
+    marker until an empty page is returned.
+
+    :param client: client of the pod
+    :param cxt: context object
+    :param filters: list of filters passed to list_servers
+    :return: generator of servers
+    """
+    filters = list(filters or [])
+    marker = None
+    while True:
+        page_filters = filters
+        if marker:
+            page_filters = filters + [{'key': 'marker', 'comparator': 'eq',
+                                       'value': marker}]
+        servers = client.list_servers(cxt, page_filters)
+        if not servers or servers[-1]['id'] == marker:
+            return
+        for server in servers:
+            yield server
+        marker = servers[-1]['id']
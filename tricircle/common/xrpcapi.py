@@ -20,6 +20,8 @@ from oslo_config import cfg
 from oslo_log import log as logging
 import oslo_messaging as messaging
 
+import coalescer
+import hash_ring
 import rpc
 from serializer import TricircleSerializer as Serializer
 import topics
@@ -32,6 +34,23 @@ rpcapi_cap_opt = cfg.StrOpt('xjobapi',
                                  'xjob api in any service')
 CONF.register_opt(rpcapi_cap_opt, 'upgrade_levels')
 
+xjobapi_opts = [
+    cfg.FloatOpt('xjob_cast_coalesce_window',
+                 default=0,
+                 help='Seconds to hold configure extra routes messages'
+                      ' before sending them to xjob, messages for the same'
+                      ' router sent during this period are merged into one.'
+                      ' Set to 0 to send messages immediately'),
+    cfg.ListOpt('xjob_hosts',
+                default=[],
+                help='Host names of xjob services. If set, jobs are sharded'
+                     ' across these hosts by consistent hashing of the'
+                     ' resource id, so jobs for one resource are always'
+                     ' sent to the same host. Otherwise jobs are sent to'
+                     ' any xjob service'),
+]
+CONF.register_opts(xjobapi_opts)
+
 LOG = logging.getLogger(__name__)
 
 
@@ -63,6 +82,10 @@ class XJobAPI(object):
         self.client = rpc.get_client(target,
                                      version_cap=version_cap,
                                      serializer=serializer)
+        self.extra_route_coalescer = coalescer.Coalescer(
+            self._cast_configure_extra_routes,
+            CONF.xjob_cast_coalesce_window)
+        self.hash_ring = hash_ring.HashRing(CONF.xjob_hosts)
 
     # to do the version compatibility for future purpose
     def _determine_version_cap(self, target):
@@ -73,9 +96,16 @@ class XJobAPI(object):
         return self.client.call(ctxt, 'test_rpc', payload=payload)
 
     def configure_extra_routes(self, ctxt, router_id):
+        self.extra_route_coalescer.submit(router_id, ctxt, router_id)
+
+    def _cast_configure_extra_routes(self, ctxt, router_id):
         # NOTE(zhiyuan) this RPC is called by plugin in Neutron server, whose
         # control exchange is "neutron", however, we starts xjob without
         # specifying its control exchange, so the default value "openstack" is
         # used, thus we need to pass exchange as "openstack" here.
-        self.client.prepare(exchange='openstack').cast(
+        # if xjob hosts are configured, the job is sent to the queue of the
+        # host owning the router, so jobs for the same router can be merged
+        # by that host
+        self.client.prepare(exchange='openstack',
+                            server=self.hash_ring.get_node(router_id)).cast(
             ctxt, 'configure_extra_routes', payload={'router': router_id})
@@ -13,6 +13,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
 import functools
 import time
 import uuid
@@ -20,7 +21,11 @@ import uuid
 from oslo_config import cfg
 from oslo_db import exception as db_exc
 from oslo_log import log as logging
+from oslo_serialization import jsonutils
 from oslo_utils import timeutils
+from oslo_utils import uuidutils
+import sqlalchemy as sql
+from sqlalchemy.orm.attributes import set_committed_value
 
 from tricircle.common.context import is_admin_context as _is_admin_context
 from tricircle.common import exceptions
@@ -31,62 +36,76 @@ from tricircle.db import core
 from tricircle.db import models
 
 
+api_opts = [
+    cfg.IntOpt('quota_class_cache_ttl',
+               default=10,
+               help=_('Seconds to cache the limits of a quota class, '
+                      'including the default quota class, in each process. '
+                      'Changes made in other processes may take this long '
+                      'to take effect. Set to 0 to disable the cache')),
+    cfg.IntOpt('reservation_expire_batch_size',
+               default=500,
+               help=_('Number of expired reservations rolled back in one '
+                      'transaction')),
+]
+
 CONF = cfg.CONF
+CONF.register_opts(api_opts, group='quota')
 LOG = logging.getLogger(__name__)
 
 
 def create_pod(context, pod_dict):
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         return core.create_resource(context, models.Pod, pod_dict)
 
 
 def delete_pod(context, pod_id):
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         return core.delete_resource(context, models.Pod, pod_id)
 
 
 def get_pod(context, pod_id):
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         return core.get_resource(context, models.Pod, pod_id)
 
 
-def list_pods(context, filters=None, sorts=None):
-    with context.session.begin():
+def list_pods(context, filters=None, sorts=None, limit=None, marker=None):
+    with context.session.begin(subtransactions=True):
         return core.query_resource(context, models.Pod, filters or [],
-                                   sorts or [])
+                                   sorts or [], limit=limit, marker=marker)
 
 
 def update_pod(context, pod_id, update_dict):
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         return core.update_resource(context, models.Pod, pod_id, update_dict)
 
 
 def create_pod_service_configuration(context, config_dict):
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         return core.create_resource(context, models.PodServiceConfiguration,
                                     config_dict)
 
 
 def delete_pod_service_configuration(context, config_id):
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         return core.delete_resource(context, models.PodServiceConfiguration,
                                     config_id)
 
 
 def get_pod_service_configuration(context, config_id):
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         return core.get_resource(context, models.PodServiceConfiguration,
                                  config_id)
 
 
 def list_pod_service_configurations(context, filters=None, sorts=None):
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         return core.query_resource(context, models.PodServiceConfiguration,
                                    filters or [], sorts or [])
 
 
 def update_pod_service_configuration(context, config_id, update_dict):
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         return core.update_resource(
             context, models.PodServiceConfiguration, config_id, update_dict)
 
@@ -104,7 +123,7 @@ def get_bottom_mappings_by_top_id(context, top_id, resource_type):
                       'comparator': 'eq',
                       'value': resource_type}]
     mappings = []
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         routes = core.query_resource(
             context, models.ResourceRouting, route_filters, [])
         for route in routes:
@@ -153,7 +172,7 @@ def get_bottom_mappings_by_tenant_pod(context,
                       'comparator': 'eq',
                       'value': resource_type}]
     routings = {}
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         routes = core.query_resource(
             context, models.ResourceRouting, route_filters, [])
         for _route in routes:
@@ -163,48 +182,222 @@ def get_bottom_mappings_by_tenant_pod(context,
     return routings
 
 
+def get_extra_route_snapshots(context, top_router_id):
+    """Get extra route snapshots of bottom routers mapped to a top router
+
+    :param context: context object
+    :param top_router_id: router id on top
+    :return: a dict {bottom_router_id: snapshot}, where 'subnet_cidrs' of the
+    snapshot is a list of [bottom_subnet_id, cidr] pairs
+    """
+    snapshot_filters = [{'key': 'top_router_id',
+                         'comparator': 'eq',
+                         'value': top_router_id}]
+    snapshots = {}
+    with context.session.begin(subtransactions=True):
+        for snapshot in core.query_resource(
+                context, models.ExtraRouteSnapshot, snapshot_filters, []):
+            snapshot['subnet_cidrs'] = jsonutils.loads(
+                snapshot['subnet_cidrs'] or '[]')
+            snapshots[snapshot['bottom_router_id']] = snapshot
+    return snapshots
+
+
+def update_extra_route_snapshots(context, top_router_id, snapshots):
+    """Replace extra route snapshots of bottom routers mapped to a top router
+
+    :param context: context object
+    :param top_router_id: router id on top
+    :param snapshots: a dict {bottom_router_id: snapshot}, snapshot is a dict
+    with key 'pod_id', 'bridge_ip' and 'subnet_cidrs'
+    :return: None
+    """
+    snapshot_filters = [{'key': 'top_router_id',
+                         'comparator': 'eq',
+                         'value': top_router_id}]
+    with context.session.begin(subtransactions=True):
+        core.delete_resources(context, models.ExtraRouteSnapshot,
+                              snapshot_filters)
+        for b_router_id, snapshot in snapshots.iteritems():
+            core.create_resource(
+                context, models.ExtraRouteSnapshot,
+                {'top_router_id': top_router_id,
+                 'bottom_router_id': b_router_id,
+                 'pod_id': snapshot['pod_id'],
+                 'bridge_ip': snapshot['bridge_ip'],
+                 'subnet_cidrs': jsonutils.dumps(snapshot['subnet_cidrs'])})
+
+
+def acquire_job_lease(context, resource_id, owner, lease_time):
+    """Try to acquire the lease to run jobs for the given resource.
+
+    :param resource_id: id of the resource the job works on
+    :param owner: identity of the worker, unique across hosts and processes
+    :param lease_time: seconds after which the lease can be taken over
+    :return: True if the lease is acquired. If the lease is held by another
+             worker, its owner is asked to run the job again before
+             releasing the lease and False is returned
+    """
+    while True:
+        now = timeutils.utcnow()
+        expire_at = now + datetime.timedelta(seconds=lease_time)
+        with context.session.begin(subtransactions=True):
+            lease = context.session.query(models.JobLease).filter_by(
+                resource_id=resource_id).with_lockmode('update').first()
+            if lease:
+                if lease.expire_at > now:
+                    lease.rerun = True
+                    return False
+                # NOTE: owner of the lease is likely to be dead,
+                # take it over
+                lease.owner = owner
+                lease.expire_at = expire_at
+                lease.rerun = False
+                return True
+        try:
+            # NOTE(zhiyuan) try/except block inside a with block will cause
+            # problem, so move them out of the block and manually handle the
+            # session context
+            context.session.begin()
+            core.create_resource(context, models.JobLease,
+                                 {'resource_id': resource_id,
+                                  'owner': owner,
+                                  'expire_at': expire_at,
+                                  'rerun': False})
+            context.session.commit()
+            return True
+        except db_exc.DBDuplicateEntry:
+            # another worker creates the lease at the same time, retry to
+            # mark the lease for rerun
+            context.session.rollback()
+        finally:
+            context.session.close()
+
+
+def release_job_lease(context, resource_id, owner, lease_time=None):
+    """Release the lease acquired by acquire_job_lease.
+
+    :param lease_time: if set and a rerun has been requested, the lease is
+                       renewed for lease_time seconds instead of released
+    :return: True if the lease is renewed, owner should run the job again
+             and then release the lease again
+    """
+    with context.session.begin(subtransactions=True):
+        lease = context.session.query(models.JobLease).filter_by(
+            resource_id=resource_id, owner=owner).with_lockmode(
+                'update').first()
+        if not lease:
+            return False
+        if lease.rerun and lease_time is not None:
+            lease.expire_at = timeutils.utcnow() + datetime.timedelta(
+                seconds=lease_time)
+            lease.rerun = False
+            return True
+        context.session.delete(lease)
+        return False
+
+
 def get_next_bottom_pod(context, current_pod_id=None):
-    pods = list_pods(context, sorts=[(models.Pod.pod_id, True)])
-    # NOTE(zhiyuan) number of pods is small, just traverse to filter top pod
-    pods = [pod for pod in pods if pod['az_name']]
-    for index, pod in enumerate(pods):
-        if not current_pod_id:
-            return pod
-        if pod['pod_id'] == current_pod_id and index < len(pods) - 1:
-            return pods[index + 1]
-    return None
+    filters = [{'key': 'az_name', 'comparator': 'ne', 'value': ''}]
+    if current_pod_id:
+        # None is returned if current pod is not a bottom pod
+        if not list_pods(context, filters=filters + [
+                {'key': 'pod_id', 'comparator': 'eq',
+                 'value': current_pod_id}], limit=1):
+            return None
+        filters.append({'key': 'pod_id', 'comparator': 'gt',
+                        'value': current_pod_id})
+    pods = list_pods(context, filters=filters,
+                     sorts=[(models.Pod.pod_id, True)], limit=1)
+    return pods[0] if pods else None
 
 
 def get_top_pod(context):
 
-    filters = [{'key': 'az_name', 'comparator': 'eq', 'value': ''}]
-    pods = list_pods(context, filters=filters)
+    filters = [{'key': 'az_name', 'comparator': 'eq', 'value': ''},
+               {'key': 'pod_name', 'comparator': 'ne', 'value': ''}]
+    pods = list_pods(context, filters=filters, limit=1)
 
     # only one should be searched
-    for pod in pods:
-        if (pod['pod_name'] != '') and \
-                (pod['az_name'] == ''):
-            return pod
-
-    return None
+    return pods[0] if pods else None
 
 
 def get_pod_by_name(context, pod_name):
 
     filters = [{'key': 'pod_name', 'comparator': 'eq', 'value': pod_name}]
-    pods = list_pods(context, filters=filters)
+    pods = list_pods(context, filters=filters, limit=1)
 
     # only one should be searched
-    for pod in pods:
-        if pod['pod_name'] == pod_name:
-            return pod
-
-    return None
+    return pods[0] if pods else None
 
 
 _DEFAULT_QUOTA_NAME = 'default'
 
 
+def _create_pod_bindings_batch(context, bindings, existing):
+    pod_ids = list(set(binding['pod_id'] for binding in bindings))
+    pods = dict((pod['pod_id'], pod) for pod in core.query_resource(
+        context, models.Pod,
+        [{'key': 'pod_id', 'comparator': 'in', 'value': pod_ids}], []))
+    tenant_ids = list(set(binding['tenant_id'] for binding in bindings))
+    query = context.session.query(models.PodBinding.tenant_id,
+                                  models.PodBinding.pod_id).filter(
+        models.PodBinding.tenant_id.in_(tenant_ids))
+    existing.update((tenant_id, pod_id) for tenant_id, pod_id in query)
+
+    now = timeutils.utcnow()
+    results = []
+    rows = []
+    for binding in bindings:
+        tenant_id, pod_id = binding['tenant_id'], binding['pod_id']
+        pod = pods.get(pod_id)
+        if not pod:
+            results.append(exceptions.ResourceNotFound(models.Pod, pod_id))
+        elif not pod['az_name']:
+            results.append(exceptions.ValidationError(
+                msg=_('Top region can not be bound')))
+        elif (tenant_id, pod_id) in existing:
+            results.append(exceptions.PodBindingExists(tenant_id=tenant_id,
+                                                       pod_id=pod_id))
+        else:
+            existing.add((tenant_id, pod_id))
+            row = {'id': uuidutils.generate_uuid(),
+                   'tenant_id': tenant_id,
+                   'pod_id': pod_id,
+                   'created_at': now}
+            rows.append(row)
+            results.append(dict((key, row.get(key))
+                                for key in models.PodBinding.attributes))
+    if rows:
+        context.session.execute(
+            models.PodBinding.__table__.insert().values(rows))
+    return results
+
+
+def create_pod_bindings(context, bindings, batch_size=200):
+    """Bind tenants to pods in bulk.
+
+    Pods and existing bindings of a batch are checked with one query each
+    and the new bindings are inserted with one multi-row INSERT, all the
+    batches run in one transaction. Bindings failing the checks are
+    skipped without affecting the others.
+
+    :param bindings: list of dict with keys 'tenant_id' and 'pod_id'
+    :return: a list in the order of bindings, each item is the created
+             binding dict, or the exception telling why the binding is
+             not created, ResourceNotFound if the pod does not exist,
+             ValidationError if the pod is the top pod, PodBindingExists if
+             the tenant is already bound to the pod
+    """
+    results = []
+    existing = set()
+    with context.session.begin(subtransactions=True):
+        for start in xrange(0, len(bindings), batch_size):
+            results.extend(_create_pod_bindings_batch(
+                context, bindings[start:start + batch_size], existing))
+    return results
+
+
 def _is_user_context(context):
     """Indicates if the request context is a normal user."""
     if not context:
@@ -275,6 +468,14 @@ def require_context(f):
     return wrapper
 
 
+_deadlock_retries = {}
+
+
+def get_deadlock_retries():
+    """Return the number of deadlock retries of each DB API call."""
+    return dict(_deadlock_retries)
+
+
 def _retry_on_deadlock(f):
     """Decorator to retry a DB API call if Deadlock was received."""
     @functools.wraps(f)
@@ -286,6 +487,8 @@ def _retry_on_deadlock(f):
                 LOG.warning(_LW("Deadlock detected when running "
                                 "'%(func_name)s': Retrying..."),
                             dict(func_name=f.__name__))
+                _deadlock_retries[f.__name__] = _deadlock_retries.get(
+                    f.__name__, 0) + 1
                 # Retry!
                 time.sleep(0.5)
                 continue
@@ -370,6 +573,21 @@ def quota_allocated_get_all_by_project(context, project_id):
     return result
 
 
+# NOTE: version of the limits of projects and quota classes, bumped
+# on every change made in this process, so snapshots of limits built by
+# the quota driver can tell whether they are out of date
+_quota_limits_version = 0
+
+
+def get_quota_limits_version():
+    return _quota_limits_version
+
+
+def _bump_quota_limits_version():
+    global _quota_limits_version
+    _quota_limits_version += 1
+
+
 @require_admin_context
 def quota_create(context, project_id, resource, limit, allocated=0):
     quota_ref = models.Quotas()
@@ -380,23 +598,25 @@ def quota_create(context, project_id, resource, limit, allocated=0):
         quota_ref.allocated = allocated
 
     session = core.get_session()
-    with session.begin():
+    with session.begin(subtransactions=True):
         quota_ref.save(session)
-        return quota_ref
+    _bump_quota_limits_version()
+    return quota_ref
 
 
 @require_admin_context
 def quota_update(context, project_id, resource, limit):
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         quota_ref = _quota_get(context, project_id, resource,
                                session=context.session)
         quota_ref.hard_limit = limit
-        return quota_ref
+    _bump_quota_limits_version()
+    return quota_ref
 
 
 @require_admin_context
 def quota_allocated_update(context, project_id, resource, allocated):
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         quota_ref = _quota_get(context, project_id, resource,
                                session=context.session)
         quota_ref.allocated = allocated
@@ -405,10 +625,214 @@ def quota_allocated_update(context, project_id, resource, allocated):
 
 @require_admin_context
 def quota_destroy(context, project_id, resource):
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         quota_ref = _quota_get(context, project_id, resource,
                                session=context.session)
         quota_ref.delete(session=context.session)
+    _bump_quota_limits_version()
+
+
+# NOTE: limits of quota classes, especially the default one, are
+# read by every quota show and check but almost never change, so they are
+# cached for a short time. quota class changes made in this process clear
+# the cache immediately
+_quota_class_cache = {}
+
+
+def _get_cached_quota_class(class_name):
+    cached = _quota_class_cache.get(class_name)
+    if not cached or cached[0] < time.time():
+        return None
+    return dict(cached[1])
+
+
+def _cache_quota_class(class_name, result):
+    if CONF.quota.quota_class_cache_ttl > 0:
+        now = time.time()
+        for name in [name for name, (expire, _result)
+                     in _quota_class_cache.items() if expire < now]:
+            del _quota_class_cache[name]
+        _quota_class_cache[class_name] = (
+            now + CONF.quota.quota_class_cache_ttl, dict(result))
+
+
+def invalidate_quota_class_cache(class_name=None):
+    _bump_quota_limits_version()
+    if class_name:
+        _quota_class_cache.pop(class_name, None)
+    else:
+        _quota_class_cache.clear()
+
+
+@require_context
+def quota_load_all_by_project(context, project_id, quota_class=None,
+                              default_class=False, usages=True):
+    """Load the quota data needed to show a project in one query.
+
+    Limits and allocated quotas of the project, its usages if requested and
+    limits of the quota classes not found in cache are read with one UNION
+    ALL query.
+
+    :param quota_class: name of the quota class whose limits are loaded
+    :param default_class: whether limits of the default quota class are
+                          loaded
+    :param usages: whether usages of the project are loaded
+    :return: a dict with keys 'quotas', 'allocated', 'usages',
+             'class_quotas' and 'default_quotas', whose values are in the
+             same format as the results of quota_get_all_by_project,
+             quota_allocated_get_all_by_project,
+             quota_usage_get_all_by_project, quota_class_get_all_by_name
+             and quota_class_get_default
+    """
+    authorize_project_context(context, project_id)
+    if quota_class:
+        authorize_quota_class_context(context, quota_class)
+
+    result = {'quotas': {'project_id': project_id},
+              'allocated': {'project_id': project_id},
+              'usages': {'project_id': project_id},
+              'class_quotas': {},
+              'default_quotas': {}}
+    class_keys = {}
+    if quota_class:
+        class_keys[quota_class] = 'class_quotas'
+    if default_class:
+        class_keys[_DEFAULT_QUOTA_NAME] = 'default_quotas'
+    uncached_classes = []
+    for class_name, key in class_keys.iteritems():
+        cached = _get_cached_quota_class(class_name)
+        if cached is None:
+            result[key] = {'class_name': class_name}
+            uncached_classes.append(class_name)
+        else:
+            result[key] = cached
+
+    quotas = models.Quotas.__table__
+    selects = [sql.select([sql.literal('quotas').label('kind'),
+                           quotas.c.project_id.label('name'),
+                           quotas.c.resource,
+                           quotas.c.hard_limit.label('value'),
+                           quotas.c.allocated.label('extra')]).where(
+        sql.and_(quotas.c.project_id == project_id,
+                 quotas.c.deleted == sql.false()))]
+    if usages:
+        quota_usages = models.QuotaUsages.__table__
+        selects.append(sql.select([sql.literal('usages'),
+                                   quota_usages.c.project_id,
+                                   quota_usages.c.resource,
+                                   quota_usages.c.in_use,
+                                   quota_usages.c.reserved]).where(
+            sql.and_(quota_usages.c.project_id == project_id,
+                     quota_usages.c.deleted == sql.false())))
+    if uncached_classes:
+        quota_classes = models.QuotaClasses.__table__
+        selects.append(sql.select([sql.literal('classes'),
+                                   quota_classes.c.class_name,
+                                   quota_classes.c.resource,
+                                   quota_classes.c.hard_limit,
+                                   sql.null()]).where(
+            sql.and_(quota_classes.c.class_name.in_(uncached_classes),
+                     quota_classes.c.deleted == sql.false())))
+
+    for row in context.session.execute(sql.union_all(*selects)):
+        if row['kind'] == 'quotas':
+            result['quotas'][row['resource']] = row['value']
+            result['allocated'][row['resource']] = row['extra']
+        elif row['kind'] == 'usages':
+            result['usages'][row['resource']] = dict(in_use=row['value'],
+                                                     reserved=row['extra'])
+        else:
+            result[class_keys[row['name']]][row['resource']] = row['value']
+
+    for class_name in uncached_classes:
+        _cache_quota_class(class_name, result[class_keys[class_name]])
+    return result
+
+
+def _quota_project_ids(context, marker, limit):
+    """Return sorted ids of projects having limits or usages after marker."""
+    quotas = models.Quotas.__table__
+    quota_usages = models.QuotaUsages.__table__
+    project_ids = sql.union(
+        sql.select([quotas.c.project_id.label('project_id')]).where(
+            quotas.c.deleted == sql.false()),
+        sql.select([quota_usages.c.project_id]).where(
+            quota_usages.c.deleted == sql.false())).alias('project_ids')
+    query = sql.select([project_ids.c.project_id])
+    if marker is not None:
+        query = query.where(project_ids.c.project_id > marker)
+    query = query.order_by(project_ids.c.project_id).limit(limit)
+    return [row[0] for row in context.session.execute(query)]
+
+
+def _quota_project_id_batches(context, project_ids, batch_size):
+    if project_ids is not None:
+        project_ids = sorted(set(project_ids))
+        for start in xrange(0, len(project_ids), batch_size):
+            yield project_ids[start:start + batch_size]
+        return
+
+    marker = None
+    while True:
+        batch = _quota_project_ids(context, marker, batch_size)
+        if batch:
+            yield batch
+        if len(batch) < batch_size:
+            return
+        marker = batch[-1]
+
+
+@require_admin_context
+def quota_load_all_projects(context, project_ids=None, usages=True,
+                            batch_size=1000):
+    """Iterate limits and usages of many projects.
+
+    Projects are processed batch_size at a time, limits, allocated quotas
+    and usages of one batch are read with one UNION ALL query, so the
+    results can be streamed without loading all the projects in memory.
+
+    :param project_ids: ids of the projects to load, projects having limits
+                        or usages are loaded if not specified
+    :param usages: whether usages of the projects are loaded
+    :return: an iterator of (project_id, dict) sorted by project id, the
+             dict has keys 'quotas', 'allocated' and 'usages' in the same
+             format as the result of quota_load_all_by_project
+    """
+    quotas = models.Quotas.__table__
+    quota_usages = models.QuotaUsages.__table__
+
+    for batch in _quota_project_id_batches(context, project_ids, batch_size):
+        result = dict((project_id, {
+            'quotas': {'project_id': project_id},
+            'allocated': {'project_id': project_id},
+            'usages': {'project_id': project_id}}) for project_id in batch)
+        selects = [sql.select([sql.literal('quotas').label('kind'),
+                               quotas.c.project_id,
+                               quotas.c.resource,
+                               quotas.c.hard_limit.label('value'),
+                               quotas.c.allocated.label('extra')]).where(
+            sql.and_(quotas.c.project_id.in_(batch),
+                     quotas.c.deleted == sql.false()))]
+        if usages:
+            selects.append(sql.select([sql.literal('usages'),
+                                       quota_usages.c.project_id,
+                                       quota_usages.c.resource,
+                                       quota_usages.c.in_use,
+                                       quota_usages.c.reserved]).where(
+                sql.and_(quota_usages.c.project_id.in_(batch),
+                         quota_usages.c.deleted == sql.false())))
+
+        for row in context.session.execute(sql.union_all(*selects)):
+            project = result[row['project_id']]
+            if row['kind'] == 'quotas':
+                project['quotas'][row['resource']] = row['value']
+                project['allocated'][row['resource']] = row['extra']
+            else:
+                project['usages'][row['resource']] = dict(
+                    in_use=row['value'], reserved=row['extra'])
+
+        for project_id in batch:
+            yield project_id, result[project_id]
 
 
 @require_context
@@ -431,6 +855,10 @@ def quota_class_get(context, class_name, resource):
 
 
 def quota_class_get_default(context):
+    result = _get_cached_quota_class(_DEFAULT_QUOTA_NAME)
+    if result is not None:
+        return result
+
     rows = model_query(context, models.QuotaClasses,
                        read_deleted="no").\
         filter_by(class_name=_DEFAULT_QUOTA_NAME).all()
@@ -439,6 +867,7 @@ def quota_class_get_default(context):
     for row in rows:
         result[row.resource] = row.hard_limit
 
+    _cache_quota_class(_DEFAULT_QUOTA_NAME, result)
     return result
 
 
@@ -446,6 +875,10 @@ def quota_class_get_default(context):
 def quota_class_get_all_by_name(context, class_name):
     authorize_quota_class_context(context, class_name)
 
+    result = _get_cached_quota_class(class_name)
+    if result is not None:
+        return result
+
     rows = model_query(context, models.QuotaClasses, read_deleted="no").\
         filter_by(class_name=class_name).\
         all()
@@ -454,6 +887,7 @@ def quota_class_get_all_by_name(context, class_name):
     for row in rows:
         result[row.resource] = row.hard_limit
 
+    _cache_quota_class(class_name, result)
     return result
 
 
@@ -465,32 +899,35 @@ def quota_class_create(context, class_name, resource, limit):
     quota_class_ref.hard_limit = limit
 
     session = core.get_session()
-    with session.begin():
+    with session.begin(subtransactions=True):
         quota_class_ref.save(session)
-        return quota_class_ref
+    invalidate_quota_class_cache(class_name)
+    return quota_class_ref
 
 
 @require_admin_context
 def quota_class_update(context, class_name, resource, limit):
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         quota_class_ref = _quota_class_get(context, class_name, resource,
                                            session=context.session)
         quota_class_ref.hard_limit = limit
+    invalidate_quota_class_cache(class_name)
 
-        return quota_class_ref
+    return quota_class_ref
 
 
 @require_admin_context
 def quota_class_destroy(context, class_name, resource):
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         quota_class_ref = _quota_class_get(context, class_name, resource,
                                            session=context.session)
         quota_class_ref.delete(session=context.session)
+    invalidate_quota_class_cache(class_name)
 
 
 @require_admin_context
 def quota_class_destroy_all_by_name(context, class_name):
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         quota_classes = model_query(context, models.QuotaClasses,
                                     session=context.session,
                                     read_deleted="no").\
@@ -499,6 +936,7 @@ def quota_class_destroy_all_by_name(context, class_name):
 
         for quota_class_ref in quota_classes:
             quota_class_ref.delete(session=context.session)
+    invalidate_quota_class_cache(class_name)
 
 
 @require_context
@@ -530,38 +968,73 @@ def quota_usage_get_all_by_project(context, project_id):
 
 
 @require_admin_context
-def _quota_usage_create(context, project_id, resource, in_use, reserved,
-                        until_refresh, session=None):
-
-    quota_usage_ref = models.QuotaUsages()
-    quota_usage_ref.project_id = project_id
-    quota_usage_ref.resource = resource
-    quota_usage_ref.in_use = in_use
-    quota_usage_ref.reserved = reserved
-    quota_usage_ref.until_refresh = until_refresh
-    quota_usage_ref.save(session=session)
-
-    return quota_usage_ref
+def _quota_usages_create(context, project_id, resources, until_refresh,
+                         session=None):
+    """Create usages of the given resources in one statement.
 
-
-def _reservation_create(context, uuid, usage, project_id, resource, delta,
-                        expire, session=None):
-    reservation_ref = models.Reservation()
-    reservation_ref.uuid = uuid
-    reservation_ref.usage_id = usage['id']
-    reservation_ref.project_id = project_id
-    reservation_ref.resource = resource
-    reservation_ref.delta = delta
-    reservation_ref.expire = expire
-    reservation_ref.save(session=session)
-
-    return reservation_ref
+    Returns the created usages keyed by resource, locked for update.
+    """
+    session = session or context.session
+    now = timeutils.utcnow()
+    rows = [{'project_id': project_id,
+             'resource': resource,
+             'in_use': 0,
+             'reserved': 0,
+             'until_refresh': until_refresh,
+             'created_at': now,
+             'deleted': False} for resource in sorted(resources)]
+    session.execute(models.QuotaUsages.__table__.insert().values(rows))
+    return _get_quota_usages_by_resources(context, session, project_id,
+                                          resources)
+
+
+def _reservations_create(context, project_id, usages, deltas, expire,
+                         session=None):
+    """Create reservations of the given deltas in one statement.
+
+    Returns uuids of the created reservations.
+    """
+    session = session or context.session
+    now = timeutils.utcnow()
+    rows = [{'uuid': str(uuid.uuid4()),
+             'usage_id': usages[resource]['id'],
+             'project_id': project_id,
+             'resource': resource,
+             'delta': delta,
+             'expire': expire,
+             'created_at': now,
+             'deleted': False} for resource, delta in deltas.items()]
+    if rows:
+        session.execute(models.Reservation.__table__.insert().values(rows))
+    return [row['uuid'] for row in rows]
+
+
+def _quota_usages_add_reserved(context, usages, deltas, session=None):
+    """Add deltas to the reserved count of usages in one statement."""
+    session = session or context.session
+    deltas = dict((usages[resource]['id'], delta)
+                  for resource, delta in deltas.items())
+    if not deltas:
+        return
+    table = models.QuotaUsages.__table__
+    session.execute(
+        table.update().where(table.c.id.in_(deltas.keys())).values(
+            reserved=table.c.reserved + sql.case(deltas, value=table.c.id),
+            updated_at=timeutils.utcnow()))
+    # keep loaded usages consistent with the database without marking them
+    # dirty, otherwise the reserved count would be flushed again
+    for usage in usages.values():
+        if usage['id'] in deltas:
+            set_committed_value(usage, 'reserved',
+                                usage['reserved'] + deltas[usage['id']])
 
 
 # NOTE(johannes): The quota code uses SQL locking to ensure races don't
 # cause under or over counting of resources. To avoid deadlocks, this
 # code always acquires the lock on quota_usages before acquiring the lock
-# on reservations.
+# on reservations. Usage rows are always locked in the order of resource
+# name, so two transactions locking overlapping usages can not wait for
+# each other.
 
 def _get_quota_usages(context, session, project_id):
     # Broken out for testability
@@ -569,18 +1042,22 @@ def _get_quota_usages(context, session, project_id):
                        read_deleted="no",
                        session=session).\
         filter_by(project_id=project_id).\
+        order_by(models.QuotaUsages.resource).\
         with_lockmode('update').\
         all()
     return {row.resource: row for row in rows}
 
 
-def _get_quota_usages_by_resource(context, session, project_id, resource):
+def _get_quota_usages_by_resources(context, session, project_id, resources):
     # TODO(joehuang), add user_id as part of the filter
+    if not resources:
+        return {}
     rows = model_query(context, models.QuotaUsages,
                        read_deleted="no",
                        session=session).\
         filter_by(project_id=project_id).\
-        filter_by(resource=resource).\
+        filter(models.QuotaUsages.resource.in_(sorted(resources))).\
+        order_by(models.QuotaUsages.resource).\
         with_lockmode('update').\
         all()
     return {row.resource: row for row in rows}
@@ -591,12 +1068,20 @@ def _get_quota_usages_by_resource(context, session, project_id, resource):
 def quota_reserve(context, resources, quotas, deltas, expire,
                   until_refresh, max_age, project_id=None):
     elevated = context.elevated()
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         if project_id is None:
             project_id = context.project_id
 
-        # Get the current usages
-        usages = _get_quota_usages(context, context.session, project_id)
+        # Get and lock the current usages of the resources to reserve only
+        usages = _get_quota_usages_by_resources(context, context.session,
+                                                project_id, deltas.keys())
+
+        # Create the missing usages at once, they are refreshed below
+        missing = set(deltas.keys()) - set(usages.keys())
+        if missing:
+            usages.update(_quota_usages_create(elevated, project_id, missing,
+                                               until_refresh or None,
+                                               session=context.session))
 
         # Handle usage refresh
         refresh = False
@@ -605,13 +1090,7 @@ def quota_reserve(context, resources, quotas, deltas, expire,
             resource = work.pop()
 
             # Do we need to refresh the usage?
-            if resource not in usages:
-                usages[resource] = _quota_usage_create(elevated,
-                                                       project_id,
-                                                       resource,
-                                                       0, 0,
-                                                       until_refresh or None,
-                                                       session=context.session)
+            if resource in missing:
                 refresh = True
             elif usages[resource].in_use < 0:
                 # Negative in_use count indicates a desync, so try to
@@ -627,10 +1106,17 @@ def quota_reserve(context, resources, quotas, deltas, expire,
                 refresh = True
 
             if refresh:
-                # no actural usage refresh here
-
-                # refresh from the bottom pod
-                usages[resource].until_refresh = until_refresh or None
+                # NOTE: counting resources in bottom pods for each
+                # reservation is too expensive, xjob periodically counts
+                # them and we refresh from the latest count. A count
+                # started before the usage last changed misses the change,
+                # so it is not applied
+                usage = usages[resource]
+                if usage.synced_in_use is not None and usage.synced_at and (
+                        usage.synced_at >
+                        (usage.updated_at or usage.created_at)):
+                    usage.in_use = usage.synced_in_use
+                usage.until_refresh = until_refresh or None
 
                 # Because more than one resource may be refreshed
                 # by the call to the sync routine, and we don't
@@ -666,30 +1152,26 @@ def quota_reserve(context, resources, quotas, deltas, expire,
 
         # Create the reservations
         if not overs:
-            reservations = []
-            for resource, delta in deltas.items():
-                reservation = _reservation_create(elevated,
-                                                  str(uuid.uuid4()),
-                                                  usages[resource],
-                                                  project_id,
-                                                  resource, delta, expire,
-                                                  session=context.session)
-                reservations.append(reservation.uuid)
-
-                # Also update the reserved quantity
-                # NOTE(Vek): Again, we are only concerned here about
-                #            positive increments.  Here, though, we're
-                #            worried about the following scenario:
-                #
-                #            1) User initiates resize down.
-                #            2) User allocates a new instance.
-                #            3) Resize down fails or is reverted.
-                #            4) User is now over quota.
-                #
-                #            To prevent this, we only update the
-                #            reserved value if the delta is positive.
-                if delta > 0:
-                    usages[resource].reserved += delta
+            reservations = _reservations_create(elevated, project_id,
+                                                usages, deltas, expire,
+                                                session=context.session)
+
+            # Also update the reserved quantity
+            # NOTE(Vek): Again, we are only concerned here about
+            #            positive increments.  Here, though, we're
+            #            worried about the following scenario:
+            #
+            #            1) User initiates resize down.
+            #            2) User allocates a new instance.
+            #            3) Resize down fails or is reverted.
+            #            4) User is now over quota.
+            #
+            #            To prevent this, we only update the
+            #            reserved value if the delta is positive.
+            _quota_usages_add_reserved(
+                elevated, usages,
+                dict((r, delta) for r, delta in deltas.items() if delta > 0),
+                session=context.session)
 
     if unders:
         LOG.warning(_LW("Change will make usage less than 0 for the following "
@@ -703,6 +1185,160 @@ def quota_reserve(context, resources, quotas, deltas, expire,
     return reservations
 
 
+@require_admin_context
+def count_resource_routings(context, resource_types):
+    """Count bound top resources of each project.
+
+    :return: a dict like {project_id: {resource_type: count}}
+    """
+    routing = models.ResourceRouting
+    rows = context.session.query(
+        routing.project_id, routing.resource_type,
+        sql.func.count(sql.distinct(routing.top_id))).\
+        filter(routing.resource_type.in_(resource_types)).\
+        filter(routing.bottom_id.isnot(None)).\
+        filter(routing.project_id.isnot(None)).\
+        group_by(routing.project_id, routing.resource_type)
+    result = {}
+    for project_id, resource_type, count in rows:
+        result.setdefault(project_id, {})[resource_type] = count
+    return result
+
+
+@require_admin_context
+def get_resource_routing_pod_types(context, resource_types):
+    """Get pods having bound resources of the given types.
+
+    :return: a set of (pod_id, resource_type)
+    """
+    routing = models.ResourceRouting
+    rows = context.session.query(routing.pod_id, routing.resource_type).\
+        filter(routing.resource_type.in_(resource_types)).\
+        filter(routing.bottom_id.isnot(None)).\
+        distinct()
+    return set((pod_id, resource_type) for pod_id, resource_type in rows)
+
+
+@require_admin_context
+def delete_resource_routings(context, routing_ids, batch_size=500):
+    """Delete routing entries, batch_size entries in one transaction.
+
+    :return: number of deleted entries
+    """
+    deleted = 0
+    for start in xrange(0, len(routing_ids), batch_size):
+        with context.session.begin(subtransactions=True):
+            deleted += context.session.query(models.ResourceRouting).\
+                filter(models.ResourceRouting.id.in_(
+                    routing_ids[start:start + batch_size])).\
+                delete(synchronize_session=False)
+    return deleted
+
+
+@require_admin_context
+def delete_unbound_resource_routings(context, created_before):
+    """Delete routing entries whose bottom resources are never created.
+
+    :param created_before: only entries created before this time are
+                           deleted
+    :return: number of deleted entries
+    """
+    with context.session.begin(subtransactions=True):
+        return context.session.query(models.ResourceRouting).\
+            filter(models.ResourceRouting.bottom_id.is_(None)).\
+            filter(models.ResourceRouting.created_at < created_before).\
+            delete(synchronize_session=False)
+
+
+@require_admin_context
+@_retry_on_deadlock
+def _quota_usages_sync_batch(context, resources, in_use_by_project,
+                             counted_at):
+    with context.session.begin(subtransactions=True):
+        usages = model_query(context, models.QuotaUsages,
+                             read_deleted="no",
+                             session=context.session).\
+            filter(models.QuotaUsages.project_id.in_(
+                in_use_by_project.keys())).\
+            filter(models.QuotaUsages.resource.in_(resources)).\
+            order_by(models.QuotaUsages.project_id,
+                     models.QuotaUsages.resource).\
+            with_lockmode('update').\
+            all()
+
+        changed = 0
+        existing = set()
+        for usage in usages:
+            existing.add((usage.project_id, usage.resource))
+            in_use = in_use_by_project[usage.project_id].get(
+                usage.resource, 0)
+            if usage.synced_in_use != in_use:
+                changed += 1
+            # updated_at is kept, it tells whether the usage changes after
+            # the count starts
+            context.session.query(models.QuotaUsages).\
+                filter_by(id=usage.id).\
+                update({'synced_in_use': in_use,
+                        'synced_at': counted_at,
+                        'updated_at': models.QuotaUsages.updated_at},
+                       synchronize_session=False)
+
+        now = timeutils.utcnow()
+        rows = []
+        for project_id in sorted(in_use_by_project):
+            for resource in sorted(resources):
+                in_use = in_use_by_project[project_id].get(resource, 0)
+                if in_use and (project_id, resource) not in existing:
+                    rows.append({'project_id': project_id,
+                                 'resource': resource,
+                                 'in_use': in_use,
+                                 'reserved': 0,
+                                 'synced_in_use': in_use,
+                                 'synced_at': counted_at,
+                                 'created_at': now,
+                                 'deleted': False})
+        if rows:
+            context.session.execute(
+                models.QuotaUsages.__table__.insert().values(rows))
+        return changed + len(rows)
+
+
+@require_admin_context
+def quota_usages_sync(context, resources, in_use_by_project, counted_at,
+                      batch_size=100):
+    """Record in_use counted from bottom pods.
+
+    The counts are saved as synced_in_use of the usages and copied to
+    in_use when quota_reserve refreshes the usages, unless the usages are
+    changed after counted_at. Usages of the given
+    resources not found in in_use_by_project are counted as 0. Usages are
+    created for projects using resources but never reserving quota.
+    Projects are processed batch_size at a time, each batch in its own
+    transaction.
+
+    :param resources: names of the counted resources
+    :param in_use_by_project: a dict like {project_id: {resource: in_use}}
+    :param counted_at: time when counting of the resources starts
+    :return: number of usages changed or created
+    """
+    project_ids = set(in_use_by_project.keys())
+    rows = model_query(context, models.QuotaUsages.project_id,
+                       read_deleted="no").\
+        filter(models.QuotaUsages.resource.in_(resources)).\
+        distinct().all()
+    project_ids.update([row[0] for row in rows])
+    project_ids = sorted(project_ids)
+
+    changed = 0
+    for start in xrange(0, len(project_ids), batch_size):
+        batch = dict(
+            (project_id, in_use_by_project.get(project_id, {}))
+            for project_id in project_ids[start:start + batch_size])
+        changed += _quota_usages_sync_batch(context, resources, batch,
+                                            counted_at)
+    return changed
+
+
 def _quota_reservations(session, context, reservations):
     """Return the relevant reservations."""
 
@@ -718,7 +1354,7 @@ def _quota_reservations(session, context, reservations):
 @require_context
 @_retry_on_deadlock
 def reservation_commit(context, reservations, project_id=None):
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         usages = _get_quota_usages(context, context.session, project_id)
 
         for reservation in _quota_reservations(context.session,
@@ -735,7 +1371,7 @@ def reservation_commit(context, reservations, project_id=None):
 @require_context
 @_retry_on_deadlock
 def reservation_rollback(context, reservations, project_id=None):
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         usages = _get_quota_usages(context, context.session, project_id)
 
         for reservation in _quota_reservations(context.session,
@@ -768,7 +1404,7 @@ def quota_destroy_all_by_project(context, project_id, only_quotas=False):
     :param project_id: The ID of the project being deleted.
     :param only_quotas: Only delete limit quotas, leave other types intact.
     """
-    with context.session.begin():
+    with context.session.begin(subtransactions=True):
         quotas = model_query(context, models.Quotas, session=context.session,
                              read_deleted="no").\
             filter_by(project_id=project_id).\
@@ -777,43 +1413,104 @@ def quota_destroy_all_by_project(context, project_id, only_quotas=False):
         for quota_ref in quotas:
             quota_ref.delete(session=context.session)
 
-        if only_quotas:
-            return
+        if not only_quotas:
+            quota_usages = model_query(context, models.QuotaUsages,
+                                       session=context.session,
+                                       read_deleted="no").\
+                filter_by(project_id=project_id).\
+                all()
 
-        quota_usages = model_query(context, models.QuotaUsages,
-                                   session=context.session,
-                                   read_deleted="no").\
-            filter_by(project_id=project_id).\
-            all()
+            for quota_usage_ref in quota_usages:
+                quota_usage_ref.delete(session=context.session)
+
+            reservations = model_query(context, models.Reservation,
+                                       session=context.session,
+                                       read_deleted="no").\
+                filter_by(project_id=project_id).\
+                all()
+
+            for reservation_ref in reservations:
+                reservation_ref.delete(session=context.session)
+    _bump_quota_limits_version()
 
-        for quota_usage_ref in quota_usages:
-            quota_usage_ref.delete(session=context.session)
 
-        reservations = model_query(context, models.Reservation,
+@_retry_on_deadlock
+def _reservation_expire_batch(context, current_time, batch_size):
+    with context.session.begin(subtransactions=True):
+        candidates = model_query(context, models.Reservation.id,
+                                 models.Reservation.usage_id,
+                                 session=context.session,
+                                 read_deleted="no").\
+            filter(models.Reservation.expire < current_time).\
+            order_by(models.Reservation.expire).\
+            limit(batch_size).\
+            all()
+        if not candidates:
+            return 0, 0
+
+        # follow the lock order of quota_reserve, usages first and sorted by
+        # resource, then the reservations
+        usage_ids = set([usage_id for _id, usage_id in candidates])
+        model_query(context, models.QuotaUsages.id,
+                    session=context.session,
+                    read_deleted="no").\
+            filter(models.QuotaUsages.id.in_(usage_ids)).\
+            order_by(models.QuotaUsages.project_id,
+                     models.QuotaUsages.resource).\
+            with_lockmode('update').\
+            all()
+        # reservations may be committed or rolled back after selected
+        reservations = model_query(context, models.Reservation.id,
+                                   models.Reservation.usage_id,
+                                   models.Reservation.delta,
                                    session=context.session,
                                    read_deleted="no").\
-            filter_by(project_id=project_id).\
+            filter(models.Reservation.id.in_(
+                [_id for _id, _usage_id in candidates])).\
+            with_lockmode('update').\
             all()
-
-        for reservation_ref in reservations:
-            reservation_ref.delete(session=context.session)
+        if not reservations:
+            return len(candidates), 0
+
+        # one usage row per (project, resource), so adjustments are summed
+        # by usage id and applied in one statement
+        deltas = {}
+        for _id, usage_id, delta in reservations:
+            if delta >= 0:
+                deltas[usage_id] = deltas.get(usage_id, 0) + delta
+        if deltas:
+            usages = models.QuotaUsages.__table__
+            context.session.execute(
+                usages.update().where(usages.c.id.in_(deltas.keys())).values(
+                    reserved=usages.c.reserved - sql.case(
+                        deltas, value=usages.c.id),
+                    updated_at=current_time))
+
+        reservation_table = models.Reservation.__table__
+        context.session.execute(
+            reservation_table.update().where(
+                reservation_table.c.id.in_(
+                    [_id for _id, _usage_id, _delta in reservations])).values(
+                deleted=True, deleted_at=current_time))
+        return len(candidates), len(reservations)
 
 
 @require_admin_context
-@_retry_on_deadlock
-def reservation_expire(context):
-    with context.session.begin():
-        current_time = timeutils.utcnow()
-        results = model_query(context, models.Reservation,
-                              session=context.session,
-                              read_deleted="no").\
-            filter(models.Reservation.expire < current_time).\
-            all()
+def reservation_expire(context, batch_size=None):
+    """Roll back expired reservations.
 
-        if results:
-            for reservation in results:
-                if reservation.delta >= 0:
-                    reservation.usage.reserved -= reservation.delta
-                    reservation.usage.save(session=context.session)
+    Expired reservations are processed in batches of batch_size, each batch
+    in its own transaction, so usage rows are not locked for long.
 
-                reservation.delete(session=context.session)
+    :returns: number of reservations expired
+    """
+    if not batch_size:
+        batch_size = CONF.quota.reservation_expire_batch_size
+    current_time = timeutils.utcnow()
+    total = 0
+    while True:
+        selected, expired = _reservation_expire_batch(context, current_time,
+                                                      batch_size)
+        total += expired
+        if selected < batch_size:
+            return total
@@ -16,7 +16,9 @@
 
 import threading
 
+import six
 import sqlalchemy as sql
+from sqlalchemy.ext import baked
 from sqlalchemy.ext import declarative
 from sqlalchemy.inspection import inspect
 
@@ -32,12 +34,136 @@ from tricircle.common import exceptions
 db_opts = [
     cfg.StrOpt('tricircle_db_connection',
                help='db connection string for tricircle'),
+    cfg.IntOpt('tricircle_db_max_pool_size',
+               help='Maximum number of connections to keep open in the '
+                    'connection pool of each worker, [database] '
+                    'max_pool_size is used if not set'),
+    cfg.IntOpt('tricircle_db_max_overflow',
+               help='Number of connections which can be opened beyond '
+                    'tricircle_db_max_pool_size in each worker when the '
+                    'pool is exhausted, [database] max_overflow is used if '
+                    'not set'),
+    cfg.IntOpt('tricircle_db_pool_timeout',
+               help='Seconds to wait for a free connection before raising '
+                    'an error, [database] pool_timeout is used if not set'),
+    cfg.IntOpt('tricircle_db_pool_recycle',
+               help='Seconds after which a pooled connection is recycled, '
+                    'should be shorter than the idle timeout of the '
+                    'database server, [database] idle_timeout is used if '
+                    'not set'),
+    cfg.IntOpt('tricircle_db_warmup_connections',
+               default=1,
+               help='Number of connections opened by each worker right '
+                    'after it is started, so the first requests do not '
+                    'pay engine creation and connecting'),
+    cfg.IntOpt('tricircle_db_pool_stats_interval',
+               default=0,
+               help='Seconds between two logs of the connection pool '
+                    'statistics of each API worker, including connections '
+                    'checked out, overflow, connections opened and the peak '
+                    'of connections in use. Set to 0 to disable the logs'),
 ]
 cfg.CONF.register_opts(db_opts)
 
 _LOCK = threading.Lock()
 _engine_facade = None
+# connection checkout statistics of the pool in this process
+_pool_stats = {'checkouts': 0,
+               'connects': 0,
+               'in_use': 0,
+               'max_in_use': 0}
 ModelBase = declarative.declarative_base()
+# model -> _ModelInfo, built the first time the model is queried
+_model_infos = {}
+# compiled queries, keyed by model, filtered columns and sort columns
+_bakery = baked.bakery()
+
+
+class _ModelInfo(object):
+    """Attributes of a model precomputed for building queries"""
+
+    __slots__ = ('attributes', 'boolean_keys', 'columns')
+
+    def __init__(self, model):
+        mapper = inspect(model)
+        column_keys = set(mapper.column_attrs.keys())
+        self.attributes = frozenset(model.attributes)
+        self.boolean_keys = frozenset(
+            key for key in model.attributes
+            if isinstance(mapper.columns[key].type, sql.Boolean))
+        # resources can be built straight from result rows only if all the
+        # attributes are columns
+        if column_keys.issuperset(model.attributes):
+            self.columns = tuple(getattr(model, key)
+                                 for key in model.attributes)
+        else:
+            self.columns = None
+
+
+def _get_model_info(model):
+    info = _model_infos.get(model)
+    if not info:
+        info = _model_infos[model] = _ModelInfo(model)
+    return info
+
+
+# NOTE: value of "is_null" filter is a bool telling whether the
+# attribute should be null, value of "in" filter is a list
+_FILTER_COMPARATORS = ('eq', 'ne', 'lt', 'gt', 'like', 'in', 'is_null')
+
+
+def _get_filter_specs(model, filters):
+    """Normalize filters to (key, comparator, value) tuples
+
+    Filters on unknown attributes or with unsupported comparators are
+    ignored. Values of boolean attributes are converted to bool.
+    """
+    info = _get_model_info(model)
+    specs = []
+    for query_filter in filters:
+        comparator = query_filter['comparator']
+        key = query_filter['key']
+        if comparator not in _FILTER_COMPARATORS or (
+                key not in info.attributes):
+            continue
+        value = query_filter['value']
+        if comparator == 'is_null':
+            value = strutils.bool_from_string(value)
+        elif comparator == 'in':
+            value = list(value)
+            if key in info.boolean_keys:
+                value = [strutils.bool_from_string(v) for v in value]
+        elif key in info.boolean_keys and value is not None:
+            value = strutils.bool_from_string(value)
+        specs.append((key, comparator, value))
+    return specs
+
+
+def _get_filter_shape(comparator, value):
+    # values changing the SQL statement are part of the query shape
+    if comparator in ('eq', 'ne'):
+        return value is None
+    if comparator == 'is_null':
+        return value
+    return None
+
+
+def _build_filter_clause(model, key, comparator, shape, value):
+    column = getattr(model, key)
+    if comparator == 'eq':
+        return column.is_(None) if shape else column == value
+    if comparator == 'ne':
+        return column.isnot(None) if shape else column != value
+    if comparator == 'lt':
+        return column < value
+    if comparator == 'gt':
+        return column > value
+    if comparator == 'like':
+        return column.like(value)
+    if comparator == 'in':
+        return column.in_(value) if value else sql.false()
+    # is_null
+    return column.is_(None) if shape else column.isnot(None)
 
 
 def _filter_query(model, query, filters):
@@ -46,26 +172,90 @@ def _filter_query(model, query, filters):
     :param model:
     :param query:
     :param filters: list of filter dict with key 'key', 'comparator', 'value'
-    like {'key': 'pod_id', 'comparator': 'eq', 'value': 'test_pod_uuid'}
+    like {'key': 'pod_id', 'comparator': 'eq', 'value': 'test_pod_uuid'},
+    supported comparators are 'eq', 'ne', 'lt', 'gt', 'like', 'in' and
+    'is_null'
     :return:
     """
-    filter_dict = {}
-    for query_filter in filters:
-        # only eq filter supported at first
-        if query_filter['comparator'] != 'eq':
-            continue
+    for key, comparator, value in _get_filter_specs(model, filters):
+        query = query.filter(_build_filter_clause(
+            model, key, comparator, _get_filter_shape(comparator, value),
+            value))
+    return query
 
-        key = query_filter['key']
-        if key not in model.attributes:
-            continue
-        if isinstance(inspect(model).columns[key].type, sql.Boolean):
-            filter_dict[key] = strutils.bool_from_string(query_filter['value'])
-        else:
-            filter_dict[key] = query_filter['value']
-    if filter_dict:
-        return query.filter_by(**filter_dict)
-    else:
-        return query
+
+def _get_sort_keys(model, sorts):
+    """Get (attribute name, ascending) pairs of sorts
+
+    :return: the pairs, or None if some sort key is not an attribute of the
+             model, like an expression
+    """
+    info = _get_model_info(model)
+    sort_keys = []
+    for sort_key, sort_dir in sorts:
+        if not isinstance(sort_key, six.string_types):
+            if getattr(sort_key, 'class_', None) is not model:
+                return None
+            sort_key = sort_key.key
+        if sort_key not in info.attributes:
+            return None
+        sort_keys.append((sort_key, bool(sort_dir)))
+    return tuple(sort_keys)
+
+
+def _build_column_query(session, model, filter_shapes, sort_keys):
+    query = session.query(*_get_model_info(model).columns)
+    for i, (key, comparator, shape) in enumerate(filter_shapes):
+        query = query.filter(_build_filter_clause(
+            model, key, comparator, shape, sql.bindparam('f%d' % i)))
+    return _sort_query(model, query, sort_keys)
+
+
+def _sort_query(model, query, sort_keys):
+    for key, sort_dir in sort_keys:
+        sort_dir_func = sql.asc if sort_dir else sql.desc
+        query = query.order_by(sort_dir_func(getattr(model, key)))
+    return query
+
+
+def _get_baked_query(model, filter_shapes, sort_keys):
+    return _bakery(
+        lambda session: _build_column_query(session, model, filter_shapes,
+                                            sort_keys),
+        model, filter_shapes, sort_keys)
+
+
+def _paginate_query(context, model, query, sort_keys, limit, marker):
+    """Apply keyset pagination to query
+
+    Primary key columns are appended to sort keys so the order is unique,
+    rows sorted after the row whose primary key is marker are returned.
+    """
+    pk_keys = [column.key for column in inspect(model).primary_key]
+    sort_keys = list(sort_keys)
+    sorted_keys = set(key for key, _ in sort_keys)
+    sort_keys.extend((key, True) for key in pk_keys if key not in sorted_keys)
+    query = _sort_query(model, query, sort_keys)
+
+    if marker is not None:
+        marker_row = context.session.query(
+            *[getattr(model, key) for key, _ in sort_keys]).filter(
+                getattr(model, pk_keys[0]) == marker).first()
+        if not marker_row:
+            raise exceptions.ResourceNotFound(model, marker)
+        # (k1 > v1) or (k1 == v1 and k2 > v2) or ...
+        criteria = []
+        for i, (key, sort_dir) in enumerate(sort_keys):
+            clauses = [getattr(model, prev_key) == marker_row[j]
+                       for j, (prev_key, _) in enumerate(sort_keys[:i])]
+            column = getattr(model, key)
+            clauses.append(column > marker_row[i] if sort_dir
+                           else column < marker_row[i])
+            criteria.append(sql.and_(*clauses))
+        query = query.filter(sql.or_(*criteria))
+    if limit:
+        query = query.limit(limit)
+    return query
 
 
 def _get_engine_facade():
@@ -75,11 +265,86 @@ def _get_engine_facade():
 
         if not _engine_facade:
             t_connection = cfg.CONF.tricircle_db_connection
+            # NOTE: oslo.db pings the database every time a
+            # connection is checked out, stale connections are replaced
+            # transparently
+            pool_args = {}
+            for arg, opt in (('max_pool_size', 'tricircle_db_max_pool_size'),
+                             ('max_overflow', 'tricircle_db_max_overflow'),
+                             ('pool_timeout', 'tricircle_db_pool_timeout'),
+                             ('idle_timeout', 'tricircle_db_pool_recycle')):
+                if cfg.CONF[opt] is not None:
+                    pool_args[arg] = cfg.CONF[opt]
             _engine_facade = db_session.EngineFacade(t_connection,
-                                                     _conf=cfg.CONF)
+                                                     _conf=cfg.CONF,
+                                                     **pool_args)
+            _instrument_pool(_engine_facade.get_engine().pool)
         return _engine_facade
 
 
+def _on_pool_connect(dbapi_connection, connection_record):
+    _pool_stats['connects'] += 1
+
+
+def _on_pool_checkout(dbapi_connection, connection_record, connection_proxy):
+    _pool_stats['checkouts'] += 1
+    _pool_stats['in_use'] += 1
+    _pool_stats['max_in_use'] = max(_pool_stats['max_in_use'],
+                                    _pool_stats['in_use'])
+
+
+def _on_pool_checkin(dbapi_connection, connection_record):
+    _pool_stats['in_use'] = max(_pool_stats['in_use'] - 1, 0)
+
+
+def _instrument_pool(pool):
+    # NOTE: listeners are copied to the new pool when engine.dispose()
+    # recreates the pool, so they are only added once
+    for name, listener in (('connect', _on_pool_connect),
+                           ('checkout', _on_pool_checkout),
+                           ('checkin', _on_pool_checkin)):
+        sql.event.listen(pool, name, listener)
+
+
+def get_pool_stats():
+    """Get statistics of the connection pool of this process
+
+    :return: a dict with the pool size, the number of connections checked
+             out, checked in and opened beyond the pool size, the number of
+             checkouts and of connections opened, and the max number of
+             connections in use at the same time. max_in_use reaching the
+             pool size plus overflow means requests wait for connections
+    """
+    pool = get_engine().pool
+    stats = dict(_pool_stats)
+    # NOTE: pools for sqlite do not support sizing
+    for key, method in (('size', 'size'),
+                        ('checked_out', 'checkedout'),
+                        ('checked_in', 'checkedin'),
+                        ('overflow', 'overflow')):
+        if hasattr(pool, method):
+            stats[key] = getattr(pool, method)()
+    return stats
+
+
+def warmup_engine():
+    """Create the engine and open connections in this process
+
+    Called in every worker right after fork. Connections inherited from the
+    parent process are discarded instead of being shared with it.
+    """
+    engine = get_engine()
+    engine.dispose()
+    _pool_stats.update(checkouts=0, connects=0, in_use=0, max_in_use=0)
+    connections = []
+    try:
+        for _ in xrange(cfg.CONF.tricircle_db_warmup_connections):
+            connections.append(engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+
+
 def _get_resource(context, model, pk_value):
     res_obj = context.session.query(model).get(pk_value)
     if not res_obj:
@@ -127,15 +392,87 @@ def initialize():
         connection='sqlite:///:memory:')
 
 
-def query_resource(context, model, filters, sorts):
+def query_resource(context, model, filters, sorts, limit=None, marker=None):
+    """Query resources
+
+    :param filters: list of filter dict, see _filter_query
+    :param sorts: list of (sort key, ascending) tuple
+    :param limit: max number of resources returned
+    :param marker: primary key of the last resource in the previous page,
+                   resources sorted after it are returned
+    :return: list of resource dict
+    """
+    info = _get_model_info(model)
+    sort_keys = _get_sort_keys(model, sorts)
+    specs = _get_filter_specs(model, filters)
+    if info.columns is not None and sort_keys is not None:
+        # NOTE: resources are built from rows without loading ORM
+        # objects. compiled query of each filter shape is cached, "in"
+        # filters and pagination change the statement with the values so
+        # they are not cached
+        attributes = model.attributes
+        if limit or marker is not None or any(
+                comparator == 'in' for _, comparator, _ in specs):
+            query = _filter_query(
+                model, context.session.query(*info.columns), filters)
+            query = _paginate_query(context, model, query, sort_keys,
+                                    limit, marker)
+            return [dict(zip(attributes, row)) for row in query]
+
+        filter_shapes = tuple(
+            (key, comparator, _get_filter_shape(comparator, value))
+            for key, comparator, value in specs)
+        params = dict(('f%d' % i, value)
+                      for i, (_, _, value) in enumerate(specs))
+        query = _get_baked_query(model, filter_shapes, sort_keys)
+        return [dict(zip(attributes, row))
+                for row in query(context.session).params(**params)]
+
+    if marker is not None:
+        raise exceptions.ValidationError(
+            msg='pagination needs sort keys to be attributes of %s' %
+            model.__name__)
     query = context.session.query(model)
     query = _filter_query(model, query, filters)
     for sort_key, sort_dir in sorts:
         sort_dir_func = sql.asc if sort_dir else sql.desc
         query = query.order_by(sort_dir_func(sort_key))
+    if limit:
+        query = query.limit(limit)
     return [obj.to_dict() for obj in query]
 
 
+def query_resource_iter(context, model, filters, sorts, limit=None,
+                        marker=None, batch_size=1000):
+    """Query resources in batches
+
+    Resources are read batch_size at a time with keyset pagination, so
+    only one batch is kept in memory when the result is consumed.
+
+    :param filters: list of filter dict, see _filter_query
+    :param sorts: list of (sort key, ascending) tuple, sort keys should be
+                  attributes of the model
+    :param limit: max number of resources returned
+    :param marker: primary key of the resource sorted before the first
+                   returned one
+    :param batch_size: number of resources read in one query
+    :return: iterator of resource dict
+    """
+    pk_key = inspect(model).primary_key[0].key
+    while limit is None or limit > 0:
+        num = batch_size if limit is None else min(batch_size, limit)
+        with context.session.begin(subtransactions=True):
+            resources = query_resource(context, model, filters, sorts,
+                                       limit=num, marker=marker)
+        for resource in resources:
+            yield resource
+        if len(resources) < num:
+            return
+        if limit is not None:
+            limit -= num
+        marker = resources[-1][pk_key]
+
+
 def update_resource(context, model, pk_value, update_dict):
     res_obj = _get_resource(context, model, pk_value)
     for key in update_dict:
@@ -0,0 +1,51 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+# All Rights Reserved
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import migrate
+import sqlalchemy as sql
+
+
+def upgrade(migrate_engine):
+    meta = sql.MetaData()
+    meta.bind = migrate_engine
+
+    extra_route_snapshot = sql.Table(
+        'extra_route_snapshot', meta,
+        sql.Column('id', sql.Integer, primary_key=True),
+        sql.Column('top_router_id', sql.String(length=36), nullable=False,
+                   index=True),
+        sql.Column('bottom_router_id', sql.String(length=36),
+                   nullable=False),
+        sql.Column('pod_id', sql.String(length=64), nullable=False),
+        sql.Column('bridge_ip', sql.String(length=64)),
+        sql.Column('subnet_cidrs', sql.Text),
+        sql.Column('created_at', sql.DateTime),
+        sql.Column('updated_at', sql.DateTime),
+        migrate.UniqueConstraint(
+            'top_router_id', 'bottom_router_id',
+            name='extra_route_snapshot0top_router_id0bottom_router_id'),
+        mysql_engine='InnoDB',
+        mysql_charset='utf8')
+    extra_route_snapshot.create()
+
+    cascaded_pods = sql.Table('cascaded_pods', meta, autoload=True)
+    migrate.ForeignKeyConstraint(
+        columns=[extra_route_snapshot.c.pod_id],
+        refcolumns=[cascaded_pods.c.pod_id]).create()
+
+
+def downgrade(migrate_engine):
+    raise NotImplementedError('downgrade not support')
@@ -0,0 +1,31 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+# All Rights Reserved
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import sqlalchemy as sql
+
+
+def upgrade(migrate_engine):
+    meta = sql.MetaData()
+    meta.bind = migrate_engine
+
+    routings = sql.Table('cascaded_pods_resource_routing', meta,
+                         autoload=True)
+    sql.Index('resource_routing_bottom_id_type_idx',
+              routings.c.bottom_id,
+              routings.c.resource_type).create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    raise NotImplementedError('downgrade not support')
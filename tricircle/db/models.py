@@ -218,8 +218,9 @@ class QuotaUsages(core.ModelBase, QuotasBase):
     __tablename__ = 'quota_usages'
     __table_args__ = ()
     attributes = ['id', 'project_id', 'user_id', 'resource',
-                  'in_use', 'reserved', 'until_refresh',
-                  'created_at', 'updated_at', 'deleted_at', 'deleted']
+                  'in_use', 'reserved', 'until_refresh', 'synced_in_use',
+                  'synced_at', 'created_at', 'updated_at', 'deleted_at',
+                  'deleted']
 
     id = sql.Column(sql.Integer, primary_key=True)
     project_id = sql.Column(sql.String(255), index=True)
@@ -230,6 +231,10 @@ class QuotaUsages(core.ModelBase, QuotasBase):
     reserved = sql.Column(sql.Integer, default=0)
 
     until_refresh = sql.Column(sql.Integer, default=0)
+    # latest in_use counted from bottom pods, applied when usage refreshes
+    # if the usage is not changed after synced_at, the time counting starts
+    synced_in_use = sql.Column(sql.Integer)
+    synced_at = sql.Column(sql.DateTime)
 
     @property
     def total(self):
@@ -242,7 +247,9 @@ class Reservation(core.ModelBase, QuotasBase):
     Represents a resource reservation for quotas
     """
     __tablename__ = 'reservations'
-    __table_args__ = ()
+    __table_args__ = (
+        sql.Index('reservations_deleted_expire_idx', 'deleted', 'expire'),
+    )
     attributes = ['id', 'uuid', 'usage_id', 'project_id', 'resource',
                   'delta', 'expire',
                   'created_at', 'updated_at', 'deleted_at', 'deleted']
@@ -379,6 +386,8 @@ class ResourceRouting(core.ModelBase, core.DictBase, models.TimestampMixin):
         schema.UniqueConstraint(
             'top_id', 'pod_id',
             name='cascaded_pods_resource_routing0top_id0pod_id'),
+        sql.Index('resource_routing_bottom_id_type_idx',
+                  'bottom_id', 'resource_type'),
     )
     attributes = ['id', 'top_id', 'bottom_id', 'pod_id', 'project_id',
                   'resource_type', 'created_at', 'updated_at']
@@ -392,3 +401,50 @@ class ResourceRouting(core.ModelBase, core.DictBase, models.TimestampMixin):
     project_id = sql.Column('project_id', sql.String(length=36))
     resource_type = sql.Column('resource_type', sql.String(length=64),
                                nullable=False)
+
+
+# Extra Route Snapshot Model
+class ExtraRouteSnapshot(core.ModelBase, core.DictBase,
+                         models.TimestampMixin):
+    """Last extra route input pushed to one bottom router.
+
+    subnet_cidrs stores a json list of [bottom_subnet_id, cidr] pairs of the
+    non-bridge interfaces attached to the bottom router.
+    """
+    __tablename__ = 'extra_route_snapshot'
+    __table_args__ = (
+        schema.UniqueConstraint(
+            'top_router_id', 'bottom_router_id',
+            name='extra_route_snapshot0top_router_id0bottom_router_id'),
+    )
+    attributes = ['id', 'top_router_id', 'bottom_router_id', 'pod_id',
+                  'bridge_ip', 'subnet_cidrs', 'created_at', 'updated_at']
+
+    id = sql.Column('id', sql.Integer, primary_key=True)
+    top_router_id = sql.Column('top_router_id', sql.String(length=36),
+                               nullable=False, index=True)
+    bottom_router_id = sql.Column('bottom_router_id', sql.String(length=36),
+                                  nullable=False)
+    pod_id = sql.Column('pod_id', sql.String(length=64),
+                        sql.ForeignKey('cascaded_pods.pod_id'),
+                        nullable=False)
+    bridge_ip = sql.Column('bridge_ip', sql.String(length=64))
+    subnet_cidrs = sql.Column('subnet_cidrs', sql.Text)
+
+
+# Job Lease Model
+class JobLease(core.ModelBase, core.DictBase, models.TimestampMixin):
+    """Exclusive right of one xjob worker to run jobs for a resource.
+
+    rerun is set when another worker receives a job for the resource while
+    the lease is held, the owner then runs the job again before releasing.
+    """
+    __tablename__ = 'job_leases'
+    attributes = ['resource_id', 'owner', 'expire_at', 'rerun',
+                  'created_at', 'updated_at']
+
+    resource_id = sql.Column('resource_id', sql.String(length=127),
+                             primary_key=True)
+    owner = sql.Column('owner', sql.String(length=255), nullable=False)
+    expire_at = sql.Column('expire_at', sql.DateTime, nullable=False)
+    rerun = sql.Column('rerun', sql.Boolean, nullable=False, default=False)
@@ -13,10 +13,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import tricircle.db.api
 import tricircle.db.core
 
 
 def list_opts():
     return [
         ('DEFAULT', tricircle.db.core.db_opts),
+        ('quota', tricircle.db.api.api_opts),
     ]
@@ -16,6 +16,7 @@
 from oslo_config import cfg
 import oslo_log.helpers as log_helpers
 from oslo_log import log
+from oslo_utils import excutils
 from oslo_utils import uuidutils
 
 from neutron.api.v2 import attributes
@@ -49,6 +50,8 @@ import tricircle.common.context as t_context
 import tricircle.common.exceptions as t_exceptions
 from tricircle.common.i18n import _
 from tricircle.common.i18n import _LI
+from tricircle.common import id_index
+from tricircle.common import id_rewriter
 import tricircle.common.lock_handle as t_lock
 from tricircle.common import xrpcapi
 import tricircle.db.api as db_api
@@ -134,13 +137,13 @@ class TricirclePlugin(db_base_plugin_v2.NeutronDbPluginV2,
         if not az_list:
             return
         t_ctx = t_context.get_context_from_neutron_context(context)
+        az_set = set(az_list)
+        key = 'pod_name' if external else 'az_name'
         with context.session.begin():
-            pods = core.query_resource(t_ctx, models.Pod, [], [])
-            az_set = set(az_list)
-            if external:
-                known_az_set = set([pod['pod_name'] for pod in pods])
-            else:
-                known_az_set = set([pod['az_name'] for pod in pods])
+            pods = core.query_resource(
+                t_ctx, models.Pod,
+                [{'key': key, 'comparator': 'in', 'value': az_set}], [])
+            known_az_set = set([pod[key] for pod in pods])
             diff = az_set - known_az_set
             if diff:
                 if external:
@@ -328,6 +331,7 @@ class TricirclePlugin(db_base_plugin_v2.NeutronDbPluginV2,
                 bottom_port_id = mappings[0][1]
                 self._get_client(pod_name).delete_ports(
                     t_ctx, bottom_port_id)
+                id_index.discard(t_constants.RT_PORT, bottom_port_id)
         except Exception:
             raise
         with t_ctx.session.begin():
@@ -346,27 +350,14 @@ class TricirclePlugin(db_base_plugin_v2.NeutronDbPluginV2,
             bottom_port_id = mappings[0][1]
             port = self._get_client(pod_name).get_ports(
                 t_ctx, bottom_port_id)
-            port['id'] = port_id
             if fields:
                 port = dict(
                     [(k, v) for k, v in port.iteritems() if k in fields])
-            if 'network_id' not in port and 'fixed_ips' not in port:
-                return port
-
-            bottom_top_map = {}
-            with t_ctx.session.begin():
-                for resource in (t_constants.RT_SUBNET, t_constants.RT_NETWORK,
-                                 t_constants.RT_ROUTER):
-                    route_filters = [{'key': 'resource_type',
-                                      'comparator': 'eq',
-                                      'value': resource}]
-                    routes = core.query_resource(
-                        t_ctx, models.ResourceRouting, route_filters, [])
-                    for route in routes:
-                        if route['bottom_id']:
-                            bottom_top_map[
-                                route['bottom_id']] = route['top_id']
-            self._map_port_from_bottom_to_top(port, bottom_top_map)
+            if 'network_id' in port or 'fixed_ips' in port:
+                id_rewriter.PORT_REWRITER.rewrite(t_ctx, [port],
+                                                  drop_unmapped=False)
+            if 'id' in port:
+                port['id'] = port_id
             return port
         else:
             return super(TricirclePlugin, self).get_port(context,
@@ -433,29 +424,6 @@ class TricirclePlugin(db_base_plugin_v2.NeutronDbPluginV2,
                     ret.append(port)
             return ret
 
-    @staticmethod
-    def _map_port_from_bottom_to_top(port, bottom_top_map):
-        if 'network_id' in port and port['network_id'] in bottom_top_map:
-            port['network_id'] = bottom_top_map[port['network_id']]
-        if 'fixed_ips' in port:
-            for ip in port['fixed_ips']:
-                if ip['subnet_id'] in bottom_top_map:
-                    ip['subnet_id'] = bottom_top_map[ip['subnet_id']]
-        if 'device_id' in port and port['device_id'] in bottom_top_map:
-            port['device_id'] = bottom_top_map[port['device_id']]
-
-    @staticmethod
-    def _map_ports_from_bottom_to_top(ports, bottom_top_map):
-        # TODO(zhiyuan) judge if it's fine to remove unmapped port
-        port_list = []
-        for port in ports:
-            if port['id'] not in bottom_top_map:
-                continue
-            port['id'] = bottom_top_map[port['id']]
-            TricirclePlugin._map_port_from_bottom_to_top(port, bottom_top_map)
-            port_list.append(port)
-        return port_list
-
     @staticmethod
     def _get_map_filter_ids(key, value, pod_id, top_bottom_map):
         if key in ('id', 'network_id', 'device_id'):
@@ -472,8 +440,7 @@ class TricirclePlugin(db_base_plugin_v2.NeutronDbPluginV2,
 
     def _get_ports_from_pod_with_number(self, context,
                                         current_pod, number, last_port_id,
-                                        bottom_top_map, top_bottom_map,
-                                        filters=None):
+                                        top_bottom_map, filters=None):
         # NOTE(zhiyuan) last_port_id is top id, also id in returned port dict
         # also uses top id. when interacting with bottom pod, need to map
         # top to bottom in request and map bottom to top in response
@@ -495,8 +462,8 @@ class TricirclePlugin(db_base_plugin_v2.NeutronDbPluginV2,
             params['marker'] = top_bottom_map[last_port_id]
         res = q_client.get(q_client.ports_path, params=params)
         # map bottom id to top id in client response
-        mapped_port_list = self._map_ports_from_bottom_to_top(res['ports'],
-                                                              bottom_top_map)
+        mapped_port_list = id_rewriter.PORT_REWRITER.rewrite(t_ctx,
+                                                             res['ports'])
         del res['ports']
         res['ports'] = mapped_port_list
 
@@ -517,7 +484,7 @@ class TricirclePlugin(db_base_plugin_v2.NeutronDbPluginV2,
                 # need to map
                 next_res = self._get_ports_from_pod_with_number(
                     context, next_pod, number - len(res['ports']), '',
-                    bottom_top_map, top_bottom_map, filters)
+                    top_bottom_map, filters)
                 next_res['ports'].extend(res['ports'])
                 return next_res
 
@@ -525,27 +492,27 @@ class TricirclePlugin(db_base_plugin_v2.NeutronDbPluginV2,
                   limit=None, marker=None, page_reverse=False):
         t_ctx = t_context.get_context_from_neutron_context(context)
         with t_ctx.session.begin():
-            bottom_top_map = {}
             top_bottom_map = {}
-            for resource in (t_constants.RT_PORT, t_constants.RT_SUBNET,
-                             t_constants.RT_NETWORK, t_constants.RT_ROUTER):
-                route_filters = [{'key': 'resource_type',
-                                  'comparator': 'eq',
-                                  'value': resource}]
-                routes = core.query_resource(t_ctx, models.ResourceRouting,
-                                             route_filters, [])
-
-                for route in routes:
-                    if route['bottom_id']:
-                        bottom_top_map[route['bottom_id']] = route['top_id']
-                        if route['resource_type'] == t_constants.RT_PORT:
-                            key = route['top_id']
-                        else:
-                            # for non port resource, one top resource is
-                            # possible to be mapped to more than one bottom
-                            # resource
-                            key = '%s_%s' % (route['pod_id'], route['top_id'])
-                        top_bottom_map[key] = route['bottom_id']
+            route_filters = [{'key': 'resource_type',
+                              'comparator': 'in',
+                              'value': [t_constants.RT_PORT,
+                                        t_constants.RT_SUBNET,
+                                        t_constants.RT_NETWORK,
+                                        t_constants.RT_ROUTER]},
+                             {'key': 'bottom_id',
+                              'comparator': 'is_null',
+                              'value': False}]
+            routes = core.query_resource(t_ctx, models.ResourceRouting,
+                                         route_filters, [])
+
+            for route in routes:
+                if route['resource_type'] == t_constants.RT_PORT:
+                    key = route['top_id']
+                else:
+                    # for non port resource, one top resource is possible
+                    # to be mapped to more than one bottom resource
+                    key = '%s_%s' % (route['pod_id'], route['top_id'])
+                top_bottom_map[key] = route['bottom_id']
 
         if limit:
             if marker:
@@ -558,7 +525,7 @@ class TricirclePlugin(db_base_plugin_v2.NeutronDbPluginV2,
                     current_pod = db_api.get_pod(t_ctx, pod_id)
                     res = self._get_ports_from_pod_with_number(
                         context, current_pod, limit, marker,
-                        bottom_top_map, top_bottom_map, filters)
+                        top_bottom_map, filters)
                 else:
                     res = self._get_ports_from_top_with_number(
                         context, limit, marker, top_bottom_map, filters)
@@ -569,7 +536,7 @@ class TricirclePlugin(db_base_plugin_v2.NeutronDbPluginV2,
                 if current_pod:
                     res = self._get_ports_from_pod_with_number(
                         context, current_pod, limit, '',
-                        bottom_top_map, top_bottom_map, filters)
+                        top_bottom_map, filters)
                 else:
                     res = self._get_ports_from_top_with_number(
                         context, limit, marker, top_bottom_map, filters)
@@ -602,7 +569,7 @@ class TricirclePlugin(db_base_plugin_v2.NeutronDbPluginV2,
                                              'value': value})
                 client = self._get_client(pod['pod_name'])
                 ret.extend(client.list_ports(t_ctx, filters=_filters))
-            ret = self._map_ports_from_bottom_to_top(ret, bottom_top_map)
+            ret = id_rewriter.PORT_REWRITER.rewrite(t_ctx, ret)
             ret.extend(self._get_ports_from_top(context, top_bottom_map,
                                                 filters))
             return ret
@@ -641,22 +608,31 @@ class TricirclePlugin(db_base_plugin_v2.NeutronDbPluginV2,
             project_id, pod, ele, _type, body,
             list_resources, create_resources)
 
-    def _prepare_bottom_element(self, t_ctx,
-                                project_id, pod, ele, _type, body):
-        def list_resources(t_ctx_, q_ctx, pod_, _id_, _type_):
-            client = self._get_client(pod_['pod_name'])
-            return client.list_resources(_type_, t_ctx_, [{'key': 'name',
-                                                           'comparator': 'eq',
-                                                           'value': _id_}])
+    def _list_bottom_elements(self, t_ctx, q_ctx, pod, _id, _type):
+        client = self._get_client(pod['pod_name'])
+        return client.list_resources(_type, t_ctx, [{'key': 'name',
+                                                     'comparator': 'eq',
+                                                     'value': _id}])
 
-        def create_resources(t_ctx_, q_ctx, pod_, body_, _type_):
-            client = self._get_client(pod_['pod_name'])
-            return client.create_resources(_type_, t_ctx_, body_)
+    def _create_bottom_element(self, t_ctx, q_ctx, pod, body, _type):
+        client = self._get_client(pod['pod_name'])
+        return client.create_resources(_type, t_ctx, body)
 
+    def _prepare_bottom_routes(self, t_ctx, project_id, pod, eles):
+        # eles is a list of (top element, resource type) tuple
+        return t_lock.get_or_create_routes(
+            t_ctx, None, project_id,
+            [(ele['id'], pod, _type) for ele, _type in eles],
+            self._list_bottom_elements)
+
+    def _prepare_bottom_element(self, t_ctx,
+                                project_id, pod, ele, _type, body,
+                                prepared_route=None):
         return t_lock.get_or_create_element(
             t_ctx, None,  # we don't need neutron context, so pass None
             project_id, pod, ele, _type, body,
-            list_resources, create_resources)
+            self._list_bottom_elements, self._create_bottom_element,
+            prepared_route)
 
     def _get_bridge_subnet_pool_id(self, t_ctx, q_ctx, project_id, pod, is_ew):
         if is_ew:
@@ -750,42 +726,52 @@ class TricirclePlugin(db_base_plugin_v2.NeutronDbPluginV2,
 
     def _get_bottom_elements(self, t_ctx, project_id, pod,
                              t_net, t_subnet, t_port):
-        net_body = {
-            'network': {
-                'tenant_id': project_id,
-                'name': t_net['id'],
-                'admin_state_up': True
+        routes = self._prepare_bottom_routes(
+            t_ctx, project_id, pod,
+            [(t_net, 'network'), (t_subnet, 'subnet'), (t_port, 'port')])
+        try:
+            net_body = {
+                'network': {
+                    'tenant_id': project_id,
+                    'name': t_net['id'],
+                    'admin_state_up': True
+                }
             }
-        }
-        _, net_id = self._prepare_bottom_element(
-            t_ctx, project_id, pod, t_net, 'network', net_body)
-        subnet_body = {
-            'subnet': {
-                'network_id': net_id,
-                'name': t_subnet['id'],
-                'ip_version': t_subnet['ip_version'],
-                'cidr': t_subnet['cidr'],
-                'gateway_ip': t_subnet['gateway_ip'],
-                'allocation_pools': t_subnet['allocation_pools'],
-                'enable_dhcp': t_subnet['enable_dhcp'],
-                'tenant_id': project_id
+            _, net_id = self._prepare_bottom_element(
+                t_ctx, project_id, pod, t_net, 'network', net_body,
+                routes[0])
+            subnet_body = {
+                'subnet': {
+                    'network_id': net_id,
+                    'name': t_subnet['id'],
+                    'ip_version': t_subnet['ip_version'],
+                    'cidr': t_subnet['cidr'],
+                    'gateway_ip': t_subnet['gateway_ip'],
+                    'allocation_pools': t_subnet['allocation_pools'],
+                    'enable_dhcp': t_subnet['enable_dhcp'],
+                    'tenant_id': project_id
+                }
             }
-        }
-        _, subnet_id = self._prepare_bottom_element(
-            t_ctx, project_id, pod, t_subnet, 'subnet', subnet_body)
-        port_body = {
-            'port': {
-                'network_id': net_id,
-                'name': t_port['id'],
-                'admin_state_up': True,
-                'fixed_ips': [
-                    {'subnet_id': subnet_id,
-                     'ip_address': t_port['fixed_ips'][0]['ip_address']}],
-                'mac_address': t_port['mac_address']
+            _, subnet_id = self._prepare_bottom_element(
+                t_ctx, project_id, pod, t_subnet, 'subnet', subnet_body,
+                routes[1])
+            port_body = {
+                'port': {
+                    'network_id': net_id,
+                    'name': t_port['id'],
+                    'admin_state_up': True,
+                    'fixed_ips': [
+                        {'subnet_id': subnet_id,
+                         'ip_address': t_port['fixed_ips'][0]['ip_address']}],
+                    'mac_address': t_port['mac_address']
+                }
             }
-        }
-        _, port_id = self._prepare_bottom_element(
-            t_ctx, project_id, pod, t_port, 'port', port_body)
+            _, port_id = self._prepare_bottom_element(
+                t_ctx, project_id, pod, t_port, 'port', port_body, routes[2])
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                t_lock.delete_unbound_routes(
+                    t_ctx, [route for route, is_new in routes if is_new])
         return port_id
 
     def _get_bridge_interface(self, t_ctx, q_ctx, project_id, pod,
@@ -824,49 +810,63 @@ class TricirclePlugin(db_base_plugin_v2.NeutronDbPluginV2,
             query = query.filter_by(network_id=t_net['id'])
             vlan = query.first().segmentation_id
 
-        net_body = {'network': {'tenant_id': project_id,
-                                'name': t_net['id'],
-                                'provider:network_type': 'vlan',
-                                'provider:physical_network': phy_net,
-                                'provider:segmentation_id': vlan,
-                                'admin_state_up': True}}
-        if is_external:
-            net_body['network'][external_net.EXTERNAL] = True
-        _, b_net_id = self._prepare_bottom_element(
-            t_ctx, project_id, pod, t_net, 'network', net_body)
-
-        subnet_body = {'subnet': {'network_id': b_net_id,
-                                  'name': t_subnet['id'],
-                                  'ip_version': 4,
-                                  'cidr': t_subnet['cidr'],
-                                  'enable_dhcp': False,
-                                  'tenant_id': project_id}}
-        # In the pod hosting external network, where ns bridge network is used
-        # as an internal network, need to allocate ip address from .3 because
-        # .2 is used by the router gateway port in the pod hosting servers,
-        # where ns bridge network is used as an external network.
-        # if t_subnet['name'].startswith('ns_bridge_') and not is_external:
-        #     prefix = t_subnet['cidr'][:t_subnet['cidr'].rindex('.')]
-        #     subnet_body['subnet']['allocation_pools'] = [
-        #         {'start': prefix + '.3', 'end': prefix + '.254'}]
-        _, b_subnet_id = self._prepare_bottom_element(
-            t_ctx, project_id, pod, t_subnet, 'subnet', subnet_body)
-
+        eles = [(t_net, 'network'), (t_subnet, 'subnet')]
         if t_port:
-            port_body = {
-                'port': {
-                    'tenant_id': project_id,
-                    'admin_state_up': True,
-                    'name': t_port['id'],
-                    'network_id': b_net_id,
-                    'fixed_ips': [
-                        {'subnet_id': b_subnet_id,
-                         'ip_address': t_port['fixed_ips'][0]['ip_address']}]
+            eles.append((t_port, 'port'))
+        routes = self._prepare_bottom_routes(t_ctx, project_id, pod, eles)
+        try:
+            net_body = {'network': {'tenant_id': project_id,
+                                    'name': t_net['id'],
+                                    'provider:network_type': 'vlan',
+                                    'provider:physical_network': phy_net,
+                                    'provider:segmentation_id': vlan,
+                                    'admin_state_up': True}}
+            if is_external:
+                net_body['network'][external_net.EXTERNAL] = True
+            _, b_net_id = self._prepare_bottom_element(
+                t_ctx, project_id, pod, t_net, 'network', net_body,
+                routes[0])
+
+            subnet_body = {'subnet': {'network_id': b_net_id,
+                                      'name': t_subnet['id'],
+                                      'ip_version': 4,
+                                      'cidr': t_subnet['cidr'],
+                                      'enable_dhcp': False,
+                                      'tenant_id': project_id}}
+            # In the pod hosting external network, where ns bridge network is
+            # used as an internal network, need to allocate ip address from .3
+            # because .2 is used by the router gateway port in the pod hosting
+            # servers, where ns bridge network is used as an external network.
+            # if t_subnet['name'].startswith('ns_bridge_') and not is_external:
+            #     prefix = t_subnet['cidr'][:t_subnet['cidr'].rindex('.')]
+            #     subnet_body['subnet']['allocation_pools'] = [
+            #         {'start': prefix + '.3', 'end': prefix + '.254'}]
+            _, b_subnet_id = self._prepare_bottom_element(
+                t_ctx, project_id, pod, t_subnet, 'subnet', subnet_body,
+                routes[1])
+
+            if t_port:
+                port_body = {
+                    'port': {
+                        'tenant_id': project_id,
+                        'admin_state_up': True,
+                        'name': t_port['id'],
+                        'network_id': b_net_id,
+                        'fixed_ips': [
+                            {'subnet_id': b_subnet_id,
+                             'ip_address': t_port['fixed_ips'][0][
+                                 'ip_address']}]
+                    }
                 }
-            }
-            is_new, b_port_id = self._prepare_bottom_element(
-                t_ctx, project_id, pod, t_port, 'port', port_body)
+                is_new, b_port_id = self._prepare_bottom_element(
+                    t_ctx, project_id, pod, t_port, 'port', port_body,
+                    routes[2])
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                t_lock.delete_unbound_routes(
+                    t_ctx, [route for route, is_new in routes if is_new])
 
+        if t_port:
             return is_new, b_port_id, b_subnet_id, b_net_id
         else:
             return None, None, b_subnet_id, b_net_id
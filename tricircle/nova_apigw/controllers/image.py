@@ -30,7 +30,7 @@ class ImageController(rest.RestController):
     @expose(generic=True, template='json')
     def get_one(self, _id):
         context = t_context.extract_context_from_environ()
-        image = self.client.get_images(context, _id)
+        image = self.client.get_images(context, _id, shared=True)
         if not image:
             pecan.abort(404, 'Image not found')
             return
@@ -39,5 +39,5 @@ class ImageController(rest.RestController):
     @expose(generic=True, template='json')
     def get_all(self):
         context = t_context.extract_context_from_environ()
-        images = self.client.list_images(context)
+        images = self.client.list_images(context, shared=True)
         return {'images': images}
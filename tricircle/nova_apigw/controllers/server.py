@@ -13,19 +13,36 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import functools
+
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+from oslo_utils import excutils
 import pecan
 from pecan import expose
+from pecan import Response
 from pecan import rest
+import six
 
 from tricircle.common import az_ag
 import tricircle.common.client as t_client
 from tricircle.common import constants
 import tricircle.common.context as t_context
+from tricircle.common.i18n import _LE
+from tricircle.common import id_index
+from tricircle.common import id_rewriter
+from tricircle.common import list_cache
 import tricircle.common.lock_handle as t_lock
+from tricircle.common import restapp
 import tricircle.db.api as db_api
 from tricircle.db import core
 from tricircle.db import models
 
+LOG = logging.getLogger(__name__)
+
+# number of servers whose ids are mapped with one lookup
+_REWRITE_BATCH_SIZE = 500
+
 
 class ServerController(rest.RestController):
 
@@ -39,15 +56,9 @@ class ServerController(rest.RestController):
         return self.clients[pod_name]
 
     def _get_or_create_route(self, context, pod, _id, _type):
-        def list_resources(t_ctx, q_ctx, pod_, _id_, _type_):
-            client = self._get_client(pod_['pod_name'])
-            return client.list_resources(_type_, t_ctx, [{'key': 'name',
-                                                          'comparator': 'eq',
-                                                          'value': _id_}])
-
         return t_lock.get_or_create_route(context, None,
                                           self.project_id, pod, _id, _type,
-                                          list_resources)
+                                          self._list_bottom_elements)
 
     def _get_create_network_body(self, network):
         body = {
@@ -112,36 +123,50 @@ class ServerController(rest.RestController):
         }
         return body
 
-    def _prepare_neutron_element(self, context, pod, ele, _type, body):
-        def list_resources(t_ctx, q_ctx, pod_, _id_, _type_):
-            client = self._get_client(pod_['pod_name'])
-            return client.list_resources(_type_, t_ctx, [{'key': 'name',
-                                                          'comparator': 'eq',
-                                                          'value': _id_}])
+    def _list_bottom_elements(self, t_ctx, q_ctx, pod, _id, _type):
+        client = self._get_client(pod['pod_name'])
+        return client.list_resources(_type, t_ctx, [{'key': 'name',
+                                                     'comparator': 'eq',
+                                                     'value': _id}])
 
-        def create_resources(t_ctx, q_ctx, pod_, body_, _type_):
-            client = self._get_client(pod_['pod_name'])
-            return client.create_resources(_type_, t_ctx, body_)
+    def _create_bottom_element(self, t_ctx, q_ctx, pod, body, _type):
+        client = self._get_client(pod['pod_name'])
+        return client.create_resources(_type, t_ctx, body)
 
+    def _prepare_neutron_element(self, context, pod, ele, _type, body,
+                                 prepared_route=None):
         _, ele_id = t_lock.get_or_create_element(
             context, None,  # we don't need neutron context, so pass None
             self.project_id, pod, ele, _type, body,
-            list_resources, create_resources)
+            self._list_bottom_elements, self._create_bottom_element,
+            prepared_route)
         return ele_id
 
     def _handle_network(self, context, pod, net, subnets, port=None):
-        # network
-        net_body = self._get_create_network_body(net)
-        bottom_net_id = self._prepare_neutron_element(context, pod, net,
-                                                      'network', net_body)
-
-        # subnet
-        subnet_map = {}
-        for subnet in subnets:
-            subnet_body = self._get_create_subnet_body(subnet, bottom_net_id)
-            bottom_subnet_id = self._prepare_neutron_element(
-                context, pod, subnet, 'subnet', subnet_body)
-            subnet_map[subnet['id']] = bottom_subnet_id
+        # read or reserve routing entries of network and subnets at once
+        eles = [(net['id'], pod, 'network')]
+        eles.extend([(subnet['id'], pod, 'subnet') for subnet in subnets])
+        routes = t_lock.get_or_create_routes(context, None, self.project_id,
+                                             eles, self._list_bottom_elements)
+        try:
+            # network
+            net_body = self._get_create_network_body(net)
+            bottom_net_id = self._prepare_neutron_element(
+                context, pod, net, 'network', net_body, routes[0])
+
+            # subnet
+            subnet_map = {}
+            for i, subnet in enumerate(subnets):
+                subnet_body = self._get_create_subnet_body(subnet,
+                                                           bottom_net_id)
+                bottom_subnet_id = self._prepare_neutron_element(
+                    context, pod, subnet, 'subnet', subnet_body,
+                    routes[i + 1])
+                subnet_map[subnet['id']] = bottom_subnet_id
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                t_lock.delete_unbound_routes(
+                    context, [route for route, is_new in routes if is_new])
         top_client = self._get_client()
         top_port_body = {'port': {'network_id': net['id'],
                                   'admin_state_up': True}}
@@ -214,6 +239,8 @@ class ServerController(rest.RestController):
                                  'pod_id': pod['pod_id'],
                                  'project_id': self.project_id,
                                  'resource_type': constants.RT_PORT})
+                        id_index.add(constants.RT_PORT, dhcp_port['id'],
+                                     t_dhcp_port['id'])
                         dhcp_port_match = True
                         break
                 if not dhcp_port_match:
@@ -228,6 +255,8 @@ class ServerController(rest.RestController):
                                           'pod_id': pod['pod_id'],
                                           'project_id': self.project_id,
                                           'resource_type': constants.RT_PORT})
+                id_index.add(constants.RT_PORT, b_dhcp_port['id'],
+                             t_dhcp_port['id'])
                 # there is still one thing to do, there may be other dhcp ports
                 # created by bottom pod, we need to delete them
                 b_dhcp_ports = client.list_ports(context,
@@ -282,36 +311,98 @@ class ServerController(rest.RestController):
 
     @staticmethod
     def _remove_fip_info(servers):
+        """Strip floating ip addresses of servers
+
+        :param servers: iterable of servers
+        :return: generator of servers with only fixed ip addresses
+        """
         for server in servers:
-            if 'addresses' not in server:
-                continue
-            for addresses in server['addresses'].values():
-                remove_index = -1
-                for i, address in enumerate(addresses):
-                    if address.get('OS-EXT-IPS:type') == 'floating':
-                        remove_index = i
-                        break
-                if remove_index >= 0:
-                    del addresses[remove_index]
+            addresses = server.get('addresses')
+            if addresses:
+                for name, ips in six.iteritems(addresses):
+                    addresses[name] = [
+                        ip for ip in ips
+                        if ip.get('OS-EXT-IPS:type') != 'floating']
+            yield server
+
+    @staticmethod
+    def _set_az_info(servers, pod):
+        """Replace the bottom availability zone with the one of the pod"""
+        for server in servers:
+            if 'OS-EXT-AZ:availability_zone' in server:
+                server['OS-EXT-AZ:availability_zone'] = pod['az_name']
+            yield server
+
+    @staticmethod
+    def _map_ids(context, servers):
+        """Rewrite bottom ids of servers in batches"""
+        batch = []
+        for server in servers:
+            batch.append(server)
+            if len(batch) == _REWRITE_BATCH_SIZE:
+                # NOTE: servers not bound to top resources are kept
+                for rewritten in id_rewriter.SERVER_REWRITER.rewrite(
+                        context, batch):
+                    yield rewritten
+                batch = []
+        if batch:
+            for rewritten in id_rewriter.SERVER_REWRITER.rewrite(context,
+                                                                 batch):
+                yield rewritten
+
+    def _list_pod_servers(self, context, pod):
+        client = self._get_client(pod['pod_name'])
+        servers = self._remove_fip_info(client.list_servers(context))
+        servers = self._set_az_info(servers, pod)
+        return self._map_ids(context, servers)
 
     def _get_all(self, context):
-        ret = []
+        """List servers of all the pods
+
+        Servers are listed pod by pod and pass through the stages one at a
+        time, so only servers of the pod being listed are kept in memory.
+        If list_cache_ttl is set, servers of each pod are cached.
+
+        :return: generator of servers
+        """
         pods = db_api.list_pods(context)
         for pod in pods:
             if not pod['az_name']:
                 continue
-            client = self._get_client(pod['pod_name'])
-            servers = client.list_servers(context)
-            self._remove_fip_info(servers)
-            ret.extend(servers)
-        return ret
+            servers = list_cache.get(
+                context, self.project_id, pod['pod_id'], constants.RT_SERVER,
+                functools.partial(self._list_pod_servers, context, pod))
+            for server in servers:
+                yield server
+
+    def _stream_servers(self, context):
+        # NOTE: each pod is listed before its servers are written,
+        # and pods are listed here until one server is found, so failing to
+        # list the first pods still returns an error status
+        servers = restapp.prefetch(self._get_all(context))
+
+        def _stream():
+            yield '{"servers": ['
+            try:
+                for i, server in enumerate(servers):
+                    body = jsonutils.dumps(server)
+                    yield ', ' + body if i else body
+            except Exception as e:
+                # NOTE: response status has been sent when
+                # streaming, the client gets a broken json body
+                LOG.error(_LE('Fail to list servers: %(exception)s'),
+                          {'exception': e})
+                raise
+            yield ']}'
+
+        return Response(app_iter=_stream(), content_type='application/json')
 
     @expose(generic=True, template='json')
     def get_one(self, _id):
         context = t_context.extract_context_from_environ()
 
         if _id == 'detail':
-            return {'servers': self._get_all(context)}
+            return self._stream_servers(context)
 
         mappings = db_api.get_bottom_mappings_by_top_id(
             context, _id, constants.RT_SERVER)
@@ -320,17 +411,18 @@ class ServerController(rest.RestController):
             return
         pod, bottom_id = mappings[0]
         client = self._get_client(pod['pod_name'])
-        server = client.get_servers(context, bottom_id)
+        server = client.get_servers(context, bottom_id, shared=True)
         if not server:
             pecan.abort(404, 'Server not found')
             return
         else:
+            id_rewriter.SERVER_REWRITER.rewrite(context, [server])
             return {'server': server}
 
     @expose(generic=True, template='json')
     def get_all(self):
         context = t_context.extract_context_from_environ()
-        return {'servers': self._get_all(context)}
+        return self._stream_servers(context)
 
     @expose(generic=True, template='json')
     def post(self, **kw):
@@ -394,4 +486,6 @@ class ServerController(rest.RestController):
                                   'pod_id': pod['pod_id'],
                                   'project_id': self.project_id,
                                   'resource_type': constants.RT_SERVER})
+        id_index.add(constants.RT_SERVER, server['id'], server['id'])
+        list_cache.invalidate(self.project_id)
         return {'server': server}
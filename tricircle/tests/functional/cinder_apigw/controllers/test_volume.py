@@ -31,6 +31,8 @@ from tricircle.cinder_apigw import app
 from tricircle.common import constants as cons
 from tricircle.common import context
 from tricircle.common import httpclient as hclient
+from tricircle.common import id_index
+from tricircle.common import list_cache
 
 from tricircle.db import api as db_api
 from tricircle.db import core
@@ -119,6 +121,18 @@ def fake_volumes_forward_req(ctx, action, b_header, b_url, b_req_body):
     return resp
 
 
+def fake_volumes_summary_forward_req(ctx, action, b_header, b_url,
+                                     b_req_body):
+    resp = fake_volumes_forward_req(ctx, action, b_header, b_url,
+                                    b_req_body)
+    if action == 'GET' and b_url.endswith('/volumes'):
+        vols = jsonutils.loads(resp.content)['volumes']
+        resp._content = jsonutils.dumps(
+            {'volumes': [{'id': vol['id'],
+                          'name': vol['name']} for vol in vols]})
+    return resp
+
+
 class CinderVolumeFunctionalTest(base.TestCase):
 
     def setUp(self):
@@ -210,6 +224,8 @@ class CinderVolumeFunctionalTest(base.TestCase):
         cfg.CONF.unregister_opts(app.common_opts)
         pecan.set_config({}, overwrite=True)
         core.ModelBase.metadata.drop_all(core.get_engine())
+        id_index.clear()
+        list_cache.clear()
 
 
 class TestVolumeController(CinderVolumeFunctionalTest):
@@ -387,6 +403,51 @@ class TestVolumeController(CinderVolumeFunctionalTest):
 
         self._test_and_check_delete(volumes, 'my_tenant_id')
 
+    @patch.object(hclient, 'forward_req',
+                  new=fake_volumes_forward_req)
+    @patch.object(list_cache, 'invalidate')
+    def test_delete_bottom_fail(self, mock_invalidate):
+        volume = {
+            "name": 'vol_1',
+            "availability_zone": FAKE_AZ,
+            "size": 10,
+            "project_id": 'my_tenant_id',
+            "metadata": {}
+        }
+        response = self.app.post_json('/v2/my_tenant_id/volumes',
+                                      dict(volume=volume))
+        _id = jsonutils.loads(response.body)['volume']['id']
+        mock_invalidate.reset_mock()
+
+        # bottom volume is gone, bottom pod returns 404
+        del fake_volumes[:]
+        delete_resp = self.app.delete('/v2/my_tenant_id/volumes/' + _id,
+                                      expect_errors=True)
+        self.assertEqual(delete_resp.status_int, 404)
+        self.assertFalse(mock_invalidate.called)
+
+    @patch.object(hclient, 'forward_req',
+                  new=fake_volumes_summary_forward_req)
+    def test_get_summary_and_detail_cached(self):
+        self.CONF.set_override('list_cache_ttl', 10)
+        volume = {
+            "name": 'vol_1',
+            "availability_zone": FAKE_AZ,
+            "size": 10,
+            "project_id": 'my_tenant_id',
+            "metadata": {}
+        }
+        self.app.post_json('/v2/my_tenant_id/volumes', dict(volume=volume))
+
+        for _ in xrange(2):
+            detail_resp = self.app.get('/v2/my_tenant_id/volumes/detail')
+            summary_resp = self.app.get('/v2/my_tenant_id/volumes')
+            detail_vols = jsonutils.loads(detail_resp.body)['volumes']
+            summary_vols = jsonutils.loads(summary_resp.body)['volumes']
+            self.assertEqual(10, detail_vols[0]['size'])
+            self.assertNotIn('size', summary_vols[0])
+        self.assertEqual(2, list_cache.get_stats()['hits'])
+
     @patch.object(hclient, 'forward_req',
                   new=fake_volumes_forward_req)
     def test_get(self):
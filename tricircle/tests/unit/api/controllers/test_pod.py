@@ -17,8 +17,14 @@ import mock
 from mock import patch
 import unittest
 
+from six.moves.urllib import parse as urlparse
+
+from oslo_config import cfg
+from oslo_serialization import jsonutils
 import pecan
+from webob import exc
 
+from tricircle.api import app
 from tricircle.api.controllers import pod
 from tricircle.common import context
 from tricircle.common import utils
@@ -26,8 +32,20 @@ from tricircle.db import core
 from tricircle.db import models
 
 
+FAKE_URL = 'http://127.0.0.1:19999/v1.0/pods'
+
+
+class FakeException(Exception):
+    pass
+
+
+def _get_body(response):
+    return jsonutils.loads(''.join(response.app_iter))
+
+
 class PodsControllerTest(unittest.TestCase):
     def setUp(self):
+        cfg.CONF.register_opts(app.common_opts)
         core.initialize()
         core.ModelBase.metadata.create_all(core.get_engine())
         self.controller = pod.PodsController()
@@ -89,6 +107,7 @@ class PodsControllerTest(unittest.TestCase):
         self.assertEqual(pod['pod']['pod_name'], 'TopPod')
         self.assertEqual(pod['pod']['az_name'], '')
 
+    @patch.object(pecan, 'request', new=mock.Mock(path_url=FAKE_URL))
     @patch.object(context, 'extract_context_from_environ')
     def test_get_all(self, mock_context):
         mock_context.return_value = self.context
@@ -97,11 +116,69 @@ class PodsControllerTest(unittest.TestCase):
         self.controller.post(**kw1)
         self.controller.post(**kw2)
 
-        pods = self.controller.get_all()
+        pods = _get_body(self.controller.get_all())
         actual = [(pod['pod_name'],
                    pod['az_name']) for pod in pods['pods']]
         expect = [('TopPod', ''), ('BottomPod', 'TopAZ')]
         self.assertItemsEqual(expect, actual)
+        self.assertNotIn('pods_links', pods)
+
+    @patch.object(pecan, 'request', new=mock.Mock(path_url=FAKE_URL))
+    @patch.object(context, 'extract_context_from_environ')
+    def test_get_all_pagination(self, mock_context):
+        mock_context.return_value = self.context
+        for i in xrange(5):
+            self.controller.post(**{'pod': {'pod_name': 'BottomPod%d' % i,
+                                            'az_name': 'TopAZ'}})
+
+        kw = {'limit': '2', 'sort_key': 'pod_name', 'sort_dir': 'desc'}
+        pod_names = []
+        while True:
+            pods = _get_body(self.controller.get_all(**kw))
+            pod_names.append([pod['pod_name'] for pod in pods['pods']])
+            if 'pods_links' not in pods:
+                break
+            link = pods['pods_links'][0]
+            self.assertEqual('next', link['rel'])
+            url, query = link['href'].split('?')
+            self.assertEqual(FAKE_URL, url)
+            kw = dict(urlparse.parse_qsl(query))
+            self.assertEqual(pods['pods'][-1]['pod_id'], kw['marker'])
+        self.assertEqual([['BottomPod4', 'BottomPod3'],
+                          ['BottomPod2', 'BottomPod1'],
+                          ['BottomPod0']], pod_names)
+
+        # limit is bounded by pagination_max_limit
+        cfg.CONF.set_override('pagination_max_limit', '3')
+        pods = _get_body(self.controller.get_all())
+        self.assertEqual(3, len(pods['pods']))
+        pods = _get_body(self.controller.get_all(limit='4'))
+        self.assertEqual(3, len(pods['pods']))
+        cfg.CONF.set_override('pagination_max_limit', 'infinite')
+        pods = _get_body(self.controller.get_all())
+        self.assertEqual(5, len(pods['pods']))
+
+    @patch.object(pecan, 'request', new=mock.Mock(path_url=FAKE_URL))
+    @patch.object(context, 'extract_context_from_environ')
+    def test_get_all_invalid_params(self, mock_context):
+        mock_context.return_value = self.context
+        for kw in ({'limit': '0'}, {'limit': 'a'}, {'sort_key': 'az_name'},
+                   {'sort_dir': 'up'}, {'marker': 'fake_pod_id'}):
+            self.assertRaises(exc.HTTPBadRequest,
+                              self.controller.get_all, **kw)
+
+    @patch.object(pecan, 'request', new=mock.Mock(path_url=FAKE_URL))
+    @patch.object(core, 'query_resource')
+    @patch.object(context, 'get_stream_context')
+    @patch.object(context, 'extract_context_from_environ')
+    def test_get_all_query_error(self, mock_context, mock_stream_ctx,
+                                 mock_query):
+        mock_context.return_value = self.context
+        mock_query.side_effect = FakeException()
+        # raised before the response is returned, not when streaming
+        self.assertRaises(exc.HTTPInternalServerError,
+                          self.controller.get_all)
+        mock_stream_ctx.return_value.session.close.assert_called_once_with()
 
     @patch.object(pecan, 'response', new=mock.Mock)
     @patch.object(context, 'extract_context_from_environ')
@@ -132,4 +209,94 @@ class PodsControllerTest(unittest.TestCase):
             self.assertEqual(len(metadatas), 0)
 
     def tearDown(self):
+        cfg.CONF.unregister_opts(app.common_opts)
+        core.ModelBase.metadata.drop_all(core.get_engine())
+
+
+class BindingsControllerTest(unittest.TestCase):
+    def setUp(self):
+        cfg.CONF.register_opts(app.common_opts)
+        core.initialize()
+        core.ModelBase.metadata.create_all(core.get_engine())
+        self.controller = pod.BindingsController()
+        self.context = context.get_admin_context()
+
+    @patch.object(pecan, 'request', new=mock.Mock(path_url=FAKE_URL))
+    @patch.object(context, 'extract_context_from_environ')
+    def test_get_all(self, mock_context):
+        mock_context.return_value = self.context
+        with self.context.session.begin():
+            core.create_resource(self.context, models.Pod,
+                                 {'pod_id': 'pod_id_1',
+                                  'pod_name': 'pod_1',
+                                  'az_name': 'az_name_1'})
+            for i in xrange(3):
+                core.create_resource(self.context, models.PodBinding,
+                                     {'id': 'binding_id_%d' % i,
+                                      'tenant_id': 'tenant_id_%d' % (2 - i),
+                                      'pod_id': 'pod_id_1'})
+
+        bindings = _get_body(self.controller.get_all(sort_key='tenant_id',
+                                                     limit='2'))
+        self.assertEqual(['tenant_id_0', 'tenant_id_1'],
+                         [binding['tenant_id']
+                          for binding in bindings['pod_bindings']])
+        self.assertIn('marker=binding_id_1',
+                      bindings['pod_bindings_links'][0]['href'])
+        bindings = _get_body(self.controller.get_all(
+            sort_key='tenant_id', limit='2', marker='binding_id_1'))
+        self.assertEqual(['binding_id_0'],
+                         [binding['id']
+                          for binding in bindings['pod_bindings']])
+        self.assertNotIn('pod_bindings_links', bindings)
+
+    @patch.object(context, 'extract_context_from_environ')
+    def test_post_bulk(self, mock_context):
+        mock_context.return_value = self.context
+        with self.context.session.begin():
+            core.create_resource(self.context, models.Pod,
+                                 {'pod_id': 'pod_id_1',
+                                  'pod_name': 'pod_1',
+                                  'az_name': 'az_name_1'})
+
+        kw = {'pod_bindings': [
+            {'tenant_id': 'tenant_id_1', 'pod_id': 'pod_id_1'},
+            {'tenant_id': 'tenant_id_1', 'pod_id': 'pod_id_1'},
+            {'tenant_id': 'tenant_id_2', 'pod_id': 'pod_id_2'},
+            {'tenant_id': '', 'pod_id': 'pod_id_1'},
+            {'tenant_id': 'tenant_id_2', 'pod_id': 'pod_id_1'}]}
+        results = self.controller.post(**kw)['pod_bindings']
+        self.assertEqual('tenant_id_1',
+                         results[0]['pod_binding']['tenant_id'])
+        self.assertEqual([409, 422, 422],
+                         [result['error']['code'] for result in results[1:4]])
+        self.assertEqual({'tenant_id': 'tenant_id_2', 'pod_id': 'pod_id_2'},
+                         dict((key, results[2][key])
+                              for key in ('tenant_id', 'pod_id')))
+        self.assertEqual('tenant_id_2',
+                         results[4]['pod_binding']['tenant_id'])
+
+        with self.context.session.begin():
+            bindings = core.query_resource(self.context, models.PodBinding,
+                                           [], [])
+        self.assertEqual(2, len(bindings))
+
+        self.assertRaises(exc.HTTPBadRequest, self.controller.post,
+                          pod_bindings={})
+        # bindings with ids not being strings fail alone
+        kw = {'pod_bindings': [
+            {'tenant_id': 1, 'pod_id': 'pod_id_1'},
+            {'tenant_id': 'tenant_id_3', 'pod_id': ['pod_id_1']},
+            {'tenant_id': 'tenant_id_3', 'pod_id': 'pod_id_1'}]}
+        results = self.controller.post(**kw)['pod_bindings']
+        self.assertEqual([422, 422],
+                         [result['error']['code'] for result in results[:2]])
+        self.assertEqual({'tenant_id': 1, 'pod_id': 'pod_id_1'},
+                         dict((key, results[0][key])
+                              for key in ('tenant_id', 'pod_id')))
+        self.assertEqual('tenant_id_3',
+                         results[2]['pod_binding']['tenant_id'])
+
+    def tearDown(self):
+        cfg.CONF.unregister_opts(app.common_opts)
         core.ModelBase.metadata.drop_all(core.get_engine())
@@ -0,0 +1,98 @@
+# Copyright (c) 2015 Huawei Tech. Co., Ltd.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+from mock import patch
+import unittest
+
+from oslo_serialization import jsonutils
+from webob import exc
+
+from tricircle.api.controllers import quota as quota_controller
+from tricircle.common import context
+from tricircle.common import quota
+from tricircle.db import api as db_api
+from tricircle.db import core
+
+
+class FakeException(Exception):
+    pass
+
+
+class QuotasControllerTest(unittest.TestCase):
+    def setUp(self):
+        core.initialize()
+        core.ModelBase.metadata.create_all(core.get_engine())
+        self.controller = quota_controller.QuotasController()
+        self.context = context.get_admin_context()
+
+    def _prepare_quotas(self):
+        db_api.quota_class_create(self.context, 'default', 'volumes', 10)
+        db_api.quota_create(self.context, 'project2', 'volumes', 5)
+        resources = {'volumes': quota.ReservableResource('volumes', None)}
+        expire = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        db_api.quota_reserve(self.context, resources, {'volumes': 10},
+                             {'volumes': 2}, expire, 0, 0, 'project1')
+
+    def _get_all(self, **kw):
+        resp = self.controller.get_all(**kw)
+        return jsonutils.loads(''.join(resp.app_iter))['quotas']
+
+    @patch.object(context, 'extract_context_from_environ')
+    def test_get_all(self, mock_context):
+        mock_context.return_value = self.context
+        self._prepare_quotas()
+
+        quotas = self._get_all()
+        self.assertEqual(['project1', 'project2'],
+                         [q['project_id'] for q in quotas])
+        self.assertEqual({'limit': 10, 'in_use': 0, 'reserved': 2},
+                         quotas[0]['quota_set']['volumes'])
+        self.assertEqual({'limit': 5, 'in_use': 0, 'reserved': 0,
+                          'allocated': 0},
+                         quotas[1]['quota_set']['volumes'])
+        self.assertEqual(
+            quota.QUOTAS.get_project_quotas(self.context, 'project1'),
+            quotas[0]['quota_set'])
+
+        quotas = self._get_all(project_id='project3', usage='false')
+        self.assertEqual(1, len(quotas))
+        self.assertEqual({'limit': 10},
+                         quotas[0]['quota_set']['volumes'])
+
+        quotas = self._get_all(project_id=['project2', 'project1'])
+        self.assertEqual(['project1', 'project2'],
+                         [q['project_id'] for q in quotas])
+
+    @patch.object(context, 'extract_context_from_environ')
+    def test_get_all_empty(self, mock_context):
+        mock_context.return_value = self.context
+        self.assertEqual([], self._get_all())
+
+    @patch.object(db_api, 'quota_load_all_projects')
+    @patch.object(context, 'get_stream_context')
+    @patch.object(context, 'extract_context_from_environ')
+    def test_get_all_query_error(self, mock_context, mock_stream_ctx,
+                                 mock_load):
+        mock_context.return_value = self.context
+        mock_load.side_effect = FakeException()
+        # raised before the response is returned, not when streaming
+        self.assertRaises(exc.HTTPInternalServerError,
+                          self.controller.get_all)
+        mock_stream_ctx.return_value.session.close.assert_called_once_with()
+
+    def tearDown(self):
+        db_api.invalidate_quota_class_cache()
+        core.ModelBase.metadata.drop_all(core.get_engine())
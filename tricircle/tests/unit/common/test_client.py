@@ -17,6 +17,7 @@
 import unittest
 import uuid
 
+import eventlet
 import mock
 from mock import patch
 from oslo_config import cfg
@@ -300,5 +301,42 @@ class ClientTest(unittest.TestCase):
         url = self.client.get_endpoint(self.context, FAKE_SITE_ID, FAKE_TYPE)
         self.assertEqual(url, FAKE_URL)
 
+    def test_list_shared(self):
+        calls = []
+        handle = self.client.service_handle_map[FAKE_TYPE]
+        handle_list = handle.handle_list
+
+        def _slow_list(cxt, resource, filters):
+            calls.append(filters)
+            eventlet.sleep(0.02)
+            return handle_list(cxt, resource, filters)
+
+        def _list(filters, shared=True):
+            return self.client.list_resources(FAKE_RESOURCE, self.context,
+                                              filters, shared=shared)
+
+        handle.handle_list = _slow_list
+        filters = [{'key': 'name', 'comparator': 'eq', 'value': 'res2'}]
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(_list, [[], [], filters]))
+        self.assertEqual([FAKE_RESOURCES, FAKE_RESOURCES, [{'name': 'res2'}]],
+                         results)
+        self.assertEqual([[], filters], calls)
+        # shared results are copied for each caller
+        self.assertIsNot(results[0][0], results[1][0])
+
+        # requests are not shared unless asked for
+        del calls[:]
+        list(pool.imap(lambda i: _list([], False), xrange(2)))
+        self.assertEqual([[], []], calls)
+
+        cfg.CONF.set_override(name='share_concurrent_reads', override=False,
+                              group='client')
+        self.addCleanup(cfg.CONF.clear_override, 'share_concurrent_reads',
+                        group='client')
+        del calls[:]
+        list(pool.imap(_list, [[], []]))
+        self.assertEqual([[], []], calls)
+
     def tearDown(self):
         core.ModelBase.metadata.drop_all(core.get_engine())
@@ -0,0 +1,77 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+# All Rights Reserved
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import eventlet
+import unittest
+
+from tricircle.common import coalescer
+
+
+class CoalescerTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+    def _handler(self, value):
+        self.calls.append(value)
+
+    def _slow_handler(self, value):
+        self.calls.append(value)
+        eventlet.sleep(0.05)
+
+    def test_submit_no_window(self):
+        _coalescer = coalescer.Coalescer(self._handler, 0)
+        _coalescer.submit('key', 1)
+        _coalescer.submit('key', 2)
+        self.assertEqual([1, 2], self.calls)
+        self.assertEqual(2, _coalescer.get_stats()['handled'])
+        self.assertEqual(0, _coalescer.get_stats()['merged'])
+
+    def test_submit_merge(self):
+        _coalescer = coalescer.Coalescer(self._handler, 0.01)
+        _coalescer.submit('key_1', 1)
+        _coalescer.submit('key_1', 2)
+        _coalescer.submit('key_2', 3)
+        self.assertEqual([], self.calls)
+        stats = _coalescer.get_stats()
+        self.assertEqual(2, stats['queue_depth'])
+        self.assertEqual(1, stats['merged'])
+        eventlet.sleep(0.05)
+        self.assertEqual([2, 3], sorted(self.calls))
+        stats = _coalescer.get_stats()
+        self.assertEqual(0, stats['queue_depth'])
+        self.assertEqual(3, stats['submitted'])
+        self.assertEqual(2, stats['handled'])
+
+    def test_submit_while_running(self):
+        _coalescer = coalescer.Coalescer(self._slow_handler, 0.01)
+        _coalescer.submit('key', 1)
+        eventlet.sleep(0.02)
+        # handler for the first request is still running
+        _coalescer.submit('key', 2)
+        eventlet.sleep(0.02)
+        self.assertEqual([1], self.calls)
+        eventlet.sleep(0.1)
+        self.assertEqual([1, 2], self.calls)
+
+    def test_handler_error(self):
+        def _handler(value):
+            raise Exception('handler error')
+
+        _coalescer = coalescer.Coalescer(_handler, 0.01)
+        _coalescer.submit('key', 1)
+        eventlet.sleep(0.05)
+        self.assertEqual(1, _coalescer.get_stats()['handled'])
+        self.assertEqual(0, _coalescer.get_stats()['running'])
@@ -0,0 +1,44 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+# All Rights Reserved
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import unittest
+
+from tricircle.common import hash_ring
+
+
+class HashRingTest(unittest.TestCase):
+    def test_get_node(self):
+        ring = hash_ring.HashRing(['host_1', 'host_2', 'host_3'])
+        keys = ['router_%d' % i for i in xrange(300)]
+        nodes = [ring.get_node(key) for key in keys]
+        self.assertEqual(set(['host_1', 'host_2', 'host_3']), set(nodes))
+        self.assertEqual(nodes, [ring.get_node(key) for key in keys])
+        self.assertEqual(ring.get_node('router_0'),
+                         ring.get_node(u'router_0'))
+
+    def test_get_node_remove_node(self):
+        ring = hash_ring.HashRing(['host_1', 'host_2', 'host_3'])
+        new_ring = hash_ring.HashRing(['host_1', 'host_2'])
+        for i in xrange(300):
+            key = 'router_%d' % i
+            node = ring.get_node(key)
+            # only keys owned by the removed node are moved
+            if node != 'host_3':
+                self.assertEqual(node, new_ring.get_node(key))
+
+    def test_get_node_empty(self):
+        ring = hash_ring.HashRing([])
+        self.assertIsNone(ring.get_node('router_id'))
@@ -0,0 +1,91 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from oslo_config import cfg
+
+from tricircle.common import constants
+from tricircle.common import context
+from tricircle.common import id_index
+import tricircle.db.api as db_api
+from tricircle.db import core
+from tricircle.db import models
+
+
+class IdIndexTest(unittest.TestCase):
+    def setUp(self):
+        core.initialize()
+        core.ModelBase.metadata.create_all(core.get_engine())
+        self.context = context.get_admin_context()
+        id_index.clear()
+        db_api.create_pod(self.context, {'pod_id': 'pod_id_1',
+                                         'pod_name': 'pod_1',
+                                         'az_name': 'az_name_1'})
+
+    def _create_routing(self, top_id, bottom_id, resource_type):
+        with self.context.session.begin():
+            core.create_resource(
+                self.context, models.ResourceRouting,
+                {'top_id': top_id, 'bottom_id': bottom_id,
+                 'pod_id': 'pod_id_1', 'project_id': 'project_id',
+                 'resource_type': resource_type})
+
+    def test_get_top_ids(self):
+        self._create_routing('top_port_1', 'bottom_port_1',
+                             constants.RT_PORT)
+        self._create_routing('top_net_1', 'bottom_net_1',
+                             constants.RT_NETWORK)
+        self.assertEqual(
+            {'bottom_port_1': 'top_port_1'},
+            id_index.get_top_ids(self.context, constants.RT_PORT,
+                                 ['bottom_port_1', 'bottom_port_2',
+                                  'bottom_net_1', None]))
+        self.assertEqual(3, id_index.get_stats()['misses'])
+
+        # cached mappings are not read from the routing table again
+        with self.context.session.begin():
+            core.delete_resources(self.context, models.ResourceRouting, [],
+                                  delete_all=True)
+        self.assertEqual(
+            {'bottom_port_1': 'top_port_1'},
+            id_index.get_top_ids(self.context, constants.RT_PORT,
+                                 ['bottom_port_1']))
+        self.assertEqual(1, id_index.get_stats()['hits'])
+
+        id_index.discard(constants.RT_PORT, 'bottom_port_1')
+        self.assertEqual({}, id_index.get_top_ids(
+            self.context, constants.RT_PORT, ['bottom_port_1']))
+
+    def test_lru_eviction(self):
+        cfg.CONF.set_override('bottom_top_index_size', 2)
+        id_index.add(constants.RT_PORT, 'bottom_port_1', 'top_port_1')
+        id_index.add(constants.RT_PORT, 'bottom_port_2', 'top_port_2')
+        # port 1 becomes the most recently used one
+        id_index.get_top_ids(self.context, constants.RT_PORT,
+                             ['bottom_port_1'])
+        id_index.add(constants.RT_PORT, 'bottom_port_3', 'top_port_3')
+        self.assertEqual(
+            {'bottom_port_1': 'top_port_1', 'bottom_port_3': 'top_port_3'},
+            id_index.get_top_ids(self.context, constants.RT_PORT,
+                                 ['bottom_port_1', 'bottom_port_2',
+                                  'bottom_port_3']))
+        self.assertEqual(1, id_index.get_stats()['evictions'])
+        self.assertEqual(2, id_index.get_stats()['size'])
+
+    def tearDown(self):
+        cfg.CONF.clear_override('bottom_top_index_size')
+        id_index.clear()
+        core.ModelBase.metadata.drop_all(core.get_engine())
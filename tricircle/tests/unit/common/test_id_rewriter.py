@@ -0,0 +1,99 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import unittest
+
+from tricircle.common import constants
+from tricircle.common import context
+from tricircle.common import id_index
+from tricircle.common import id_rewriter
+import tricircle.db.api as db_api
+from tricircle.db import core
+from tricircle.db import models
+
+
+class RewriterTest(unittest.TestCase):
+    def setUp(self):
+        core.initialize()
+        core.ModelBase.metadata.create_all(core.get_engine())
+        self.context = context.get_admin_context()
+        id_index.clear()
+        db_api.create_pod(self.context, {'pod_id': 'pod_id_1',
+                                         'pod_name': 'pod_1',
+                                         'az_name': 'az_name_1'})
+        with self.context.session.begin():
+            for top_id, bottom_id, resource_type in (
+                    ('top_port_1', 'bottom_port_1', constants.RT_PORT),
+                    ('top_port_2', 'bottom_port_2', constants.RT_PORT),
+                    ('top_net', 'bottom_net', constants.RT_NETWORK),
+                    ('top_subnet_1', 'bottom_subnet_1', constants.RT_SUBNET),
+                    ('top_subnet_2', 'bottom_subnet_2', constants.RT_SUBNET),
+                    # same bottom id bound to a resource of another type
+                    ('top_router', 'bottom_net', constants.RT_ROUTER)):
+                core.create_resource(
+                    self.context, models.ResourceRouting,
+                    {'top_id': top_id, 'bottom_id': bottom_id,
+                     'pod_id': 'pod_id_1', 'project_id': 'project_id',
+                     'resource_type': resource_type})
+
+    def test_rewrite(self):
+        ports = [{'id': 'bottom_port_1',
+                  'network_id': 'bottom_net',
+                  'device_id': 'bottom_server',
+                  'fixed_ips': [{'subnet_id': 'bottom_subnet_1'},
+                                {'subnet_id': 'bottom_subnet_2'}]},
+                 {'id': 'bottom_port_2',
+                  'network_id': 'bottom_net',
+                  'device_id': 'bottom_net',
+                  'fixed_ips': []},
+                 {'id': 'bottom_port_3',
+                  'network_id': 'bottom_net'}]
+        with mock.patch.object(self.context.session, 'query',
+                               wraps=self.context.session.query) as mock_q:
+            ports = id_rewriter.PORT_REWRITER.rewrite(self.context, ports)
+            # all the ids are mapped with one query
+            self.assertEqual(1, mock_q.call_count)
+        self.assertEqual([{'id': 'top_port_1',
+                           'network_id': 'top_net',
+                           'device_id': 'bottom_server',
+                           'fixed_ips': [{'subnet_id': 'top_subnet_1'},
+                                         {'subnet_id': 'top_subnet_2'}]},
+                          {'id': 'top_port_2',
+                           'network_id': 'top_net',
+                           'device_id': 'top_router',
+                           'fixed_ips': []}], ports)
+
+        ports = [{'id': 'bottom_port_3', 'network_id': 'bottom_net'}]
+        ports = id_rewriter.PORT_REWRITER.rewrite(self.context, ports,
+                                                  drop_unmapped=False)
+        self.assertEqual([{'id': 'bottom_port_3', 'network_id': 'top_net'}],
+                         ports)
+
+    def test_nested_list(self):
+        rewriter = id_rewriter.Rewriter(
+            {'ports[].fixed_ips[].subnet_id': constants.RT_SUBNET,
+             'subnets[]': constants.RT_SUBNET})
+        resources = [
+            {'ports': [{'fixed_ips': [{'subnet_id': 'bottom_subnet_1'}]}],
+             'subnets': ['bottom_subnet_2', 'bottom_subnet_3']}]
+        rewriter.rewrite(self.context, resources)
+        self.assertEqual(
+            [{'ports': [{'fixed_ips': [{'subnet_id': 'top_subnet_1'}]}],
+              'subnets': ['top_subnet_2', 'bottom_subnet_3']}], resources)
+
+    def tearDown(self):
+        id_index.clear()
+        core.ModelBase.metadata.drop_all(core.get_engine())
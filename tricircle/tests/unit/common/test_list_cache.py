@@ -0,0 +1,159 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import eventlet
+import mock
+import unittest
+
+from oslo_config import cfg
+
+from tricircle.common import context
+from tricircle.common import list_cache
+
+
+class ListCacheTest(unittest.TestCase):
+    def setUp(self):
+        list_cache.clear()
+        cfg.CONF.set_override('list_cache_ttl', 10)
+        self.context = context.Context(tenant_id='tenant', user_id='user')
+        self.calls = []
+
+    def _list(self, resources):
+        self.calls.append(resources)
+        return iter(resources)
+
+    def _slow_list(self, resources):
+        self.calls.append(resources)
+        eventlet.sleep(0.02)
+        return resources
+
+    def test_get_disabled(self):
+        cfg.CONF.set_override('list_cache_ttl', 0)
+        for _ in xrange(2):
+            self.assertEqual(['res'], list(list_cache.get(
+                self.context, 'tenant', 'pod', 'server',
+                lambda: self._list(['res']))))
+        self.assertEqual(2, len(self.calls))
+        self.assertEqual(0, list_cache.get_stats()['size'])
+
+    @mock.patch('time.time')
+    def test_get_expire(self, mock_time):
+        mock_time.return_value = 100
+        self.assertEqual(['res_1'], list_cache.get(
+            self.context, 'tenant', 'pod', 'server',
+            lambda: self._list(['res_1'])))
+        mock_time.return_value = 110
+        self.assertEqual(['res_1'], list_cache.get(
+            self.context, 'tenant', 'pod', 'server',
+            lambda: self._list(['res_2'])))
+        # resources of another pod or query are listed separately
+        list_cache.get(self.context, 'tenant', 'pod_2', 'server',
+                       lambda: self._list(['res_3']))
+        list_cache.get(self.context, 'tenant', 'pod', 'server',
+                       lambda: self._list(['res_4']), query='status=ok')
+        mock_time.return_value = 111
+        self.assertEqual(['res_5'], list_cache.get(
+            self.context, 'tenant', 'pod', 'server',
+            lambda: self._list(['res_5'])))
+        self.assertEqual([['res_1'], ['res_3'], ['res_4'], ['res_5']],
+                         self.calls)
+        stats = list_cache.get_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(4, stats['misses'])
+
+    def test_get_failure_not_cached(self):
+        list_cache.get(self.context, 'tenant', 'pod', 'server', lambda: None)
+        self.assertEqual(['res'], list_cache.get(
+            self.context, 'tenant', 'pod', 'server',
+            lambda: self._list(['res'])))
+
+    def test_invalidate(self):
+        list_cache.get(self.context, 'tenant_1', 'pod', 'server',
+                       lambda: self._list(['res_1']))
+        list_cache.get(self.context, 'tenant_2', 'pod', 'server',
+                       lambda: self._list(['res_2']))
+        list_cache.invalidate('tenant_1')
+        self.assertEqual(['res_3'], list_cache.get(
+            self.context, 'tenant_1', 'pod', 'server',
+            lambda: self._list(['res_3'])))
+        self.assertEqual(['res_2'], list_cache.get(
+            self.context, 'tenant_2', 'pod', 'server',
+            lambda: self._list(['res_4'])))
+
+    def test_get_caller_scope(self):
+        list_cache.get(self.context, 'tenant', 'pod', 'server',
+                       lambda: self._list(['res_1']))
+        # callers with other credentials do not get the cached resources
+        other_ctxs = [
+            context.Context(tenant_id='tenant_2', user_id='user'),
+            context.Context(tenant_id='tenant', user_id='user_2'),
+            context.Context(tenant_id='tenant', user_id='user',
+                            is_admin=True)]
+        for i, other_ctx in enumerate(other_ctxs):
+            self.assertEqual(['res_%d' % (i + 2)], list_cache.get(
+                other_ctx, 'tenant', 'pod', 'server',
+                lambda: self._list(['res_%d' % (i + 2)])))
+        self.assertEqual(['res_1'], list_cache.get(
+            self.context, 'tenant', 'pod', 'server',
+            lambda: self._list(['res_5'])))
+        # all the entries of the tenant are invalidated
+        list_cache.invalidate('tenant')
+        self.assertEqual(0, list_cache.get_stats()['size'])
+
+    def test_get_coalesced(self):
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(
+            lambda i: list_cache.get(
+                self.context, 'tenant', 'pod', 'server',
+                lambda: self._slow_list(['res_%d' % i])),
+            xrange(3)))
+        self.assertEqual([['res_0']] * 3, results)
+        self.assertEqual([['res_0']], self.calls)
+        self.assertEqual(2, list_cache.get_stats()['coalesced'])
+        self.assertEqual(0, list_cache.get_stats()['inflight'])
+
+    def test_get_coalesced_error(self):
+        def _list():
+            eventlet.sleep(0.02)
+            raise Exception('list error')
+
+        def _get():
+            try:
+                list_cache.get(self.context, 'tenant', 'pod', 'server', _list)
+            except Exception as e:
+                return str(e)
+
+        pool = eventlet.GreenPool()
+        self.assertEqual(['list error'] * 2,
+                         list(pool.imap(lambda i: _get(), xrange(2))))
+        self.assertEqual(0, list_cache.get_stats()['size'])
+
+    def test_invalidate_while_listing(self):
+        def _get():
+            return list_cache.get(self.context, 'tenant', 'pod', 'server',
+                                  lambda: self._slow_list(['res_1']))
+
+        thread = eventlet.spawn(_get)
+        eventlet.sleep(0)
+        list_cache.invalidate('tenant')
+        self.assertEqual(['res_1'], thread.wait())
+        # resources listed before the invalidation are not cached
+        self.assertEqual(['res_2'], list_cache.get(
+            self.context, 'tenant', 'pod', 'server',
+            lambda: self._list(['res_2'])))
+
+    def tearDown(self):
+        cfg.CONF.clear_override('list_cache_ttl')
+        list_cache.clear()
@@ -0,0 +1,225 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+# All Rights Reserved
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import datetime
+import eventlet
+import mock
+import unittest
+
+from oslo_config import cfg
+
+from tricircle.common import context
+from tricircle.common import exceptions
+from tricircle.common import lock_handle
+from tricircle.db import api
+from tricircle.db import core
+from tricircle.db import models
+
+
+class FakeException(Exception):
+    pass
+
+
+class LockHandleTest(unittest.TestCase):
+    def setUp(self):
+        core.initialize()
+        core.ModelBase.metadata.create_all(core.get_engine())
+        self.context = context.Context()
+        self.pod = {'pod_id': 'pod_id_1', 'pod_name': 'pod_1',
+                    'az_name': 'az_name_1'}
+        api.create_pod(self.context, self.pod)
+        self.ele = {'id': 'top_net_id'}
+        self.list_ele_method = mock.Mock(return_value=[])
+        self.create_ele_method = mock.Mock(
+            return_value={'id': 'bottom_net_id'})
+
+    def _create_route(self, bottom_id=None, updated_at=None):
+        with self.context.session.begin():
+            route = core.create_resource(
+                self.context, models.ResourceRouting,
+                {'top_id': 'top_net_id', 'pod_id': 'pod_id_1',
+                 'bottom_id': bottom_id, 'resource_type': 'network'})
+            if updated_at:
+                core.update_resource(self.context, models.ResourceRouting,
+                                     route['id'], {'updated_at': updated_at})
+        return route
+
+    def _get_or_create_element(self):
+        return lock_handle.get_or_create_element(
+            self.context, None, 'project_id', self.pod, self.ele, 'network',
+            {}, self.list_ele_method, self.create_ele_method)
+
+    def test_get_or_create_element(self):
+        is_new, bottom_id = self._get_or_create_element()
+        self.assertTrue(is_new)
+        self.assertEqual('bottom_net_id', bottom_id)
+        self.assertEqual({}, lock_handle._route_events)
+
+        is_new, bottom_id = self._get_or_create_element()
+        self.assertFalse(is_new)
+        self.assertEqual('bottom_net_id', bottom_id)
+        self.assertEqual(1, self.create_ele_method.call_count)
+
+    @mock.patch.object(eventlet, 'sleep')
+    def test_get_or_create_element_backoff(self, mock_sleep):
+        cfg.CONF.set_override('route_max_tries', 4)
+        self._create_route()
+        self.assertRaises(exceptions.RoutingCreateFail,
+                          self._get_or_create_element)
+        intervals = [call[0][0] for call in mock_sleep.call_args_list]
+        self.assertEqual(4, len(intervals))
+        for i, interval in enumerate(intervals):
+            max_interval = min(0.1 * (2 ** i), 2.0)
+            self.assertTrue(max_interval / 2 <= interval <= max_interval)
+        self.assertFalse(self.create_ele_method.called)
+
+    @mock.patch.object(eventlet, 'sleep')
+    def test_get_or_create_element_wait(self, mock_sleep):
+        route = self._create_route()
+
+        def bind_route(interval):
+            with self.context.session.begin():
+                core.update_resource(self.context, models.ResourceRouting,
+                                     route['id'],
+                                     {'bottom_id': 'bottom_net_id'})
+        mock_sleep.side_effect = bind_route
+
+        is_new, bottom_id = self._get_or_create_element()
+        self.assertFalse(is_new)
+        self.assertEqual('bottom_net_id', bottom_id)
+        self.assertEqual(1, mock_sleep.call_count)
+
+    def test_get_or_create_element_expire(self):
+        updated_at = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=cfg.CONF.route_expire_threshold + 1)
+        self._create_route(updated_at=updated_at)
+
+        is_new, bottom_id = self._get_or_create_element()
+        self.assertTrue(is_new)
+        self.assertEqual('bottom_net_id', bottom_id)
+        self.list_ele_method.assert_called_once_with(
+            self.context, None, self.pod, 'top_net_id', 'network')
+
+    def test_get_or_create_element_notify(self):
+        cfg.CONF.set_override('route_retry_interval', 10)
+        cfg.CONF.set_override('route_retry_interval_max', 10)
+        route = self._create_route()
+        key = ('top_net_id', 'pod_id_1')
+        route_event = eventlet.event.Event()
+        lock_handle._route_events[key] = route_event
+
+        def bind_route():
+            with self.context.session.begin():
+                core.update_resource(self.context, models.ResourceRouting,
+                                     route['id'],
+                                     {'bottom_id': 'bottom_net_id'})
+            lock_handle._notify_route_done(key)
+
+        eventlet.spawn_after(0.01, bind_route)
+        with eventlet.Timeout(1):
+            is_new, bottom_id = self._get_or_create_element()
+        self.assertFalse(is_new)
+        self.assertEqual('bottom_net_id', bottom_id)
+        self.assertEqual({}, lock_handle._route_events)
+
+    def test_get_or_create_routes(self):
+        pod2 = {'pod_id': 'pod_id_2', 'pod_name': 'pod_2',
+                'az_name': 'az_name_2'}
+        api.create_pod(self.context, pod2)
+        bound_route = self._create_route(bottom_id='bottom_net_id')
+        eles = [('top_net_id', self.pod, 'network'),
+                ('top_subnet_id', self.pod, 'subnet'),
+                ('top_port_id', self.pod, 'port'),
+                ('top_net_id', pod2, 'network')]
+        routes = lock_handle.get_or_create_routes(
+            self.context, None, 'project_id', eles, self.list_ele_method)
+        self.assertEqual(4, len(routes))
+        self.assertEqual((bound_route['id'], False),
+                         (routes[0][0]['id'], routes[0][1]))
+        for i in xrange(1, 4):
+            route, is_new = routes[i]
+            self.assertTrue(is_new)
+            self.assertEqual(eles[i][0], route['top_id'])
+            self.assertEqual(eles[i][1]['pod_id'], route['pod_id'])
+            self.assertEqual(eles[i][2], route['resource_type'])
+            self.assertEqual('project_id', route['project_id'])
+            self.assertIsNone(route['bottom_id'])
+
+        # routes are created, now they exist but are not bound
+        routes = lock_handle.get_or_create_routes(
+            self.context, None, 'project_id', eles, self.list_ele_method)
+        self.assertEqual([False] * 4, [_is_new for _, _is_new in routes])
+        self.assertFalse(self.list_ele_method.called)
+
+    def test_get_or_create_element_prepared_route(self):
+        routes = lock_handle.get_or_create_routes(
+            self.context, None, 'project_id',
+            [('top_net_id', self.pod, 'network')], self.list_ele_method)
+        is_new, bottom_id = lock_handle.get_or_create_element(
+            self.context, None, 'project_id', self.pod, self.ele, 'network',
+            {}, self.list_ele_method, self.create_ele_method, routes[0])
+        self.assertTrue(is_new)
+        self.assertEqual('bottom_net_id', bottom_id)
+        route = core.get_resource(self.context, models.ResourceRouting,
+                                  routes[0][0]['id'])
+        self.assertEqual('bottom_net_id', route['bottom_id'])
+
+    def test_get_or_create_element_prepared_route_removed(self):
+        routes = lock_handle.get_or_create_routes(
+            self.context, None, 'project_id',
+            [('top_net_id', self.pod, 'network')], self.list_ele_method)
+        # other worker removes the route as expired
+        with self.context.session.begin():
+            core.delete_resource(self.context, models.ResourceRouting,
+                                 routes[0][0]['id'])
+        is_new, bottom_id = lock_handle.get_or_create_element(
+            self.context, None, 'project_id', self.pod, self.ele, 'network',
+            {}, self.list_ele_method, self.create_ele_method, routes[0])
+        self.assertTrue(is_new)
+        self.assertEqual('bottom_net_id', bottom_id)
+        routes = core.query_resource(self.context, models.ResourceRouting,
+                                     [], [])
+        self.assertEqual(1, len(routes))
+        self.assertEqual('bottom_net_id', routes[0]['bottom_id'])
+
+    @mock.patch.object(core, 'update_resource')
+    def test_get_or_create_element_bind_fail(self, mock_update):
+        mock_update.side_effect = FakeException()
+        self.assertRaises(FakeException, self._get_or_create_element)
+        self.assertEqual({}, lock_handle._route_events)
+
+    def test_delete_unbound_routes(self):
+        routes = lock_handle.get_or_create_routes(
+            self.context, None, 'project_id',
+            [('top_net_id', self.pod, 'network'),
+             ('top_subnet_id', self.pod, 'subnet')], self.list_ele_method)
+        with self.context.session.begin():
+            core.update_resource(self.context, models.ResourceRouting,
+                                 routes[0][0]['id'],
+                                 {'bottom_id': 'bottom_net_id'})
+        lock_handle.delete_unbound_routes(
+            self.context, [route for route, _ in routes])
+        routes = core.query_resource(self.context, models.ResourceRouting,
+                                     [], [])
+        self.assertEqual(1, len(routes))
+        self.assertEqual('bottom_net_id', routes[0]['bottom_id'])
+
+    def tearDown(self):
+        cfg.CONF.clear_override('route_max_tries')
+        cfg.CONF.clear_override('route_retry_interval')
+        cfg.CONF.clear_override('route_retry_interval_max')
+        lock_handle._route_events.clear()
+        core.ModelBase.metadata.drop_all(core.get_engine())
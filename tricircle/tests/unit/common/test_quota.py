@@ -18,6 +18,7 @@
 import copy
 import datetime
 import mock
+import time
 import unittest
 
 from oslo_config import cfg
@@ -25,6 +26,8 @@ from oslo_utils import timeutils
 from oslo_utils import uuidutils
 from oslotest import moxstubout
 
+from keystoneclient import exceptions as k_exceptions
+
 from tricircle.common import constants as cons
 from tricircle.common import context
 from tricircle.common import exceptions
@@ -124,6 +127,9 @@ class QuotaTestBase(unittest.TestCase):
 
     def tearDown(self):
         super(QuotaTestBase, self).tearDown()
+        db_api.invalidate_quota_class_cache()
+        quota.invalidate_project_cache()
+        quota.invalidate_limit_snapshots()
         core.ModelBase.metadata.drop_all(core.get_engine())
 
 
@@ -644,6 +650,23 @@ class QuotaEngineTestCase(QuotaTestBase):
                           'test_resource3', 'test_resource4'],
                          quota_obj.resource_names)
 
+    def test_all_quota_engine_resources(self):
+        quota_obj = quota.AllQuotaEngine(quota_driver_class=FakeDriver())
+        resources = quota_obj.resources
+        self.assertIs(resources, quota_obj.resources)
+        self.assertIn('volumes', resources)
+        self.assertIsInstance(resources['key_pairs'],
+                              quota.CountableResource)
+        self.assertFalse(hasattr(resources['volumes'], 'sync'))
+        self.assertFalse(hasattr(resources['volumes'], '__dict__'))
+
+        quota_obj.refresh_resources([{'id': 'type_id', 'name': 'ssd'}])
+        self.assertIsNot(resources, quota_obj.resources)
+        for name in ('volumes_ssd', 'gigabytes_ssd', 'snapshots_ssd'):
+            self.assertEqual('type_id',
+                             quota_obj.resources[name].volume_type_id)
+        self.assertEqual(len(resources) + 3, len(quota_obj.resources))
+
 
 class DbQuotaDriverTestCase(QuotaTestBase, base.TestCase):
     def setUp(self):
@@ -788,57 +811,50 @@ class DbQuotaDriverTestCase(QuotaTestBase, base.TestCase):
         self.assertEqual(['quota_class_get_all_by_name'], self.calls)
         self.assertEqual(self.test_class_quota, result)
 
-    def _stub_get_by_project(self):
-        def fake_qgabp(context, project_id):
-            self.calls.append('quota_get_all_by_project')
+    def _stub_quota_load_all_by_project(self, project_quotas,
+                                        project_usages):
+        # Stub out quota_load_all_by_project
+        def fake_qlabp(context, project_id, quota_class=None,
+                       default_class=False, usages=True):
+            self.calls.append(('quota_load_all_by_project', quota_class,
+                               default_class, usages))
             self.assertEqual('test_project', project_id)
-            return dict(volumes=10, gigabytes=50, reserved=0,
-                        snapshots=10, backups=10,
-                        backup_gigabytes=50)
+            result = {'quotas': dict(project_quotas),
+                      'allocated': dict(self.allocated_quotas,
+                                        project_id=project_id),
+                      'usages': dict(project_usages) if usages else {},
+                      'class_quotas': {},
+                      'default_quotas': {}}
+            if quota_class:
+                self.assertEqual('test_class', quota_class)
+                result['class_quotas'] = self.test_class_quota
+            if default_class:
+                result['default_quotas'] = self.default_quota
+            return result
+
+        self.allocated_quotas = {}
+        self.stubs.Set(db_api, 'quota_load_all_by_project', fake_qlabp)
 
-        def fake_qugabp(context, project_id):
-            self.calls.append('quota_usage_get_all_by_project')
-            self.assertEqual('test_project', project_id)
-            return dict(volumes=dict(in_use=2, reserved=0),
-                        snapshots=dict(in_use=2, reserved=0),
-                        gigabytes=dict(in_use=10, reserved=0),
-                        backups=dict(in_use=2, reserved=0),
-                        backup_gigabytes=dict(in_use=10, reserved=0)
-                        )
-
-        self.stubs.Set(db_api, 'quota_get_all_by_project', fake_qgabp)
-        self.stubs.Set(db_api, 'quota_usage_get_all_by_project', fake_qugabp)
-
-        self._stub_quota_class_get_all_by_name()
-        self._stub_quota_class_get_default()
+    def _stub_get_by_project(self):
+        self._stub_quota_load_all_by_project(
+            dict(volumes=10, gigabytes=50, reserved=0,
+                 snapshots=10, backups=10,
+                 backup_gigabytes=50),
+            dict(volumes=dict(in_use=2, reserved=0),
+                 snapshots=dict(in_use=2, reserved=0),
+                 gigabytes=dict(in_use=10, reserved=0),
+                 backups=dict(in_use=2, reserved=0),
+                 backup_gigabytes=dict(in_use=10, reserved=0)))
 
     def _stub_get_by_subproject(self):
-        def fake_qgabp(context, project_id):
-            self.calls.append('quota_get_all_by_project')
-            self.assertEqual('test_project', project_id)
-            return dict(volumes=10, gigabytes=50, reserved=0)
-
-        def fake_qugabp(context, project_id):
-            self.calls.append('quota_usage_get_all_by_project')
-            self.assertEqual('test_project', project_id)
-            return dict(volumes=dict(in_use=2, reserved=0),
-                        gigabytes=dict(in_use=10, reserved=0))
-
-        self.stubs.Set(db_api, 'quota_get_all_by_project', fake_qgabp)
-        self.stubs.Set(db_api, 'quota_usage_get_all_by_project', fake_qugabp)
-
-        self._stub_quota_class_get_all_by_name()
+        self._stub_quota_load_all_by_project(
+            dict(volumes=10, gigabytes=50, reserved=0),
+            dict(volumes=dict(in_use=2, reserved=0),
+                 gigabytes=dict(in_use=10, reserved=0)))
 
     def _stub_allocated_get_all_by_project(self, allocated_quota=False):
-        def fake_qagabp(context, project_id):
-            self.calls.append('quota_allocated_get_all_by_project')
-            self.assertEqual('test_project', project_id)
-            if allocated_quota:
-                return dict(project_id=project_id, volumes=3)
-            return dict(project_id=project_id)
-
-        self.stubs.Set(db_api, 'quota_allocated_get_all_by_project',
-                       fake_qagabp)
+        if allocated_quota:
+            self.allocated_quotas = dict(volumes=3)
 
     def test_get_project_quotas(self):
         self._stub_get_by_project()
@@ -847,11 +863,8 @@ class DbQuotaDriverTestCase(QuotaTestBase, base.TestCase):
             FakeContext('test_project', 'test_class'),
             quota.QUOTAS.resources, 'test_project')
 
-        self.assertEqual(['quota_get_all_by_project',
-                          'quota_usage_get_all_by_project',
-                          'quota_allocated_get_all_by_project',
-                          'quota_class_get_all_by_name',
-                          'quota_class_get_default', ], self.calls)
+        self.assertEqual([('quota_load_all_by_project', 'test_class', True,
+                           True)], self.calls)
 
         expected = dict(volumes=dict(limit=10,
                                      in_use=2,
@@ -881,10 +894,8 @@ class DbQuotaDriverTestCase(QuotaTestBase, base.TestCase):
             FakeContext('test_project', None),
             quota.QUOTAS.resources, 'test_project')
 
-        self.assertEqual(['quota_get_all_by_project',
-                          'quota_usage_get_all_by_project',
-                          'quota_allocated_get_all_by_project',
-                          'quota_class_get_default', ], self.calls)
+        self.assertEqual([('quota_load_all_by_project', None, True,
+                           True)], self.calls)
 
         expected = dict(volumes=dict(limit=10,
                                      in_use=2,
@@ -922,9 +933,8 @@ class DbQuotaDriverTestCase(QuotaTestBase, base.TestCase):
             quota.QUOTAS.resources, 'test_project',
             parent_project_id=parent_project_id)
 
-        self.assertEqual(['quota_get_all_by_project',
-                          'quota_usage_get_all_by_project',
-                          'quota_allocated_get_all_by_project', ], self.calls)
+        self.assertEqual([('quota_load_all_by_project', None, False,
+                           True)], self.calls)
 
         expected = dict(volumes=dict(limit=10,
                                      in_use=2,
@@ -959,9 +969,8 @@ class DbQuotaDriverTestCase(QuotaTestBase, base.TestCase):
             FakeContext('other_project', 'other_class'),
             quota.QUOTAS.resources, 'test_project')
 
-        self.assertEqual(['quota_get_all_by_project',
-                          'quota_usage_get_all_by_project',
-                          'quota_class_get_default', ], self.calls)
+        self.assertEqual([('quota_load_all_by_project', None, True,
+                           True)], self.calls)
 
         expected = dict(volumes=dict(limit=10,
                                      in_use=2,
@@ -992,10 +1001,8 @@ class DbQuotaDriverTestCase(QuotaTestBase, base.TestCase):
             FakeContext('other_project', 'other_class'),
             quota.QUOTAS.resources, 'test_project', quota_class='test_class')
 
-        self.assertEqual(['quota_get_all_by_project',
-                          'quota_usage_get_all_by_project',
-                          'quota_class_get_all_by_name',
-                          'quota_class_get_default', ], self.calls)
+        self.assertEqual([('quota_load_all_by_project', 'test_class', True,
+                           True)], self.calls)
 
         expected = dict(volumes=dict(limit=10,
                                      in_use=2,
@@ -1024,10 +1031,8 @@ class DbQuotaDriverTestCase(QuotaTestBase, base.TestCase):
             FakeContext('test_project', 'test_class'),
             quota.QUOTAS.resources, 'test_project', defaults=False)
 
-        self.assertEqual(['quota_get_all_by_project',
-                          'quota_usage_get_all_by_project',
-                          'quota_class_get_all_by_name',
-                          'quota_class_get_default', ], self.calls)
+        self.assertEqual([('quota_load_all_by_project', 'test_class', True,
+                           True)], self.calls)
 
         expected = dict(backups=dict(limit=10,
                                      in_use=2,
@@ -1053,9 +1058,8 @@ class DbQuotaDriverTestCase(QuotaTestBase, base.TestCase):
             FakeContext('test_project', 'test_class'),
             quota.QUOTAS.resources, 'test_project', usages=False)
 
-        self.assertEqual(['quota_get_all_by_project',
-                          'quota_class_get_all_by_name',
-                          'quota_class_get_default', ], self.calls)
+        self.assertEqual([('quota_load_all_by_project', 'test_class', True,
+                           False)], self.calls)
         expected = dict(volumes=dict(limit=10, ),
                         snapshots=dict(limit=10, ),
                         backups=dict(limit=10, ),
@@ -1219,6 +1223,53 @@ class DbQuotaDriverTestCase(QuotaTestBase, base.TestCase):
         self.assertEqual([('quota_destroy_by_project', ('test_project')), ],
                          self.calls)
 
+    def test_limit_check_snapshot(self):
+        resources = {
+            'metadata_items': quota.AbsoluteResource(
+                'metadata_items', 'quota_metadata_items'),
+            'volumes': quota.ReservableResource('volumes', 'sync_volumes')}
+        ctx = FakeContext('test_project', 'snapshot_class')
+
+        def check(value):
+            self.driver.limit_check(ctx, resources,
+                                    {'metadata_items': value})
+
+        # snapshots out of date are removed when a snapshot is added
+        quota._limit_snapshots[('other_project', None)] = (
+            db_api.get_quota_limits_version() - 1, time.time() + 60, {})
+        with mock.patch.object(
+                db_api, 'quota_load_all_by_project',
+                wraps=db_api.quota_load_all_by_project) as mock_load:
+            check(128)
+            self.assertEqual([('test_project', 'snapshot_class')],
+                             quota._limit_snapshots.keys())
+            self.assertRaises(exceptions.OverQuota, check, 129)
+            self.assertEqual(1, mock_load.call_count)
+
+            db_api.quota_create(self.ctx, 'test_project',
+                                'metadata_items', 5)
+            self.assertRaises(exceptions.OverQuota, check, 10)
+            db_api.quota_update(self.ctx, 'test_project',
+                                'metadata_items', 20)
+            check(10)
+            db_api.quota_destroy(self.ctx, 'test_project', 'metadata_items')
+            check(128)
+            db_api.quota_class_create(self.ctx, 'snapshot_class',
+                                      'metadata_items', 1)
+            self.assertRaises(exceptions.OverQuota, check, 2)
+            check(1)
+            self.assertEqual(5, mock_load.call_count)
+
+            self.assertRaises(exceptions.QuotaResourceUnknown,
+                              self.driver.limit_check, ctx, resources,
+                              {'volumes': 1})
+
+            quota.invalidate_limit_snapshots()
+            self.flags(limit_snapshot_ttl=0)
+            check(1)
+            check(1)
+            self.assertEqual(7, mock_load.call_count)
+
 
 class FakeSession(object):
     def begin(self):
@@ -1271,37 +1322,56 @@ class QuotaReserveTestCase(QuotaTestBase, base.TestCase):
         self.usages_created = {}
         self.reservations_created = {}
 
-        def fake_get_quota_usages(context, session, project_id):
-            return self.usages.copy()
+        def fake_get_quota_usages_by_resources(context, session, project_id,
+                                               resources):
+            return dict((resource, usage)
+                        for resource, usage in self.usages.items()
+                        if resource in resources)
+
+        def fake_quota_usages_create(context, project_id, resources,
+                                     until_refresh, session=None):
+            quota_usage_refs = {}
+            for resource in resources:
+                quota_usage_ref = self._make_quota_usage(
+                    project_id, resource, 0, 0, until_refresh,
+                    timeutils.utcnow(), timeutils.utcnow())
 
-        def fake_quota_usage_create(context, project_id, resource, in_use,
-                                    reserved, until_refresh, session=None,
-                                    save=True):
-            quota_usage_ref = self._make_quota_usage(
-                project_id, resource, in_use, reserved, until_refresh,
-                timeutils.utcnow(), timeutils.utcnow())
+                self.usages_created[resource] = quota_usage_ref
+                quota_usage_refs[resource] = quota_usage_ref
 
-            self.usages_created[resource] = quota_usage_ref
+            return quota_usage_refs
 
-            return quota_usage_ref
+        def fake_reservations_create(context, project_id, usages, deltas,
+                                     expire, session=None):
+            reservations = []
+            for resource, delta in deltas.items():
+                reservation_ref = self._make_reservation(
+                    uuidutils.generate_uuid(), usages[resource], project_id,
+                    resource, delta, expire,
+                    timeutils.utcnow(), timeutils.utcnow())
 
-        def fake_reservation_create(context, uuid, usage_id, project_id,
-                                    resource, delta, expire, session=None):
-            reservation_ref = self._make_reservation(
-                uuid, usage_id, project_id, resource, delta, expire,
-                timeutils.utcnow(), timeutils.utcnow())
+                self.reservations_created[resource] = reservation_ref
+                reservations.append(reservation_ref.uuid)
 
-            self.reservations_created[resource] = reservation_ref
+            return reservations
 
-            return reservation_ref
+        def fake_quota_usages_add_reserved(context, usages, deltas,
+                                           session=None):
+            for resource, delta in deltas.items():
+                usages[resource].reserved += delta
 
         mox_fixture = self.useFixture(moxstubout.MoxStubout())
         self.mox = mox_fixture.mox
         self.stubs = mox_fixture.stubs
 
-        self.stubs.Set(db_api, '_get_quota_usages', fake_get_quota_usages)
-        self.stubs.Set(db_api, '_quota_usage_create', fake_quota_usage_create)
-        self.stubs.Set(db_api, '_reservation_create', fake_reservation_create)
+        self.stubs.Set(db_api, '_get_quota_usages_by_resources',
+                       fake_get_quota_usages_by_resources)
+        self.stubs.Set(db_api, '_quota_usages_create',
+                       fake_quota_usages_create)
+        self.stubs.Set(db_api, '_reservations_create',
+                       fake_reservations_create)
+        self.stubs.Set(db_api, '_quota_usages_add_reserved',
+                       fake_quota_usages_add_reserved)
 
         patcher = mock.patch.object(timeutils, 'utcnow')
         self.addCleanup(patcher.stop)
@@ -1644,14 +1714,35 @@ def _make_subproject_body(tenant_id='foo', root=True, **kw):
     return _make_body(tenant_id=tenant_id, root=root, **kw)
 
 
+class FakeKeystone(object):
+    """Keystone v3 client stand-in serving a fixed project hierarchy."""
+
+    class FakeProjectManager(object):
+        def __init__(self, project_by_id):
+            self.project_by_id = project_by_id
+            self.calls = []
+
+        def get(self, id, subtree_as_ids=False):
+            self.calls.append(id)
+            if id not in self.project_by_id:
+                raise k_exceptions.NotFound()
+            project = self.project_by_id[id]
+            return QuotaSetsOperationTest.FakeProject(
+                project.id, project.parent_id,
+                project.subtree if subtree_as_ids else None)
+
+    def __init__(self, project_by_id, version='v3'):
+        self.version = version
+        self.projects = self.FakeProjectManager(project_by_id)
+
+
 class QuotaSetsOperationTest(DbQuotaDriverTestCase, base.TestCase):
 
-    class FakeProject(object):
+    class FakeProject(quota.QuotaSetOperation.GenericProjectInfo):
 
-        def __init__(self, id='foo', parent_id=None):
-            self.id = id
-            self.parent_id = parent_id
-            self.subtree = None
+        def __init__(self, id='foo', parent_id=None, subtree=None):
+            super(QuotaSetsOperationTest.FakeProject, self).__init__(
+                id, 'v3', parent_id, subtree)
 
     def setUp(self):
         super(QuotaSetsOperationTest, self).setUp()
@@ -1836,6 +1927,69 @@ class QuotaSetsOperationTest(DbQuotaDriverTestCase, base.TestCase):
                           qso.show_detail_quota,
                           self.ctx)
 
+    def _quota_set_operation(self, target_project_id, keystone):
+        qso = quota.QuotaSetOperation(target_project_id)
+        qso._keystone_client = mock.Mock(return_value=keystone)
+        return qso
+
+    def test_show_project_hierarchy_cached(self):
+        keystone = FakeKeystone(self.project_by_id)
+        self.ctx.project_id = self.A.id
+        expected = _make_subproject_body(tenant_id=self.D.id, root=True,
+                                         **self.subproject_defualt_quota)
+        result = self._quota_set_operation(
+            self.D.id, keystone).show_detail_quota(self.ctx)
+        self.assertDictMatch(expected, result)
+        self.assertEqual([self.D.id, self.A.id], keystone.projects.calls)
+
+        # projects in the subtree of A are cached along with A
+        self.ctx.project_id = self.B.id
+        result = self._quota_set_operation(
+            self.D.id, keystone).show_detail_quota(self.ctx)
+        self.assertDictMatch(expected, result)
+        self.assertEqual([self.D.id, self.A.id], keystone.projects.calls)
+        self.assertRaises(exceptions.HTTPForbiddenError,
+                          self._quota_set_operation(
+                              self.C.id, keystone).show_detail_quota,
+                          self.ctx)
+        self.assertEqual([self.D.id, self.A.id], keystone.projects.calls)
+
+        quota.invalidate_project_cache(self.D.id)
+        self.ctx.project_id = self.A.id
+        self._quota_set_operation(self.D.id,
+                                  keystone).show_detail_quota(self.ctx)
+        self.assertEqual([self.D.id, self.A.id, self.D.id],
+                         keystone.projects.calls)
+
+    @mock.patch('time.time')
+    def test_show_project_hierarchy_cache_purge(self, mock_time):
+        keystone = FakeKeystone(self.project_by_id)
+        self.ctx.project_id = self.A.id
+        mock_time.return_value = 100000
+        quota._project_cache['expired_project'] = (100, None)
+        # expired projects are removed when other projects are cached
+        self._quota_set_operation(self.D.id,
+                                  keystone).show_detail_quota(self.ctx)
+        self.assertNotIn('expired_project', quota._project_cache)
+        self.assertIn(self.D.id, quota._project_cache)
+
+    def test_show_project_hierarchy_cache_disabled(self):
+        self.flags(project_hierarchy_cache_ttl=0)
+        keystone = FakeKeystone(self.project_by_id)
+        self.ctx.project_id = self.A.id
+        for _ in xrange(2):
+            self._quota_set_operation(self.D.id,
+                                      keystone).show_detail_quota(self.ctx)
+        self.assertEqual([self.D.id, self.A.id] * 2, keystone.projects.calls)
+
+    def test_get_project_not_found(self):
+        keystone = FakeKeystone(self.project_by_id)
+        qso = self._quota_set_operation('bad_project', keystone)
+        for _ in xrange(2):
+            self.assertRaises(exceptions.NotFound, qso._get_project,
+                              self.ctx, 'bad_project')
+        self.assertEqual(['bad_project'] * 2, keystone.projects.calls)
+
     def test_update(self):
         qso = quota.QuotaSetOperation(self.A.id)
         qso._get_project = mock.Mock()
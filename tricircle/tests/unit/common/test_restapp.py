@@ -0,0 +1,114 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+# All Rights Reserved
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+import unittest
+
+from tricircle.common import context
+from tricircle.common import restapp
+from tricircle.db import api
+from tricircle.db import core
+
+
+class FakeException(Exception):
+    pass
+
+
+class FakeState(object):
+    def __init__(self, status_int=200):
+        self.request = mock.Mock(environ={})
+        self.response = mock.Mock(status_int=status_int)
+
+
+class TransactionHookTest(unittest.TestCase):
+    def setUp(self):
+        core.initialize()
+        core.ModelBase.metadata.create_all(core.get_engine())
+        self.context = context.get_admin_context()
+        self.hook = restapp.TransactionHook()
+
+    def _handle_request(self, state, pod_ids):
+        self.hook.before(state)
+        session = state.request.environ[context.DB_SESSION_ENV]
+        with mock.patch.object(context, 'request', state.request):
+            for pod_id in pod_ids:
+                ctx = context.extract_context_from_environ()
+                self.assertIs(session, ctx.session)
+                api.create_pod(ctx, {'pod_id': pod_id,
+                                     'pod_name': pod_id,
+                                     'az_name': 'az'})
+        return session
+
+    def _list_pod_ids(self):
+        return sorted(pod['pod_id'] for pod in api.list_pods(self.context))
+
+    def test_commit(self):
+        state = FakeState()
+        session = self._handle_request(state, ['pod_1', 'pod_2'])
+        with mock.patch.object(session, 'commit',
+                               wraps=session.commit) as mock_commit:
+            self.hook.after(state)
+            mock_commit.assert_called_once_with()
+        self.assertEqual(['pod_1', 'pod_2'], self._list_pod_ids())
+        self.assertNotIn(context.DB_SESSION_ENV, state.request.environ)
+
+    def test_rollback_error_response(self):
+        state = FakeState(status_int=500)
+        self._handle_request(state, ['pod_1', 'pod_2'])
+        self.hook.after(state)
+        self.assertEqual([], self._list_pod_ids())
+
+    def test_rollback_exception(self):
+        state = FakeState()
+        self._handle_request(state, ['pod_1'])
+        self.hook.on_error(state, Exception())
+        self.hook.after(state)
+        self.assertEqual([], self._list_pod_ids())
+
+    def tearDown(self):
+        core.ModelBase.metadata.drop_all(core.get_engine())
+
+
+class WorkerServiceTest(unittest.TestCase):
+    @mock.patch.object(core, 'warmup_engine')
+    def test_start_warmup_fail(self, mock_warmup):
+        mock_warmup.side_effect = FakeException()
+        api_service = mock.Mock()
+        worker = restapp.WorkerService(api_service)
+        worker.start()
+        api_service.start.assert_called_once_with()
+        worker.stop()
+
+
+class PrefetchTest(unittest.TestCase):
+    def test_prefetch(self):
+        reads = []
+
+        def _read():
+            for i in xrange(3):
+                reads.append(i)
+                yield i
+
+        iterator = restapp.prefetch(_read())
+        self.assertEqual([0], reads)
+        self.assertEqual([0, 1, 2], list(iterator))
+        self.assertEqual([], list(restapp.prefetch([])))
+
+    def test_prefetch_error(self):
+        def _read():
+            raise FakeException()
+            yield
+
+        self.assertRaises(FakeException, restapp.prefetch, _read())
@@ -0,0 +1,99 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import eventlet
+import unittest
+
+from eventlet.support import greenlets
+
+from tricircle.common import singleflight
+
+
+class GroupTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+    def _slow_func(self, value):
+        self.calls.append(value)
+        eventlet.sleep(0.02)
+        return {'value': value}
+
+    def test_do_shared(self):
+        group = singleflight.Group()
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(
+            lambda key: group.do(key, self._slow_func, key),
+            ['key_1', 'key_1', 'key_2', 'key_1']))
+        self.assertEqual(['key_1', 'key_2'], self.calls)
+        self.assertEqual([{'value': 'key_1'}, {'value': 'key_1'},
+                          {'value': 'key_2'}, {'value': 'key_1'}], results)
+        self.assertIs(results[0], results[1])
+        self.assertEqual({'inflight': 0, 'called': 2, 'shared': 2},
+                         group.get_stats())
+
+        # finished calls are not kept
+        group.do('key_1', self._slow_func, 'key_1')
+        self.assertEqual(['key_1', 'key_2', 'key_1'], self.calls)
+
+    def test_do_copy(self):
+        group = singleflight.Group(copy_func=copy.deepcopy)
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(
+            lambda i: group.do('key', self._slow_func, 'key'), xrange(3)))
+        self.assertEqual([{'value': 'key'}] * 3, results)
+        self.assertEqual(3, len(set(id(result) for result in results)))
+
+        # result is not copied if not shared
+        result = group.do('key', lambda: results[0])
+        self.assertIs(results[0], result)
+
+    def test_do_error(self):
+        def _func():
+            eventlet.sleep(0.02)
+            raise Exception('func error')
+
+        def _do():
+            try:
+                group.do('key', _func)
+            except Exception as e:
+                return str(e)
+
+        group = singleflight.Group()
+        pool = eventlet.GreenPool()
+        self.assertEqual(['func error'] * 2,
+                         list(pool.imap(lambda i: _do(), xrange(2))))
+        self.assertEqual({'inflight': 0, 'called': 1, 'shared': 1},
+                         group.get_stats())
+
+    def test_do_leader_killed(self):
+        def _do():
+            try:
+                return group.do('key', self._slow_func, 'key')
+            except BaseException as e:
+                return type(e)
+
+        group = singleflight.Group()
+        leader = eventlet.spawn(group.do, 'key', self._slow_func, 'key')
+        eventlet.sleep(0)
+        waiter = eventlet.spawn(_do)
+        eventlet.sleep(0)
+        leader.kill()
+        self.assertEqual(greenlets.GreenletExit, waiter.wait())
+        self.assertEqual(0, group.get_stats()['inflight'])
+
+        # the next call runs the function again
+        self.assertEqual({'value': 'key'},
+                         group.do('key', self._slow_func, 'key'))
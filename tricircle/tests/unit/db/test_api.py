@@ -14,9 +14,12 @@
 #    under the License.
 
 import datetime
+import mock
 import six
 import unittest
 
+from oslo_db import exception as db_exc
+
 from tricircle.common import context
 from tricircle.common import exceptions
 from tricircle.common import quota
@@ -183,6 +186,74 @@ class APITest(unittest.TestCase):
             self.context, current_pod_id='test_pod_uuid_4')
         self.assertIsNone(next_pod)
 
+        # unknown pod
+        next_pod = api.get_next_bottom_pod(
+            self.context, current_pod_id='test_pod_uuid_1_unknown')
+        self.assertIsNone(next_pod)
+
+    def test_create_pod_bindings(self):
+        api.create_pod(self.context, {'pod_id': 'top_pod_id',
+                                      'pod_name': 'top_pod',
+                                      'az_name': ''})
+        for i in xrange(2):
+            api.create_pod(self.context, {'pod_id': 'pod_id_%d' % i,
+                                          'pod_name': 'pod_%d' % i,
+                                          'az_name': 'az_name_%d' % i})
+        first = api.create_pod_bindings(self.context, [
+            {'tenant_id': 'tenant_id_0', 'pod_id': 'pod_id_0'}])[0]
+
+        bindings = [{'tenant_id': 'tenant_id_%d' % i, 'pod_id': 'pod_id_0'}
+                    for i in xrange(5)]
+        bindings.extend([
+            {'tenant_id': 'tenant_id_1', 'pod_id': 'pod_id_1'},
+            {'tenant_id': 'tenant_id_1', 'pod_id': 'pod_id_1'},
+            {'tenant_id': 'tenant_id_1', 'pod_id': 'pod_id_2'},
+            {'tenant_id': 'tenant_id_1', 'pod_id': 'top_pod_id'}])
+        results = api.create_pod_bindings(self.context, bindings,
+                                          batch_size=3)
+        self.assertIsInstance(results[0], exceptions.PodBindingExists)
+        for i in xrange(1, 6):
+            self.assertEqual(bindings[i]['tenant_id'],
+                             results[i]['tenant_id'])
+            self.assertEqual(bindings[i]['pod_id'], results[i]['pod_id'])
+            self.assertIsNotNone(results[i]['created_at'])
+        self.assertIsInstance(results[6], exceptions.PodBindingExists)
+        self.assertIsInstance(results[7], exceptions.ResourceNotFound)
+        self.assertIsInstance(results[8], exceptions.ValidationError)
+
+        with self.context.session.begin():
+            created = core.query_resource(self.context, models.PodBinding,
+                                          [], [])
+        self.assertItemsEqual(
+            [first['id']] + [result['id'] for result in results[1:6]],
+            [binding['id'] for binding in created])
+
+    def test_job_lease(self):
+        self.assertTrue(api.acquire_job_lease(self.context, 'router_id',
+                                              'worker_1', 300))
+        # lease held by worker_1, worker_2 asks for a rerun
+        self.assertFalse(api.acquire_job_lease(self.context, 'router_id',
+                                               'worker_2', 300))
+        self.assertTrue(api.release_job_lease(self.context, 'router_id',
+                                              'worker_1', 300))
+        self.assertFalse(api.release_job_lease(self.context, 'router_id',
+                                               'worker_1', 300))
+        self.assertEqual(
+            [], core.query_resource(self.context, models.JobLease, [], []))
+        self.assertTrue(api.acquire_job_lease(self.context, 'router_id',
+                                              'worker_2', 300))
+
+    def test_job_lease_expire(self):
+        self.assertTrue(api.acquire_job_lease(self.context, 'router_id',
+                                              'worker_1', 0))
+        # lease of worker_1 expires, worker_2 takes it over
+        self.assertTrue(api.acquire_job_lease(self.context, 'router_id',
+                                              'worker_2', 300))
+        self.assertFalse(api.release_job_lease(self.context, 'router_id',
+                                               'worker_1', 300))
+        leases = core.query_resource(self.context, models.JobLease, [], [])
+        self.assertEqual('worker_2', leases[0]['owner'])
+
     def tearDown(self):
         core.ModelBase.metadata.drop_all(core.get_engine())
 
@@ -238,6 +309,7 @@ class QuotaApiTestCase(unittest.TestCase):
             self.assertEqual(value, obj2[key])
 
     def tearDown(self):
+        api.invalidate_quota_class_cache()
         core.ModelBase.metadata.drop_all(core.get_engine())
 
 
@@ -310,6 +382,47 @@ class DBAPIReservationTestCase(QuotaApiTestCase):
                              self.context,
                              'project1'))
 
+    def test_reservation_expire_batch(self):
+        resources = {'volumes': quota.ReservableResource('volumes', None),
+                     'gigabytes': quota.ReservableResource('gigabytes',
+                                                           None)}
+        quotas = {'volumes': 10, 'gigabytes': 100}
+        now = datetime.datetime.utcnow()
+        expired = now - datetime.timedelta(seconds=1)
+        unexpired = now + datetime.timedelta(days=1)
+        for project_id in ('project1', 'project2'):
+            for _ in xrange(2):
+                api.quota_reserve(self.context, resources, quotas,
+                                  {'volumes': 1, 'gigabytes': 10}, expired,
+                                  0, 0, project_id)
+            # negative delta doesn't change reserved count
+            api.quota_reserve(self.context, resources, quotas,
+                              {'volumes': -1}, expired, 0, 0, project_id)
+        reservations = api.quota_reserve(self.context, resources, quotas,
+                                         {'volumes': 1, 'gigabytes': 10},
+                                         unexpired, 0, 0, 'project1')
+
+        self.assertEqual(10, api.reservation_expire(self.context,
+                                                    batch_size=3))
+        self.assertEqual(0, api.reservation_expire(self.context,
+                                                   batch_size=3))
+        self.assertEqual({'project_id': 'project1',
+                          'volumes': {'reserved': 1, 'in_use': 0},
+                          'gigabytes': {'reserved': 10, 'in_use': 0}},
+                         api.quota_usage_get_all_by_project(self.context,
+                                                            'project1'))
+        self.assertEqual({'project_id': 'project2',
+                          'volumes': {'reserved': 0, 'in_use': 0},
+                          'gigabytes': {'reserved': 0, 'in_use': 0}},
+                         api.quota_usage_get_all_by_project(self.context,
+                                                            'project2'))
+        api.reservation_commit(self.context, reservations, 'project1')
+        self.assertEqual({'project_id': 'project1',
+                          'volumes': {'reserved': 0, 'in_use': 1},
+                          'gigabytes': {'reserved': 0, 'in_use': 10}},
+                         api.quota_usage_get_all_by_project(self.context,
+                                                            'project1'))
+
 
 class DBAPIQuotaClassTestCase(QuotaApiTestCase):
 
@@ -387,6 +500,97 @@ class DBAPIQuotaTestCase(QuotaApiTestCase):
                               'res1': 1,
                               'res2': 2}, quotas_db)
 
+    def test_quota_load_all_by_project(self):
+        self._quota_reserve(self.context, 'project1')
+        api.quota_create(self.context, 'project2', 'volumes', 10)
+        api.quota_class_create(self.context, 'test_qc', 'volumes', 20)
+        api.quota_class_create(self.context, 'default', 'volumes', 30)
+        api.quota_class_create(self.context, 'default', 'gigabytes', 40)
+
+        loaded = api.quota_load_all_by_project(
+            self.context, 'project1', quota_class='test_qc',
+            default_class=True)
+        self.assertEqual(
+            api.quota_get_all_by_project(self.context, 'project1'),
+            loaded['quotas'])
+        self.assertEqual(
+            api.quota_allocated_get_all_by_project(self.context, 'project1'),
+            loaded['allocated'])
+        self.assertEqual(
+            api.quota_usage_get_all_by_project(self.context, 'project1'),
+            loaded['usages'])
+        self.assertEqual({'class_name': 'test_qc', 'volumes': 20},
+                         loaded['class_quotas'])
+        self.assertEqual({'class_name': 'default', 'volumes': 30,
+                          'gigabytes': 40}, loaded['default_quotas'])
+
+        loaded = api.quota_load_all_by_project(self.context, 'project1',
+                                               usages=False)
+        self.assertEqual({'project_id': 'project1'}, loaded['usages'])
+        self.assertEqual({}, loaded['class_quotas'])
+        self.assertEqual({}, loaded['default_quotas'])
+
+    def test_quota_load_all_projects(self):
+        for project_id in ('project3', 'project1', 'project2'):
+            self._quota_reserve(self.context, project_id)
+        api.quota_create(self.context, 'project4', 'volumes', 10)
+
+        loaded = list(api.quota_load_all_projects(self.context,
+                                                  batch_size=3))
+        self.assertEqual(['project1', 'project2', 'project3', 'project4'],
+                         [project_id for project_id, _ in loaded])
+        for project_id, project in loaded:
+            self.assertEqual(
+                api.quota_get_all_by_project(self.context, project_id),
+                project['quotas'])
+            self.assertEqual(
+                api.quota_allocated_get_all_by_project(self.context,
+                                                       project_id),
+                project['allocated'])
+            self.assertEqual(
+                api.quota_usage_get_all_by_project(self.context, project_id),
+                project['usages'])
+
+        loaded = list(api.quota_load_all_projects(
+            self.context, ['project4', 'project5', 'project1'], usages=False,
+            batch_size=2))
+        self.assertEqual(['project1', 'project4', 'project5'],
+                         [project_id for project_id, _ in loaded])
+        self.assertEqual({'project_id': 'project1'}, loaded[0][1]['usages'])
+        self.assertEqual({'project_id': 'project5'}, loaded[2][1]['quotas'])
+
+    @mock.patch('time.time')
+    def test_quota_class_cache_purge(self, mock_time):
+        mock_time.return_value = 100
+        api.quota_class_create(self.context, 'class_1', 'volumes', 30)
+        api.quota_class_get_all_by_name(self.context, 'class_1')
+        self.assertIn('class_1', api._quota_class_cache)
+
+        # expired classes are removed when another class is cached
+        mock_time.return_value = 100000
+        api.quota_class_get_default(self.context)
+        self.assertEqual(['default'], api._quota_class_cache.keys())
+
+    def test_quota_class_cache(self):
+        api.quota_class_create(self.context, 'default', 'volumes', 30)
+        self.assertEqual({'class_name': 'default', 'volumes': 30},
+                         api.quota_class_get_default(self.context))
+
+        # changes not made by quota class api are not seen before expiry
+        with self.context.session.begin():
+            self.context.session.query(models.QuotaClasses).update(
+                {'hard_limit': 31})
+        self.assertEqual({'class_name': 'default', 'volumes': 30},
+                         api.quota_class_get_default(self.context))
+        loaded = api.quota_load_all_by_project(self.context, 'project1',
+                                               default_class=True)
+        self.assertEqual({'class_name': 'default', 'volumes': 30},
+                         loaded['default_quotas'])
+
+        api.quota_class_update(self.context, 'default', 'volumes', 32)
+        self.assertEqual({'class_name': 'default', 'volumes': 32},
+                         api.quota_class_get_default(self.context))
+
     def test_quota_update(self):
         api.quota_create(self.context, 'project1', 'resource1', 41)
         api.quota_update(self.context, 'project1', 'resource1', 42)
@@ -420,6 +624,63 @@ class DBAPIQuotaTestCase(QuotaApiTestCase):
                           'volumes': {'reserved': 1, 'in_use': 0}},
                          quota_usage)
 
+    def _reserve(self, deltas, quotas=None):
+        resources = dict(
+            (resource, quota.ReservableResource(resource, None))
+            for resource in deltas)
+        quotas = quotas or dict((resource, 10) for resource in deltas)
+        expire = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        return api.quota_reserve(self.context, resources, quotas, deltas,
+                                 expire, 0, 0, 'project1')
+
+    def test_quota_reserve_partial_resources(self):
+        reservations = self._reserve({'volumes': 1, 'gigabytes': 2})
+        # only usages of volumes and snapshots are touched
+        reservations.extend(self._reserve({'volumes': 2, 'snapshots': -1}))
+        self.assertEqual(4, len(reservations))
+        quota_usage = api.quota_usage_get_all_by_project(self.context,
+                                                         'project1')
+        # negative delta doesn't change reserved count
+        self.assertEqual({'project_id': 'project1',
+                          'gigabytes': {'reserved': 2, 'in_use': 0},
+                          'volumes': {'reserved': 3, 'in_use': 0},
+                          'snapshots': {'reserved': 0, 'in_use': 0}},
+                         quota_usage)
+
+        api.reservation_commit(self.context, reservations, 'project1')
+        quota_usage = api.quota_usage_get_all_by_project(self.context,
+                                                         'project1')
+        self.assertEqual({'project_id': 'project1',
+                          'gigabytes': {'reserved': 0, 'in_use': 2},
+                          'volumes': {'reserved': 0, 'in_use': 3},
+                          'snapshots': {'reserved': 0, 'in_use': -1}},
+                         quota_usage)
+
+    def test_quota_reserve_over_quota(self):
+        self._reserve({'volumes': 1})
+        self.assertRaises(exceptions.OverQuota, self._reserve,
+                          {'volumes': 1}, {'volumes': 1})
+        quota_usage = api.quota_usage_get_all_by_project(self.context,
+                                                         'project1')
+        self.assertEqual({'reserved': 1, 'in_use': 0},
+                         quota_usage['volumes'])
+
+    def test_retry_on_deadlock(self):
+        calls = []
+
+        @api._retry_on_deadlock
+        def deadlock_once():
+            calls.append(1)
+            if len(calls) == 1:
+                raise db_exc.DBDeadlock()
+            return 'done'
+
+        before = api.get_deadlock_retries().get('deadlock_once', 0)
+        with mock.patch('time.sleep'):
+            self.assertEqual('done', deadlock_once())
+        self.assertEqual(before + 1,
+                         api.get_deadlock_retries()['deadlock_once'])
+
     def test_quota_destroy(self):
         api.quota_create(self.context, 'project1', 'resource1', 41)
         self.assertIsNone(api.quota_destroy(self.context, 'project1',
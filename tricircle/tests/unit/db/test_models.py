@@ -16,6 +16,7 @@
 
 import datetime
 import inspect
+import mock
 import unittest
 
 import oslo_db.exception
@@ -189,6 +190,142 @@ class ModelsTest(unittest.TestCase):
         pods = api.list_pods(self.context, filters)
         self.assertEqual(len(pods), 0)
 
+    def test_query_column_only(self):
+        for i, disabled in enumerate([True, False, False]):
+            with self.context.session.begin():
+                core.create_resource(
+                    self.context, models.InstanceTypes,
+                    {'name': 'flavor%d' % i, 'memory_mb': 512, 'vcpus': 1,
+                     'flavorid': 'flavor%d' % i if i else None,
+                     'disabled': disabled})
+
+        def query(filters, sorts):
+            expected = [obj.to_dict() for obj in core._filter_query(
+                models.InstanceTypes,
+                self.context.session.query(models.InstanceTypes),
+                filters).order_by(models.InstanceTypes.id)]
+            if not sorts:
+                sorts = [('id', True)]
+            flavors = core.query_resource(self.context,
+                                          models.InstanceTypes,
+                                          filters, sorts)
+            self.assertEqual(expected, sorted(flavors,
+                                              key=lambda f: f['id']))
+            return flavors
+
+        with mock.patch.object(core, '_build_column_query',
+                               wraps=core._build_column_query) as mock_build:
+            flavors = query([{'key': 'disabled', 'comparator': 'eq',
+                              'value': 'false'}], [])
+            self.assertEqual(['flavor1', 'flavor2'],
+                             [flavor['name'] for flavor in flavors])
+            built = mock_build.call_count
+            flavors = query([{'key': 'disabled', 'comparator': 'eq',
+                              'value': 'true'}], [])
+            self.assertEqual(['flavor0'],
+                             [flavor['name'] for flavor in flavors])
+            # same filter shape reuses the compiled query
+            self.assertEqual(built, mock_build.call_count)
+
+            flavors = query([{'key': 'flavorid', 'comparator': 'eq',
+                              'value': None}], [])
+            self.assertEqual(['flavor0'],
+                             [flavor['name'] for flavor in flavors])
+            flavors = query([], [(models.InstanceTypes.name, False)])
+            self.assertEqual(['flavor2', 'flavor1', 'flavor0'],
+                             [flavor['name'] for flavor in flavors])
+
+    def _create_pods(self, num):
+        for i in xrange(1, num + 1):
+            api.create_pod(self.context, {'pod_id': 'pod_id_%d' % i,
+                                          'pod_name': 'pod_%d' % i,
+                                          'az_name': 'az_%d' % (i % 2)})
+
+    def _list_pod_ids(self, filters=None, sorts=None, limit=None,
+                      marker=None):
+        return [pod['pod_id'] for pod in api.list_pods(
+            self.context, filters, sorts or [(models.Pod.pod_id, True)],
+            limit, marker)]
+
+    def test_query_comparators(self):
+        self._create_pods(4)
+        self.assertEqual(['pod_id_1', 'pod_id_3'], self._list_pod_ids(
+            [{'key': 'az_name', 'comparator': 'ne', 'value': 'az_0'}]))
+        self.assertEqual(['pod_id_3', 'pod_id_4'], self._list_pod_ids(
+            [{'key': 'pod_id', 'comparator': 'gt', 'value': 'pod_id_2'}]))
+        self.assertEqual(['pod_id_1'], self._list_pod_ids(
+            [{'key': 'pod_id', 'comparator': 'lt', 'value': 'pod_id_2'}]))
+        self.assertEqual(['pod_id_2', 'pod_id_4'], self._list_pod_ids(
+            [{'key': 'az_name', 'comparator': 'like', 'value': '%_0'}]))
+        self.assertEqual(['pod_id_1', 'pod_id_4'], self._list_pod_ids(
+            [{'key': 'pod_name', 'comparator': 'in',
+              'value': ['pod_1', 'pod_4', 'pod_5']}]))
+        self.assertEqual([], self._list_pod_ids(
+            [{'key': 'pod_name', 'comparator': 'in', 'value': []}]))
+        self.assertEqual([], self._list_pod_ids(
+            [{'key': 'dc_name', 'comparator': 'is_null', 'value': False}]))
+        self.assertEqual(4, len(self._list_pod_ids(
+            [{'key': 'dc_name', 'comparator': 'is_null', 'value': True}])))
+        # unsupported comparator is ignored
+        self.assertEqual(4, len(self._list_pod_ids(
+            [{'key': 'pod_id', 'comparator': 'unknown', 'value': 'x'}])))
+
+    def test_query_pagination(self):
+        self._create_pods(5)
+        self.assertEqual(['pod_id_1', 'pod_id_2'],
+                         self._list_pod_ids(limit=2))
+        self.assertEqual(['pod_id_3', 'pod_id_4'],
+                         self._list_pod_ids(limit=2, marker='pod_id_2'))
+        self.assertEqual(['pod_id_5'],
+                         self._list_pod_ids(limit=2, marker='pod_id_4'))
+        # ties of sort key are ordered by primary key
+        sorts = [(models.Pod.az_name, False)]
+        self.assertEqual(['pod_id_1', 'pod_id_3', 'pod_id_5', 'pod_id_2'],
+                         self._list_pod_ids(sorts=sorts, limit=4))
+        self.assertEqual(['pod_id_5', 'pod_id_2', 'pod_id_4'],
+                         self._list_pod_ids(sorts=sorts, marker='pod_id_3'))
+        self.assertEqual(['pod_id_4'], self._list_pod_ids(
+            [{'key': 'az_name', 'comparator': 'eq', 'value': 'az_0'}],
+            marker='pod_id_2'))
+        self.assertRaises(exceptions.ResourceNotFound, self._list_pod_ids,
+                          marker='pod_id_6')
+        # pagination needs sort keys to be attributes
+        self.assertRaises(exceptions.ValidationError, self._list_pod_ids,
+                          sorts=[(sql.func.lower(models.Pod.pod_name),
+                                  True)],
+                          marker='pod_id_2')
+
+    def test_query_resource_iter(self):
+        self._create_pods(5)
+        sorts = [('pod_id', False)]
+        with mock.patch.object(core, 'query_resource',
+                               wraps=core.query_resource) as mock_query:
+            pods = core.query_resource_iter(self.context, models.Pod, [],
+                                            sorts, batch_size=2)
+            self.assertEqual(['pod_id_5', 'pod_id_4', 'pod_id_3',
+                              'pod_id_2', 'pod_id_1'],
+                             [pod['pod_id'] for pod in pods])
+            self.assertEqual(3, mock_query.call_count)
+
+            pods = core.query_resource_iter(self.context, models.Pod, [],
+                                            sorts, limit=3,
+                                            marker='pod_id_5', batch_size=2)
+            self.assertEqual(['pod_id_4', 'pod_id_3', 'pod_id_2'],
+                             [pod['pod_id'] for pod in pods])
+            # the last batch only reads the rest of the limit
+            self.assertEqual(5, mock_query.call_count)
+            self.assertEqual(1, mock_query.call_args[1]['limit'])
+
+    def test_get_pod(self):
+        self._create_pods(3)
+        api.create_pod(self.context, {'pod_id': 'top_pod_id',
+                                      'pod_name': 'top_pod',
+                                      'az_name': ''})
+        self.assertEqual('top_pod_id', api.get_top_pod(self.context)['pod_id'])
+        self.assertEqual('pod_id_2',
+                         api.get_pod_by_name(self.context, 'pod_2')['pod_id'])
+        self.assertIsNone(api.get_pod_by_name(self.context, 'pod_4'))
+
     def test_sort(self):
         pod1 = {'pod_id': 'test_pod1_uuid',
                 'pod_name': 'test_pod1',
@@ -243,5 +380,25 @@ class ModelsTest(unittest.TestCase):
                           core.create_resource,
                           self.context, models.ResourceRouting, routing)
 
+    def test_warmup_engine_pool_stats(self):
+        core.warmup_engine()
+        stats = core.get_pool_stats()
+        self.assertEqual(1, stats['checkouts'])
+        self.assertEqual(0, stats['in_use'])
+        self.assertEqual(1, stats['max_in_use'])
+
+        # disposing drops the in-memory database
+        core.ModelBase.metadata.create_all(core.get_engine())
+        api.create_pod(self.context, {'pod_id': 'test_pod_uuid',
+                                      'pod_name': 'test_pod',
+                                      'az_name': 'test_az_uuid'})
+        stats = core.get_pool_stats()
+        self.assertGreater(stats['checkouts'], 1)
+        self.assertGreaterEqual(stats['connects'], 1)
+
+        # listeners are not added again when warming up again
+        core.warmup_engine()
+        self.assertEqual(1, core.get_pool_stats()['checkouts'])
+
     def tearDown(self):
         core.ModelBase.metadata.drop_all(core.get_engine())
@@ -17,9 +17,14 @@ import datetime
 from mock import patch
 import unittest
 
+from oslo_config import cfg
+from oslo_serialization import jsonutils
 from oslo_utils import uuidutils
 
+from tricircle.common import constants
 from tricircle.common import context
+from tricircle.common import id_index
+from tricircle.common import list_cache
 from tricircle.db import api
 from tricircle.db import core
 from tricircle.db import models
@@ -32,8 +37,9 @@ TOP_PORTS = []
 BOTTOM_NETS = []
 BOTTOM_SUBNETS = []
 BOTTOM_PORTS = []
+BOTTOM_SERVERS = []
 RES_LIST = [TOP_NETS, TOP_SUBNETS, TOP_PORTS,
-            BOTTOM_NETS, BOTTOM_SUBNETS, BOTTOM_PORTS]
+            BOTTOM_NETS, BOTTOM_SUBNETS, BOTTOM_PORTS, BOTTOM_SERVERS]
 
 
 class FakeException(Exception):
@@ -61,7 +67,8 @@ class FakeClient(object):
                         'port': TOP_PORTS},
                 'bottom': {'network': BOTTOM_NETS,
                            'subnet': BOTTOM_SUBNETS,
-                           'port': BOTTOM_PORTS}}
+                           'port': BOTTOM_PORTS,
+                           'server': BOTTOM_SERVERS}}
 
     def __init__(self, pod_name):
         self.pod_name = pod_name
@@ -152,6 +159,9 @@ class FakeClient(object):
             'subnet', ctx,
             [{'key': 'id', 'comparator': 'eq', 'value': subnet_id}])[0]
 
+    def list_servers(self, ctx):
+        return [dict(server) for server in self._get_res_list('server')]
+
     def create_servers(self, ctx, body):
         # do nothing here since it will be mocked
         pass
@@ -164,6 +174,8 @@ class ServerTest(unittest.TestCase):
         self.context = context.Context()
         self.project_id = 'test_project'
         self.controller = FakeServerController(self.project_id)
+        id_index.clear()
+        list_cache.clear()
 
     def _prepare_pod(self):
         t_pod = {'pod_id': 't_pod_uuid', 'pod_name': 't_region',
@@ -433,7 +445,80 @@ class ServerTest(unittest.TestCase):
             self.assertEqual(b_pod['pod_id'], routes[0]['pod_id'])
             self.assertEqual(self.project_id, routes[0]['project_id'])
 
+    @patch.object(server, '_REWRITE_BATCH_SIZE', new=2)
+    @patch.object(context, 'extract_context_from_environ')
+    def test_get_all(self, mock_ctx):
+        t_pod, b_pod = self._prepare_pod()
+        mock_ctx.return_value = self.context
+        for i in xrange(1, 5):
+            BOTTOM_SERVERS.append(
+                {'id': 'bottom_server_%d' % i,
+                 'OS-EXT-AZ:availability_zone': 'bottom_az',
+                 'addresses': {
+                     'net': [{'addr': '10.0.0.%d' % i,
+                              'OS-EXT-IPS:type': 'fixed'},
+                             {'addr': '20.0.0.%d' % i,
+                              'OS-EXT-IPS:type': 'floating'},
+                             {'addr': '20.0.1.%d' % i,
+                              'OS-EXT-IPS:type': 'floating'}]}})
+        # server 4 is not bound to any top server
+        with self.context.session.begin():
+            for i in xrange(1, 4):
+                core.create_resource(
+                    self.context, models.ResourceRouting,
+                    {'top_id': 'top_server_%d' % i,
+                     'bottom_id': 'bottom_server_%d' % i,
+                     'pod_id': b_pod['pod_id'],
+                     'project_id': self.project_id,
+                     'resource_type': constants.RT_SERVER})
+
+        for res in (self.controller.get_all(),
+                    self.controller.get_one('detail')):
+            servers = jsonutils.loads(''.join(res.app_iter))['servers']
+            self.assertEqual(['top_server_1', 'top_server_2', 'top_server_3',
+                              'bottom_server_4'],
+                             [s['id'] for s in servers])
+            for i, s in enumerate(servers, 1):
+                self.assertEqual(b_pod['az_name'],
+                                 s['OS-EXT-AZ:availability_zone'])
+                self.assertEqual(
+                    {'net': [{'addr': '10.0.0.%d' % i,
+                              'OS-EXT-IPS:type': 'fixed'}]},
+                    s['addresses'])
+
+    @patch.object(FakeClient, 'list_servers')
+    @patch.object(context, 'extract_context_from_environ')
+    def test_get_all_list_error(self, mock_ctx, mock_list):
+        self._prepare_pod()
+        mock_ctx.return_value = self.context
+        mock_list.side_effect = FakeException()
+        # raised before the response is returned, not when streaming
+        self.assertRaises(FakeException, self.controller.get_all)
+        self.assertRaises(FakeException, self.controller.get_one, 'detail')
+
+    @patch.object(context, 'extract_context_from_environ')
+    def test_get_all_cached(self, mock_ctx):
+        t_pod, b_pod = self._prepare_pod()
+        mock_ctx.return_value = self.context
+        cfg.CONF.set_override('list_cache_ttl', 10)
+        self.addCleanup(cfg.CONF.clear_override, 'list_cache_ttl')
+
+        def _list_ids():
+            res = self.controller.get_all()
+            return [s['id'] for s in jsonutils.loads(
+                ''.join(res.app_iter))['servers']]
+
+        BOTTOM_SERVERS.append({'id': 'server_1'})
+        self.assertEqual(['server_1'], _list_ids())
+        BOTTOM_SERVERS.append({'id': 'server_2'})
+        self.assertEqual(['server_1'], _list_ids())
+        list_cache.invalidate(self.project_id)
+        self.assertEqual(['server_1', 'server_2'], _list_ids())
+
     def tearDown(self):
         core.ModelBase.metadata.drop_all(core.get_engine())
         for res in RES_LIST:
             del res[:]
+        id_index.clear()
+        list_cache.clear()
+        list_cache.clear()
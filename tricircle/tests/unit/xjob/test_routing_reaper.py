@@ -0,0 +1,131 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+
+from oslo_utils import timeutils
+
+from tricircle.common import constants
+from tricircle.common import context
+from tricircle.common import exceptions
+import tricircle.db.api as db_api
+from tricircle.db import core
+from tricircle.db import models
+from tricircle.xjob import routing_reaper
+
+
+# max number of servers returned in one list request
+PAGE_SIZE = 2
+
+
+class FakeClient(object):
+    def __init__(self, resources, fail=False):
+        # resource type -> list of ids
+        self.resources = resources
+        self.fail = fail
+
+    def list_resources(self, resource, cxt, filters=None):
+        if self.fail:
+            raise exceptions.EndpointNotAvailable('neutron', 'fake_url')
+        return [{'id': _id} for _id in self.resources.get(resource, [])]
+
+    def list_servers(self, cxt, filters=None):
+        servers = self.list_resources(constants.RT_SERVER, cxt, filters)
+        start = 0
+        for query_filter in filters or []:
+            if query_filter['key'] == 'marker':
+                start = [server['id'] for server in servers].index(
+                    query_filter['value']) + 1
+        return servers[start:start + PAGE_SIZE]
+
+
+class RoutingReaperTest(unittest.TestCase):
+    def setUp(self):
+        core.initialize()
+        core.ModelBase.metadata.create_all(core.get_engine())
+        self.context = context.get_admin_context()
+        self.clients = {}
+        self.reaper = routing_reaper.RoutingReaper(
+            lambda pod_name: self.clients[pod_name])
+        self.old_time = timeutils.utcnow() - datetime.timedelta(days=1)
+
+        for i in xrange(1, 3):
+            db_api.create_pod(self.context, {'pod_id': 'pod_id_%d' % i,
+                                             'pod_name': 'pod_%d' % i,
+                                             'az_name': 'az_name_%d' % i})
+
+    def _create_routing(self, top_id, pod_id, resource_type,
+                        bottom_id='bottom', created_at=None):
+        with self.context.session.begin():
+            core.create_resource(
+                self.context, models.ResourceRouting,
+                {'top_id': top_id, 'bottom_id': bottom_id, 'pod_id': pod_id,
+                 'project_id': 'project_id', 'resource_type': resource_type,
+                 'created_at': created_at or self.old_time})
+
+    def _list_top_ids(self):
+        with self.context.session.begin():
+            return sorted(routing['top_id'] for routing in core.query_resource(
+                self.context, models.ResourceRouting, [], []))
+
+    def test_reap(self):
+        self.clients['pod_1'] = FakeClient(
+            {constants.RT_PORT: ['port_1'],
+             constants.RT_SERVER: ['server_1', 'server_4', 'server_3']})
+        self.clients['pod_2'] = FakeClient({constants.RT_PORT: ['port_3']})
+        self._create_routing('port_1', 'pod_id_1', constants.RT_PORT,
+                             'port_1')
+        self._create_routing('port_2', 'pod_id_1', constants.RT_PORT,
+                             'port_2')
+        self._create_routing('port_3', 'pod_id_2', constants.RT_PORT,
+                             'port_3')
+        # bottom resource never created
+        self._create_routing('port_4', 'pod_id_2', constants.RT_PORT, None)
+        # just created
+        self._create_routing('port_5', 'pod_id_2', constants.RT_PORT,
+                             'port_5', timeutils.utcnow())
+        self._create_routing('server_1', 'pod_id_1', constants.RT_SERVER,
+                             'server_1')
+        self._create_routing('server_2', 'pod_id_1', constants.RT_SERVER,
+                             'server_2')
+        # server not returned in the first page
+        self._create_routing('server_3', 'pod_id_1', constants.RT_SERVER,
+                             'server_3')
+        # resource type not reaped
+        self._create_routing('volume_1', 'pod_id_1', constants.RT_VOLUME,
+                             'volume_1')
+
+        self.assertEqual(3, self.reaper.reap(self.context))
+        self.assertEqual(['port_1', 'port_3', 'port_5', 'server_1',
+                          'server_3', 'volume_1'], self._list_top_ids())
+        self.assertEqual(0, self.reaper.reap(self.context))
+        self.assertEqual(2, self.reaper.stats['runs'])
+        self.assertEqual(3, self.reaper.stats['reaped'])
+
+    def test_reap_list_failure(self):
+        self.clients['pod_1'] = FakeClient({}, fail=True)
+        self.clients['pod_2'] = FakeClient({})
+        self._create_routing('port_1', 'pod_id_1', constants.RT_PORT,
+                             'port_1')
+        self._create_routing('port_2', 'pod_id_2', constants.RT_PORT,
+                             'port_2')
+
+        self.assertEqual(1, self.reaper.reap(self.context))
+        self.assertEqual(['port_1'], self._list_top_ids())
+        self.assertEqual(1, self.reaper.stats['failed_lists'])
+
+    def tearDown(self):
+        core.ModelBase.metadata.drop_all(core.get_engine())
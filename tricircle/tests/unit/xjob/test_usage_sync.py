@@ -0,0 +1,212 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+
+from tricircle.common import constants
+from tricircle.common import context
+from tricircle.common import exceptions
+from tricircle.common import quota
+import tricircle.db.api as db_api
+from tricircle.db import core
+from tricircle.db import models
+from tricircle.xjob import usage_sync
+
+
+FLAVORS = [{'id': 'small', 'vcpus': 1, 'ram': 512},
+           {'id': 'large', 'vcpus': 4, 'ram': 4096}]
+# not listed
+PRIVATE_FLAVORS = [{'id': 'private', 'vcpus': 2, 'ram': 1024}]
+# max number of servers returned in one list request
+PAGE_SIZE = 2
+
+
+class FakeClient(object):
+    def __init__(self, servers, fail=False):
+        self.servers = servers
+        self.fail = fail
+
+    def list_flavors(self, cxt, filters=None):
+        if self.fail:
+            raise exceptions.EndpointNotAvailable('nova', 'fake_url')
+        return FLAVORS
+
+    def get_flavors(self, cxt, flavor_id):
+        for flavor in FLAVORS + PRIVATE_FLAVORS:
+            if flavor['id'] == flavor_id:
+                return flavor
+
+    def list_servers(self, cxt, filters=None):
+        start = 0
+        for query_filter in filters or []:
+            if query_filter['key'] == 'marker':
+                start = [server['id'] for server in self.servers].index(
+                    query_filter['value']) + 1
+        return self.servers[start:start + PAGE_SIZE]
+
+
+class UsageSyncEngineTest(unittest.TestCase):
+    def setUp(self):
+        core.initialize()
+        core.ModelBase.metadata.create_all(core.get_engine())
+        self.context = context.get_admin_context()
+        self.clients = {}
+        self.engine = usage_sync.UsageSyncEngine(
+            lambda pod_name: self.clients[pod_name])
+
+        db_api.create_pod(self.context, {'pod_id': 'top_pod',
+                                         'pod_name': 'top_pod',
+                                         'az_name': ''})
+        for i in xrange(1, 3):
+            db_api.create_pod(self.context, {'pod_id': 'pod_id_%d' % i,
+                                             'pod_name': 'pod_%d' % i,
+                                             'az_name': 'az_name_%d' % i})
+        self.clients['pod_1'] = FakeClient(
+            [{'id': 'server_1', 'tenant_id': 'project_1',
+              'flavor': {'id': 'small'}},
+             {'id': 'server_2', 'tenant_id': 'project_2',
+              'flavor': {'id': 'large'}}])
+        self.clients['pod_2'] = FakeClient(
+            [{'id': 'server_3', 'tenant_id': 'project_1',
+              'flavor': {'id': 'large'}}])
+
+    def _create_routing(self, top_id, pod_id, project_id, resource_type,
+                        bottom_id='bottom'):
+        with self.context.session.begin():
+            core.create_resource(
+                self.context, models.ResourceRouting,
+                {'top_id': top_id, 'bottom_id': bottom_id, 'pod_id': pod_id,
+                 'project_id': project_id, 'resource_type': resource_type})
+
+    def _get_synced(self, project_id):
+        usages = core.query_resource(
+            self.context, models.QuotaUsages,
+            [{'key': 'project_id', 'comparator': 'eq',
+              'value': project_id}], [])
+        return dict((usage['resource'], usage['synced_in_use'])
+                    for usage in usages)
+
+    def test_sync(self):
+        self._create_routing('server_1', 'pod_id_1', 'project_1',
+                             constants.RT_SERVER)
+        self._create_routing('server_2', 'pod_id_2', 'project_1',
+                             constants.RT_SERVER)
+        self._create_routing('volume_1', 'pod_id_1', 'project_1',
+                             constants.RT_VOLUME)
+        # the same volume is counted once
+        self._create_routing('volume_1', 'pod_id_2', 'project_1',
+                             constants.RT_VOLUME)
+        # creation in bottom pod not finished
+        self._create_routing('volume_2', 'pod_id_1', 'project_1',
+                             constants.RT_VOLUME, bottom_id=None)
+        self._create_routing('server_3', 'pod_id_1', 'project_2',
+                             constants.RT_SERVER)
+        self._create_routing('port_1', 'pod_id_1', 'project_2',
+                             constants.RT_PORT)
+
+        self.assertEqual(7, self.engine.sync(self.context))
+        self.assertEqual({'instances': 2, 'volumes': 1,
+                          'cores': 5, 'ram': 4608},
+                         self._get_synced('project_1'))
+        self.assertEqual({'instances': 1, 'cores': 4, 'ram': 4096},
+                         self._get_synced('project_2'))
+
+        # nothing changed
+        self.assertEqual(0, self.engine.sync(self.context))
+
+        self.clients['pod_1'].servers = []
+        self.assertEqual(4, self.engine.sync(self.context))
+        self.assertEqual({'instances': 2, 'volumes': 1,
+                          'cores': 4, 'ram': 4096},
+                         self._get_synced('project_1'))
+        self.assertEqual({'instances': 1, 'cores': 0, 'ram': 0},
+                         self._get_synced('project_2'))
+        self.assertEqual(3, self.engine.stats['runs'])
+        self.assertEqual(11, self.engine.stats['changed'])
+
+    def test_sync_pod_failure(self):
+        self._create_routing('server_1', 'pod_id_1', 'project_1',
+                             constants.RT_SERVER)
+        self.clients['pod_2'].fail = True
+
+        self.assertEqual(1, self.engine.sync(self.context))
+        # cores and ram are not synchronized with partial counts
+        self.assertEqual({'instances': 1}, self._get_synced('project_1'))
+        self.assertEqual(1, self.engine.stats['failed_pods'])
+
+    def test_sync_paged_servers(self):
+        # servers beyond the first page and on private flavors are counted
+        self.clients['pod_2'].servers.extend(
+            [{'id': 'server_4', 'tenant_id': 'project_1',
+              'flavor': {'id': 'small'}},
+             {'id': 'server_5', 'tenant_id': 'project_1',
+              'flavor': {'id': 'private'}}])
+        self.engine.sync(self.context)
+        self.assertEqual({'cores': 8, 'ram': 6144},
+                         self._get_synced('project_1'))
+
+    def test_sync_flavor_not_found(self):
+        self.clients['pod_2'].servers.append(
+            {'id': 'server_4', 'tenant_id': 'project_1',
+             'flavor': {'id': 'deleted'}})
+        self.engine.sync(self.context)
+        self.assertEqual({}, self._get_synced('project_1'))
+        self.assertEqual(1, self.engine.stats['failed_pods'])
+
+    def test_reserve_refresh_synced_usage(self):
+        resources = {'instances': quota.ReservableResource('instances',
+                                                           None)}
+        expire = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        db_api.quota_reserve(self.context, resources, {'instances': 10},
+                             {'instances': 1}, expire, 0, 0, 'project_1')
+        self._create_routing('server_1', 'pod_id_1', 'project_1',
+                             constants.RT_SERVER)
+        self._create_routing('server_2', 'pod_id_2', 'project_1',
+                             constants.RT_SERVER)
+        self.engine.sync(self.context)
+
+        # usage is refreshed when it is older than max_age
+        db_api.quota_reserve(self.context, resources, {'instances': 10},
+                             {'instances': 1}, expire, 0, 1, 'project_1')
+        usages = db_api.quota_usage_get_all_by_project(self.context,
+                                                       'project_1')
+        self.assertEqual({'in_use': 2, 'reserved': 2},
+                         usages['instances'])
+
+    def test_reserve_not_refresh_stale_usage(self):
+        resources = {'instances': quota.ReservableResource('instances',
+                                                           None)}
+        expire = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        reservations = db_api.quota_reserve(
+            self.context, resources, {'instances': 10}, {'instances': 1},
+            expire, 0, 0, 'project_1')
+        self._create_routing('server_1', 'pod_id_1', 'project_1',
+                             constants.RT_SERVER)
+        self._create_routing('server_2', 'pod_id_2', 'project_1',
+                             constants.RT_SERVER)
+        self.engine.sync(self.context)
+        # usage changes after the count starts
+        db_api.reservation_commit(self.context, reservations, 'project_1')
+
+        db_api.quota_reserve(self.context, resources, {'instances': 10},
+                             {'instances': 1}, expire, 0, 1, 'project_1')
+        usages = db_api.quota_usage_get_all_by_project(self.context,
+                                                       'project_1')
+        self.assertEqual({'in_use': 1, 'reserved': 1},
+                         usages['instances'])
+
+    def tearDown(self):
+        core.ModelBase.metadata.drop_all(core.get_engine())
@@ -13,14 +13,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
+import eventlet
 import mock
 from mock import patch
 import unittest
 
+from oslo_config import cfg
+
+from tricircle.common import coalescer
 from tricircle.common import context
+from tricircle.common import quota
 import tricircle.db.api as db_api
 from tricircle.db import core
 from tricircle.db import models
+from tricircle.xjob import routing_reaper
+from tricircle.xjob import usage_sync
 from tricircle.xjob import xmanager
 
 
@@ -32,7 +40,8 @@ BOTTOM1_PORT = []
 BOTTOM2_PORT = []
 BOTTOM1_ROUTER = []
 BOTTOM2_ROUTER = []
-RES_LIST = [BOTTOM1_SUBNET, BOTTOM2_SUBNET, BOTTOM1_PORT, BOTTOM2_PORT]
+RES_LIST = [BOTTOM1_NETWORK, BOTTOM2_NETWORK, BOTTOM1_SUBNET, BOTTOM2_SUBNET,
+            BOTTOM1_PORT, BOTTOM2_PORT, BOTTOM1_ROUTER, BOTTOM2_ROUTER]
 RES_MAP = {'pod_1': {'network': BOTTOM1_NETWORK,
                      'subnet': BOTTOM1_SUBNET,
                      'port': BOTTOM1_PORT,
@@ -47,6 +56,15 @@ class FakeXManager(xmanager.XManager):
     def __init__(self):
         self.clients = {'pod_1': FakeClient('pod_1'),
                         'pod_2': FakeClient('pod_2')}
+        self.host = 'fake_host'
+        self.extra_route_coalescer = coalescer.Coalescer(
+            self._run_exclusive_job, 0)
+        self.reservation_expire_stats = {'runs': 0,
+                                         'expired': 0,
+                                         'last_expired': 0,
+                                         'last_duration': 0.0}
+        self.usage_sync_engine = usage_sync.UsageSyncEngine(self._get_client)
+        self.routing_reaper = routing_reaper.RoutingReaper(self._get_client)
 
     def _get_client(self, pod_name=None):
         return self.clients[pod_name]
@@ -96,9 +114,7 @@ class XManagerTest(unittest.TestCase):
         self.context = context.Context()
         self.xmanager = FakeXManager()
 
-    @patch.object(FakeClient, 'update_routers')
-    def test_configure_extra_routes(self, mock_update):
-        top_router_id = 'router_id'
+    def _prepare_router_in_pods(self, top_router_id):
         for i in xrange(1, 3):
             pod_dict = {'pod_id': 'pod_id_%d' % i,
                         'pod_name': 'pod_%d' % i,
@@ -148,6 +164,11 @@ class XManagerTest(unittest.TestCase):
             with self.context.session.begin():
                 core.create_resource(self.context, models.ResourceRouting,
                                      route)
+
+    @patch.object(FakeClient, 'update_routers')
+    def test_configure_extra_routes(self, mock_update):
+        top_router_id = 'router_id'
+        self._prepare_router_in_pods(top_router_id)
         BOTTOM1_NETWORK.append({'id': 'network_3_id'})
         BOTTOM1_SUBNET.append({'id': 'subnet_3_id',
                                'network_id': 'network_3_id',
@@ -172,3 +193,155 @@ class XManagerTest(unittest.TestCase):
                                           {'nexthop': '100.0.1.1',
                                            'destination': '10.0.3.0/24'}]}})]
         mock_update.assert_has_calls(calls)
+
+    @patch.object(FakeClient, 'get_subnets')
+    @patch.object(FakeClient, 'update_routers')
+    def test_configure_extra_routes_incremental(self, mock_update,
+                                                mock_get_subnet):
+        top_router_id = 'router_id'
+        self._prepare_router_in_pods(top_router_id)
+        subnets = dict((subnet['id'], subnet) for subnet in
+                       BOTTOM1_SUBNET + BOTTOM2_SUBNET)
+        mock_get_subnet.side_effect = lambda cxt, _id: subnets[_id]
+
+        self.xmanager.configure_extra_routes(self.context,
+                                             {'router': top_router_id})
+        self.assertEqual(2, mock_update.call_count)
+        self.assertEqual(2, mock_get_subnet.call_count)
+
+        # nothing changes, no bottom router needs to be updated
+        mock_update.reset_mock()
+        mock_get_subnet.reset_mock()
+        self.xmanager.configure_extra_routes(self.context,
+                                             {'router': top_router_id})
+        self.assertFalse(mock_update.called)
+        self.assertFalse(mock_get_subnet.called)
+
+        # new interface in pod_2, only router in pod_1 needs to be updated
+        subnets['subnet_4_id'] = {'id': 'subnet_4_id',
+                                  'network_id': 'network_4_id',
+                                  'cidr': '10.0.4.0/24',
+                                  'gateway_ip': '10.0.4.1'}
+        BOTTOM2_PORT.append({'network_id': 'network_4_id',
+                             'device_id': 'router_2_id',
+                             'device_owner': 'network:router_interface',
+                             'fixed_ips': [{'subnet_id': 'subnet_4_id',
+                                            'ip_address': '10.0.4.1'}]})
+        self.xmanager.configure_extra_routes(self.context,
+                                             {'router': top_router_id})
+        mock_update.assert_called_once_with(
+            self.context, 'router_1_id',
+            {'router': {
+                'routes': [{'nexthop': '100.0.1.2',
+                            'destination': '10.0.2.0/24'},
+                           {'nexthop': '100.0.1.2',
+                            'destination': '10.0.4.0/24'}]}})
+        mock_get_subnet.assert_called_once_with(self.context, 'subnet_4_id')
+
+    @patch.object(eventlet, 'spawn_after')
+    @patch.object(FakeClient, 'update_routers')
+    def test_configure_extra_routes_lease_held(self, mock_update,
+                                               mock_spawn):
+        top_router_id = 'router_id'
+        self._prepare_router_in_pods(top_router_id)
+        db_api.acquire_job_lease(self.context, top_router_id, 'other_worker',
+                                 300)
+        self.xmanager.configure_extra_routes(self.context,
+                                             {'router': top_router_id})
+        self.assertFalse(mock_update.called)
+        lease = core.query_resource(self.context, models.JobLease, [], [])[0]
+        self.assertTrue(lease['rerun'])
+
+        # job is retried after the lease expires in case the owner is dead
+        mock_spawn.assert_called_once_with(
+            cfg.CONF.job_lease_time, self.xmanager._retry_exclusive_job,
+            self.context, top_router_id, mock.ANY, {'router': top_router_id})
+        db_api.release_job_lease(self.context, top_router_id, 'other_worker')
+        retry_args = mock_spawn.call_args[0][1:]
+        retry_args[0](*retry_args[1:])
+        self.assertTrue(mock_update.called)
+        self.assertEqual(
+            [], core.query_resource(self.context, models.JobLease, [], []))
+
+    def test_configure_extra_routes_rerun(self):
+        top_router_id = 'router_id'
+        runs = []
+
+        def configure(ctx, payload):
+            runs.append(payload)
+            if len(runs) == 1:
+                # another worker receives a job during the first run
+                self.assertFalse(db_api.acquire_job_lease(
+                    ctx, top_router_id, 'other_worker', 300))
+        self.xmanager._configure_extra_routes = configure
+
+        self.xmanager.configure_extra_routes(self.context,
+                                             {'router': top_router_id})
+        self.assertEqual(2, len(runs))
+        self.assertEqual(
+            [], core.query_resource(self.context, models.JobLease, [], []))
+
+    def test_expire_reservations(self):
+        ctx = context.get_admin_context()
+        resources = {'volumes': quota.ReservableResource('volumes', None)}
+        expire = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        for _ in xrange(3):
+            db_api.quota_reserve(ctx, resources, {'volumes': 10},
+                                 {'volumes': 1}, expire, 0, 0, 'project_id')
+
+        self.xmanager.expire_reservations(ctx)
+        self.xmanager.expire_reservations(ctx)
+        self.assertEqual({'runs': 2, 'expired': 3, 'last_expired': 0},
+                         dict((key, value) for key, value in
+                              self.xmanager.reservation_expire_stats.items()
+                              if key != 'last_duration'))
+        usages = db_api.quota_usage_get_all_by_project(ctx, 'project_id')
+        self.assertEqual({'reserved': 0, 'in_use': 0}, usages['volumes'])
+
+    @patch.object(usage_sync.UsageSyncEngine, 'sync')
+    def test_sync_quota_usages(self, mock_sync):
+        self.xmanager.sync_quota_usages(self.context)
+        mock_sync.assert_called_once_with(self.context)
+        self.assertEqual(
+            [], core.query_resource(self.context, models.JobLease, [], []))
+
+        # skipped when another worker is running the job
+        mock_sync.reset_mock()
+        db_api.acquire_job_lease(self.context, 'sync_quota_usages',
+                                 'other_worker', 300)
+        self.xmanager.sync_quota_usages(self.context)
+        self.assertFalse(mock_sync.called)
+
+    @patch.object(routing_reaper.RoutingReaper, 'reap')
+    def test_reap_resource_routings(self, mock_reap):
+        db_api.acquire_job_lease(self.context, 'reap_resource_routings',
+                                 'other_worker', 300)
+        self.xmanager.reap_resource_routings(self.context)
+        self.assertFalse(mock_reap.called)
+
+        db_api.release_job_lease(self.context, 'reap_resource_routings',
+                                 'other_worker')
+        self.xmanager.reap_resource_routings(self.context)
+        mock_reap.assert_called_once_with(self.context)
+
+    def test_task_intervals(self):
+        cfg.CONF.set_override('reservation_expire_interval', 5)
+        self.addCleanup(cfg.CONF.clear_override,
+                        'reservation_expire_interval')
+        cfg.CONF.set_override('usage_sync_interval', 600)
+        self.addCleanup(cfg.CONF.clear_override, 'usage_sync_interval')
+        cfg.CONF.set_override('routing_reap_interval', 7200)
+        self.addCleanup(cfg.CONF.clear_override, 'routing_reap_interval')
+        manager = xmanager.XManager(host='fake_host')
+        self.assertEqual(5, manager._periodic_spacing['expire_reservations'])
+        self.assertEqual(600, manager._periodic_spacing['sync_quota_usages'])
+        self.assertEqual(7200,
+                         manager._periodic_spacing['reap_resource_routings'])
+        # intervals are applied to the instance only
+        self.assertEqual(
+            60, xmanager.XManager._periodic_spacing['expire_reservations'])
+
+    def tearDown(self):
+        core.ModelBase.metadata.drop_all(core.get_engine())
+        for res in RES_LIST:
+            del res[:]
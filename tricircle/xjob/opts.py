@@ -13,6 +13,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import tricircle.xjob.routing_reaper
+import tricircle.xjob.usage_sync
+import tricircle.xjob.xmanager
 import tricircle.xjob.xservice
 
 
@@ -20,4 +23,7 @@ def list_opts():
     return [
         ('DEFAULT', tricircle.xjob.xservice.common_opts),
         ('DEFAULT', tricircle.xjob.xservice.service_opts),
+        ('DEFAULT', tricircle.xjob.xmanager.xmanager_opts),
+        ('DEFAULT', tricircle.xjob.usage_sync.usage_sync_opts),
+        ('DEFAULT', tricircle.xjob.routing_reaper.routing_reaper_opts),
     ]
@@ -0,0 +1,174 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import time
+
+import eventlet
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import timeutils
+
+from tricircle.common import constants
+from tricircle.common.i18n import _
+from tricircle.common.i18n import _LE
+from tricircle.common.i18n import _LI
+from tricircle.common import utils
+import tricircle.db.api as db_api
+from tricircle.db import core
+from tricircle.db import models
+
+
+routing_reaper_opts = [
+    cfg.IntOpt('routing_reap_interval',
+               default=3600,
+               help=_('Seconds between two runs of removing routing entries'
+                      ' whose bottom resources no longer exist')),
+    cfg.IntOpt('routing_reap_min_age',
+               default=300,
+               help=_('Seconds a routing entry should stay unchanged before'
+                      ' it can be removed, so entries being created are'
+                      ' not removed')),
+    cfg.IntOpt('routing_reap_batch_size',
+               default=500,
+               help=_('Number of routing entries read or deleted in one'
+                      ' query')),
+    cfg.IntOpt('routing_reap_concurrency',
+               default=10,
+               help=_('Maximum number of bottom resource lists requested at'
+                      ' the same time')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(routing_reaper_opts)
+LOG = logging.getLogger(__name__)
+
+# filters to list all the bottom resources of one type
+REAP_RESOURCES = {
+    constants.RT_SERVER: [{'key': 'all_tenants', 'comparator': 'eq',
+                           'value': 1}],
+    constants.RT_NETWORK: [],
+    constants.RT_SUBNET: [],
+    constants.RT_PORT: [],
+    constants.RT_ROUTER: []}
+
+
+class RoutingReaper(object):
+    """Remove routing entries not pointing to any bottom resource
+
+    Entries whose bottom resources are never created are removed when they
+    are older than routing_reap_min_age. For each pod and resource type
+    having entries, bottom resources are listed, concurrently for all the
+    pods and types and page by page for servers, then entries are read in
+    batches and compared with the list. Entries of resources deleted in the
+    bottom pod are removed in bulk. A pod failing to list its resources is
+    skipped.
+    """
+
+    def __init__(self, get_client):
+        self._get_client = get_client
+        self.stats = {'runs': 0,
+                      'reaped': 0,
+                      'last_reaped': 0,
+                      'failed_lists': 0,
+                      'last_duration': 0.0}
+
+    def _list_bottom_ids(self, ctx, pod, resource_type):
+        client = self._get_client(pod['pod_name'])
+        filters = REAP_RESOURCES[resource_type]
+        if resource_type == constants.RT_SERVER:
+            # NOTE: server list is paged by nova
+            resources = utils.list_all_servers(client, ctx, filters)
+        else:
+            resources = client.list_resources(resource_type, ctx, filters)
+        return set(res['id'] for res in resources)
+
+    def _find_stale_routings(self, ctx, pod, resource_type, bottom_ids,
+                             reap_before):
+        filters = [{'key': 'pod_id', 'comparator': 'eq',
+                    'value': pod['pod_id']},
+                   {'key': 'resource_type', 'comparator': 'eq',
+                    'value': resource_type},
+                   {'key': 'bottom_id', 'comparator': 'is_null',
+                    'value': False},
+                   {'key': 'created_at', 'comparator': 'lt',
+                    'value': reap_before}]
+        routings = core.query_resource_iter(
+            ctx, models.ResourceRouting, filters, [('id', True)],
+            batch_size=CONF.routing_reap_batch_size)
+        stale_ids = []
+        for routing in routings:
+            if routing['bottom_id'] in bottom_ids:
+                continue
+            if routing['updated_at'] and routing['updated_at'] >= reap_before:
+                # bound after the bottom resources are listed
+                continue
+            stale_ids.append(routing['id'])
+        return stale_ids
+
+    def _reap_pod_type(self, ctx, pod, resource_type, reap_before):
+        try:
+            bottom_ids = self._list_bottom_ids(ctx, pod, resource_type)
+            return self._find_stale_routings(ctx, pod, resource_type,
+                                             bottom_ids, reap_before)
+        except Exception as e:
+            LOG.error(_LE('Fail to reap %(type)s routing entries in pod '
+                          '%(pod)s: %(exception)s'),
+                      {'type': resource_type, 'pod': pod['pod_name'],
+                       'exception': e})
+            return None
+
+    def reap(self, ctx):
+        """Remove stale routing entries
+
+        :return: number of removed entries
+        """
+        start = time.time()
+        reap_before = timeutils.utcnow() - datetime.timedelta(
+            seconds=CONF.routing_reap_min_age)
+        reaped = db_api.delete_unbound_resource_routings(ctx, reap_before)
+
+        pods = dict((pod['pod_id'], pod) for pod in db_api.list_pods(ctx))
+        pod_types = sorted(db_api.get_resource_routing_pod_types(
+            ctx, REAP_RESOURCES.keys()))
+        pool = eventlet.GreenPool(CONF.routing_reap_concurrency)
+
+        def _reap(pod_type):
+            pod_id, resource_type = pod_type
+            return self._reap_pod_type(ctx, pods[pod_id], resource_type,
+                                       reap_before)
+
+        stale_ids = []
+        failed = 0
+        for ids in pool.imap(_reap, pod_types):
+            if ids is None:
+                failed += 1
+            else:
+                stale_ids.extend(ids)
+        reaped += db_api.delete_resource_routings(
+            ctx, stale_ids, CONF.routing_reap_batch_size)
+        duration = time.time() - start
+
+        stats = self.stats
+        stats['runs'] += 1
+        stats['reaped'] += reaped
+        stats['last_reaped'] = reaped
+        stats['failed_lists'] += failed
+        stats['last_duration'] = duration
+        if reaped:
+            LOG.info(_LI('Removed %(num)d stale routing entries in %(time).3f '
+                         'seconds'), {'num': reaped, 'time': duration})
+        LOG.debug('Routing reaper stats: %s', stats)
+        return reaped
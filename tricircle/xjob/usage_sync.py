@@ -0,0 +1,172 @@
+# Copyright 2015 Huawei Technologies Co., Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import eventlet
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import timeutils
+
+from tricircle.common import constants
+from tricircle.common.i18n import _
+from tricircle.common.i18n import _LE
+from tricircle.common.i18n import _LI
+from tricircle.common import utils
+import tricircle.db.api as db_api
+
+
+usage_sync_opts = [
+    cfg.IntOpt('usage_sync_interval',
+               default=300,
+               help=_('Seconds between two runs of counting resources in'
+                      ' bottom pods to refresh quota usages')),
+    cfg.IntOpt('usage_sync_batch_size',
+               default=100,
+               help=_('Number of projects whose quota usages are updated in'
+                      ' one transaction')),
+    cfg.IntOpt('usage_sync_pod_concurrency',
+               default=10,
+               help=_('Maximum number of bottom pods queried at the same'
+                      ' time when counting cores and ram')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(usage_sync_opts)
+LOG = logging.getLogger(__name__)
+
+# quota resources counted from the resource routing table
+ROUTING_RESOURCES = {constants.RT_SERVER: 'instances',
+                     constants.RT_VOLUME: 'volumes',
+                     constants.RT_SNAPSHOT: 'snapshots',
+                     constants.RT_BACKUP: 'backups'}
+# quota resources counted from servers in bottom pods
+SERVER_RESOURCES = ('cores', 'ram')
+
+
+class UsageSyncEngine(object):
+    """Count resources of all the projects for quota usage refresh
+
+    Instances, volumes, snapshots and backups are counted from the resource
+    routing table in one query. Cores and ram are summed up from servers
+    and flavors listed in every bottom pod, pods are queried concurrently
+    and servers are listed page by page.
+    The counts are saved in the usages and applied when quota_reserve
+    refreshes the usages, so counting is never done for a reservation.
+    """
+
+    def __init__(self, get_client):
+        self._get_client = get_client
+        self.stats = {'runs': 0,
+                      'changed': 0,
+                      'last_changed': 0,
+                      'failed_pods': 0,
+                      'last_duration': 0.0}
+
+    def _count_pod_servers(self, ctx, pod):
+        client = self._get_client(pod['pod_name'])
+        flavors = dict((flavor['id'], flavor)
+                       for flavor in client.list_flavors(ctx))
+        filters = [{'key': 'all_tenants', 'comparator': 'eq', 'value': 1}]
+        counts = {}
+        for server in utils.list_all_servers(client, ctx, filters):
+            flavor_id = (server.get('flavor') or {}).get('id')
+            if flavor_id not in flavors:
+                # NOTE: only public flavors are listed, private
+                # ones are fetched by id
+                flavors[flavor_id] = client.get_flavors(ctx, flavor_id)
+            flavor = flavors[flavor_id]
+            if not flavor:
+                # counts missing a server would release quota still in use
+                LOG.error(_LE('Fail to find flavor %(flavor)s of server '
+                              '%(server)s in pod %(pod)s'),
+                          {'flavor': flavor_id, 'server': server['id'],
+                           'pod': pod['pod_name']})
+                return None
+            project_counts = counts.setdefault(
+                server['tenant_id'], dict.fromkeys(SERVER_RESOURCES, 0))
+            project_counts['cores'] += flavor['vcpus']
+            project_counts['ram'] += flavor['ram']
+        return counts
+
+    def _count_servers(self, ctx):
+        """Sum up cores and ram in all bottom pods
+
+        :return: counts like {project_id: {'cores': 4, 'ram': 4096}}, or
+                 None if any of the pods fails to be counted
+        """
+        pods = [pod for pod in db_api.list_pods(ctx) if pod['az_name']]
+        pool = eventlet.GreenPool(CONF.usage_sync_pod_concurrency)
+
+        def _count(pod):
+            try:
+                return self._count_pod_servers(ctx, pod)
+            except Exception as e:
+                LOG.error(_LE('Fail to count servers in pod %(pod)s: '
+                              '%(exception)s'),
+                          {'pod': pod['pod_name'], 'exception': e})
+                return None
+
+        result = {}
+        failed = 0
+        for counts in pool.imap(_count, pods):
+            if counts is None:
+                failed += 1
+                continue
+            for project_id, project_counts in counts.iteritems():
+                total = result.setdefault(
+                    project_id, dict.fromkeys(SERVER_RESOURCES, 0))
+                for resource, count in project_counts.iteritems():
+                    total[resource] += count
+        self.stats['failed_pods'] += failed
+        # partial sums would release quota still in use, so skip them
+        return None if failed else result
+
+    def sync(self, ctx):
+        """Count resources and update usages of all the projects
+
+        :return: number of usages changed or created
+        """
+        start = time.time()
+        counted_at = timeutils.utcnow()
+        routing_counts = db_api.count_resource_routings(
+            ctx, ROUTING_RESOURCES.keys())
+        in_use = {}
+        for project_id, counts in routing_counts.iteritems():
+            in_use[project_id] = dict(
+                (ROUTING_RESOURCES[resource_type], count)
+                for resource_type, count in counts.iteritems())
+        changed = db_api.quota_usages_sync(
+            ctx, ROUTING_RESOURCES.values(), in_use, counted_at,
+            CONF.usage_sync_batch_size)
+
+        counted_at = timeutils.utcnow()
+        server_counts = self._count_servers(ctx)
+        if server_counts is not None:
+            changed += db_api.quota_usages_sync(
+                ctx, SERVER_RESOURCES, server_counts, counted_at,
+                CONF.usage_sync_batch_size)
+        duration = time.time() - start
+
+        stats = self.stats
+        stats['runs'] += 1
+        stats['changed'] += changed
+        stats['last_changed'] = changed
+        stats['last_duration'] = duration
+        if changed:
+            LOG.info(_LI('Synchronized %(num)d quota usages in %(time).3f '
+                         'seconds'), {'num': changed, 'time': duration})
+        LOG.debug('Usage sync stats: %s', stats)
+        return changed
@@ -13,23 +13,59 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import eventlet
 import netaddr
+import os
+import time
 
 from oslo_config import cfg
 from oslo_log import log as logging
 import oslo_messaging as messaging
 from oslo_service import periodic_task
+from oslo_utils import excutils
+import six
 
 from tricircle.common import client
+from tricircle.common import coalescer
 from tricircle.common import constants
 from tricircle.common.i18n import _
+from tricircle.common.i18n import _LE
 from tricircle.common.i18n import _LI
 import tricircle.db.api as db_api
-
+from tricircle.xjob import routing_reaper
+from tricircle.xjob import usage_sync
+
+
+xmanager_opts = [
+    cfg.FloatOpt('extra_route_coalesce_window',
+                 default=0,
+                 help=_('Seconds to wait before configuring extra routes for'
+                        ' a router, requests for the same router received'
+                        ' during this period are merged into one job. Every'
+                        ' job is delayed by this period even if nothing is'
+                        ' merged. Set to 0 to configure extra routes'
+                        ' immediately')),
+    cfg.IntOpt('job_lease_time',
+               default=300,
+               help=_('Seconds a worker can exclusively run jobs for one'
+                      ' resource before other workers can take over, jobs'
+                      ' for the same resource are never run by different'
+                      ' workers at the same time')),
+    cfg.IntOpt('reservation_expire_interval',
+               default=60,
+               help=_('Seconds between two runs of rolling back expired quota'
+                      ' reservations')),
+]
 
 CONF = cfg.CONF
+CONF.register_opts(xmanager_opts)
 LOG = logging.getLogger(__name__)
 
+# periodic task name -> name of the option giving its interval
+_TASK_INTERVAL_OPTS = {'expire_reservations': 'reservation_expire_interval',
+                       'sync_quota_usages': 'usage_sync_interval',
+                       'reap_resource_routings': 'routing_reap_interval'}
+
 
 class PeriodicTasks(periodic_task.PeriodicTasks):
     def __init__(self):
@@ -51,7 +87,26 @@ class XManager(PeriodicTasks):
         # self.notifier = rpc.get_notifier(self.service_name, self.host)
         self.additional_endpoints = []
         self.clients = {'top': client.Client()}
+        self.extra_route_coalescer = coalescer.Coalescer(
+            self._run_exclusive_job, CONF.extra_route_coalesce_window)
+        self.reservation_expire_stats = {'runs': 0,
+                                         'expired': 0,
+                                         'last_expired': 0,
+                                         'last_duration': 0.0}
+        self.usage_sync_engine = usage_sync.UsageSyncEngine(self._get_client)
+        self.routing_reaper = routing_reaper.RoutingReaper(self._get_client)
         super(XManager, self).__init__()
+        self._apply_task_intervals()
+
+    def _apply_task_intervals(self):
+        # NOTE: spacing passed to the periodic_task decorator is
+        # read when this module is imported, before config files are
+        # parsed, so intervals are read from the loaded config here
+        self._periodic_spacing = dict(self._periodic_spacing)
+        for task_name, opt_name in six.iteritems(_TASK_INTERVAL_OPTS):
+            interval = CONF[opt_name]
+            if interval > 0:
+                self._periodic_spacing[task_name] = interval
 
     def _get_client(self, pod_name=None):
         if not pod_name:
@@ -60,10 +115,86 @@ class XManager(PeriodicTasks):
             self.clients[pod_name] = client.Client(pod_name)
         return self.clients[pod_name]
 
+    @property
+    def worker_id(self):
+        # NOTE: workers are forked after manager is created, so
+        # process id is read every time
+        return '%s:%d' % (self.host, os.getpid())
+
+    def _run_exclusive_job(self, ctx, resource_id, handler, payload):
+        worker_id = self.worker_id
+        if not db_api.acquire_job_lease(ctx, resource_id, worker_id,
+                                        CONF.job_lease_time):
+            # NOTE: the owner of the lease runs the job again before
+            # releasing it, but if the owner dies the job is lost, so it is
+            # also retried here once the lease expires
+            LOG.debug('Job for resource %s is running in another worker, '
+                      'rerun requested and retry scheduled', resource_id)
+            eventlet.spawn_after(CONF.job_lease_time,
+                                 self._retry_exclusive_job,
+                                 ctx, resource_id, handler, payload)
+            return
+        rerun = True
+        while rerun:
+            try:
+                handler(ctx, payload)
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    db_api.release_job_lease(ctx, resource_id, worker_id)
+            rerun = db_api.release_job_lease(ctx, resource_id, worker_id,
+                                             CONF.job_lease_time)
+
+    def _retry_exclusive_job(self, ctx, resource_id, handler, payload):
+        try:
+            self._run_exclusive_job(ctx, resource_id, handler, payload)
+        except Exception:
+            LOG.exception(_LE('Failed to retry job for resource %s'),
+                          resource_id)
+
+    def _run_periodic_job(self, ctx, job_name, func):
+        # every xjob worker runs the periodic tasks, a worker skips the job
+        # if another one is running it
+        worker_id = self.worker_id
+        if not db_api.acquire_job_lease(ctx, job_name, worker_id,
+                                        CONF.job_lease_time):
+            LOG.debug('Periodic job %s is running in another worker, '
+                      'skipped', job_name)
+            return
+        try:
+            func(ctx)
+        finally:
+            db_api.release_job_lease(ctx, job_name, worker_id)
+
     def periodic_tasks(self, context, raise_on_error=False):
         """Tasks to be run at a periodic interval."""
         return self.run_periodic_tasks(context, raise_on_error=raise_on_error)
 
+    @periodic_task.periodic_task
+    def expire_reservations(self, ctx):
+        start = time.time()
+        expired = db_api.reservation_expire(ctx)
+        duration = time.time() - start
+
+        stats = self.reservation_expire_stats
+        stats['runs'] += 1
+        stats['expired'] += expired
+        stats['last_expired'] = expired
+        stats['last_duration'] = duration
+        if expired:
+            LOG.info(_LI('Expired %(num)d quota reservations in %(time).3f '
+                         'seconds'), {'num': expired, 'time': duration})
+        LOG.debug('Reservation expire stats: %s', stats)
+
+    @periodic_task.periodic_task
+    def sync_quota_usages(self, ctx):
+        self._run_periodic_job(ctx, 'sync_quota_usages',
+                               self.usage_sync_engine.sync)
+
+    @periodic_task.periodic_task
+    def reap_resource_routings(self, ctx):
+        self._run_periodic_job(ctx, 'reap_resource_routings',
+                               self.routing_reaper.reap)
+
     def init_host(self):
 
         """init_host
@@ -129,50 +260,105 @@ class XManager(PeriodicTasks):
         return info_text
 
     def configure_extra_routes(self, ctx, payload):
+        # NOTE: plugin casts one message for each router interface
+        # added, jobs for the same router are merged since one run already
+        # configures routes for all the interfaces
+        t_router_id = payload['router']
+        self.extra_route_coalescer.submit(
+            t_router_id, ctx, t_router_id, self._configure_extra_routes,
+            payload)
+        LOG.debug('Extra route job stats: %s',
+                  self.extra_route_coalescer.get_stats())
+
+    def _configure_extra_routes(self, ctx, payload):
         # TODO(zhiyuan) performance and reliability issue
         # better have a job tracking mechanism
         t_router_id = payload['router']
 
-        b_pods, b_router_ids = zip(*db_api.get_bottom_mappings_by_top_id(
-            ctx, t_router_id, constants.RT_ROUTER))
+        mappings = db_api.get_bottom_mappings_by_top_id(
+            ctx, t_router_id, constants.RT_ROUTER)
+        if not mappings:
+            return
+        b_pods, b_router_ids = zip(*mappings)
+
+        # NOTE: snapshot records bridge ip and cidrs of each bottom
+        # router when routes were last pushed, so we only need to update
+        # bottom routers whose route set actually changes. subnet cidr is
+        # immutable, so cidrs of known subnets are also taken from snapshot
+        snapshots = db_api.get_extra_route_snapshots(ctx, t_router_id)
 
         router_bridge_ip_map = {}
         router_cidr_map = {}
         for i, b_pod in enumerate(b_pods):
+            b_router_id = b_router_ids[i]
+            known_cidr_map = dict(
+                snapshots.get(b_router_id, {}).get('subnet_cidrs', []))
             bottom_client = self._get_client(pod_name=b_pod['pod_name'])
             b_inferfaces = bottom_client.list_ports(
                 ctx, filters=[{'key': 'device_id',
                                'comparator': 'eq',
-                               'value': b_router_ids[i]},
+                               'value': b_router_id},
                               {'key': 'device_owner',
                                'comparator': 'eq',
                                'value': 'network:router_interface'}])
-            cidrs = []
+            subnet_cidrs = []
             for b_inferface in b_inferfaces:
                 ip = b_inferface['fixed_ips'][0]['ip_address']
                 ew_bridge_cidr = '100.0.0.0/9'
                 ns_bridge_cidr = '100.128.0.0/9'
                 if netaddr.IPAddress(ip) in netaddr.IPNetwork(ew_bridge_cidr):
-                    router_bridge_ip_map[b_router_ids[i]] = ip
+                    router_bridge_ip_map[b_router_id] = ip
                     continue
                 if netaddr.IPAddress(ip) in netaddr.IPNetwork(ns_bridge_cidr):
                     continue
-                b_subnet = bottom_client.get_subnets(
-                    ctx, b_inferface['fixed_ips'][0]['subnet_id'])
-                cidrs.append(b_subnet['cidr'])
-            router_cidr_map[b_router_ids[i]] = cidrs
+                b_subnet_id = b_inferface['fixed_ips'][0]['subnet_id']
+                if b_subnet_id in known_cidr_map:
+                    cidr = known_cidr_map[b_subnet_id]
+                else:
+                    cidr = bottom_client.get_subnets(ctx, b_subnet_id)['cidr']
+                subnet_cidrs.append([b_subnet_id, cidr])
+            router_cidr_map[b_router_id] = subnet_cidrs
+
+        new_snapshots = {}
+        for i, b_router_id in enumerate(b_router_ids):
+            new_snapshots[b_router_id] = {
+                'pod_id': b_pods[i]['pod_id'],
+                'bridge_ip': router_bridge_ip_map.get(b_router_id),
+                'subnet_cidrs': router_cidr_map[b_router_id]}
+        changed_router_ids = set(
+            [router_id for router_id in snapshots
+             if router_id not in new_snapshots])
+        for router_id, snapshot in new_snapshots.iteritems():
+            old_snapshot = snapshots.get(router_id)
+            if not old_snapshot or (
+                    old_snapshot['bridge_ip'] != snapshot['bridge_ip'] or
+                    old_snapshot['subnet_cidrs'] != snapshot['subnet_cidrs']):
+                changed_router_ids.add(router_id)
 
         for i, b_router_id in enumerate(b_router_ids):
             if b_router_id not in router_bridge_ip_map:
                 continue
+            old_snapshot = snapshots.get(b_router_id)
+            # routes of one bottom router only depend on the bridge ips and
+            # cidrs of the other bottom routers, skip it if none of them
+            # changes and routes have been pushed to it before
+            if old_snapshot and old_snapshot['bridge_ip'] and not (
+                    changed_router_ids - set([b_router_id])):
+                continue
             bottom_client = self._get_client(pod_name=b_pods[i]['pod_name'])
             extra_routes = []
-            for router_id, cidrs in router_cidr_map.iteritems():
+            for router_id in b_router_ids:
                 if router_id == b_router_id:
                     continue
-                for cidr in cidrs:
+                if router_id not in router_bridge_ip_map:
+                    continue
+                for _subnet_id, cidr in router_cidr_map[router_id]:
                     extra_routes.append(
                         {'nexthop': router_bridge_ip_map[router_id],
                          'destination': cidr})
             bottom_client.update_routers(ctx, b_router_id,
                                          {'router': {'routes': extra_routes}})
+
+        if changed_router_ids:
+            db_api.update_extra_route_snapshots(ctx, t_router_id,
+                                                new_snapshots)
@@ -37,6 +37,7 @@ from tricircle.common import version
 from tricircle.common.serializer import TricircleSerializer as Serializer
 
 from tricircle.common import topics
+from tricircle.db import core
 from tricircle.xjob.xmanager import XManager
 
 
@@ -103,6 +104,7 @@ class XService(srv.Service):
                  {'topic': self.topic, 'version': ver_str})
 
         self.basic_config_check()
+        core.warmup_engine()
         self.manager.init_host()
         self.manager.pre_start_hook()
 